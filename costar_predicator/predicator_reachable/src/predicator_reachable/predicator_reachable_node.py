@@ -4,6 +4,7 @@ import rospy
 import moveit_msgs
 import tf
 import tf_conversions as tfc
+import numpy as np
 
 # import predicator to let us see what's going on
 from predicator_msgs.msg import *
@@ -18,6 +19,12 @@ from geometry_msgs.msg import *
 from predicator_reachable.srv import CheckReachability
 from predicator_reachable.srv import CheckReachabilityResponse
 
+# precomputed reachability maps are optional
+try:
+    from costar_robot.reachability_map import ReachabilityMap
+except ImportError:
+    ReachabilityMap = None
+
 
 def flip_rotation_frame(trans, rot):
     f = tfc.fromTf((trans, rot))
@@ -90,6 +97,15 @@ class PredicatorReachability(object):
 
         self.tfl = tf.TransformListener()
 
+        # robot name -> ReachabilityMap; frames the map rules out are not
+        # sent to compute_ik at all
+        self.reachability_maps = {}
+        for robot, filename in rospy.get_param("~reachability_maps", {}).items():
+            if ReachabilityMap is None:
+                rospy.logwarn("costar_robot is not available, ignoring reachability maps")
+                break
+            self.reachability_maps[robot] = ReachabilityMap.load(filename)
+
         if self.verbose == 1:
             print "starting"
 
@@ -185,7 +201,29 @@ class PredicatorReachability(object):
 
         return msg
 
+    '''
+    reachable_in_map()
+    First-pass check with the robot's reachability map, if it has one. Only
+    returns False if the map is sure the pose (in /world) cannot be reached.
+    '''
+    def reachable_in_map(self, robot, trans, rot):
+        if not robot in self.reachability_maps:
+            return True
+        reachability_map = self.reachability_maps[robot]
+        try:
+            T_base_world = tfc.toMatrix(tfc.fromTf(
+                self.tfl.lookupTransform(reachability_map.base_link, "/world", rospy.Time(0))))
+        except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException):
+            return True
+        T = T_base_world.dot(tfc.toMatrix(tfc.fromTf((trans, rot))))
+        return bool(reachability_map.reachable(T[np.newaxis])[0])
+
     def reachable(self, robot, trans, rot, srv):
+        if not self.reachable_in_map(robot, trans, rot):
+            if self.verbose:
+                print "Not reachable according to the reachability map"
+            return False
+
         p = geometry_msgs.msg.PoseStamped()
         p.pose.position.x = trans[0]
         p.pose.position.y = trans[1]
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Compare the in-process DMPs (costar_dmp DiscreteDMP) with the dmp package
+# services: learn the same demonstration with both, plan to the demonstrated
+# goal and to shifted goals, and check that the plans have the same points
+# and agree to TOLERANCE.
+# Also prints how long learning and planning take with both.
+#
+# usage: rosrun costar_dmp dmp_local_test.py (with the dmp dmp_server node running)
+
+import sys
+import time
+import rospy
+import numpy as np
+from dmp.srv import *
+from dmp.msg import *
+
+from costar_dmp.dmp_learning import DiscreteDMP
+
+TOLERANCE = 1e-3
+
+if __name__ == '__main__':
+  rospy.init_node('dmp_local_test')
+  rospy.wait_for_service('learn_dmp_from_demo')
+  lfd = rospy.ServiceProxy('learn_dmp_from_demo', LearnDMPFromDemo)
+  sad = rospy.ServiceProxy('set_active_dmp', SetActiveDMP)
+  gdp = rospy.ServiceProxy('get_dmp_plan', GetDMPPlan)
+
+  # smooth 6 dimensional demonstration, 2 seconds at 100 Hz
+  dims, dt, num_bases = 6, 0.01, 20
+  times = np.arange(0., 2. + dt / 2, dt)
+  s = times / times[-1]
+  demo = np.column_stack([0.1 * i + (0.2 + 0.05 * i) * (10 * s**3 - 15 * s**4 + 6 * s**5)
+      + 0.02 * np.sin(np.pi * (i + 1) * s) for i in xrange(dims)])
+  k_gains = [100.] * dims
+  d_gains = [2. * np.sqrt(100.)] * dims
+
+  traj = DMPTraj(times=times.tolist())
+  for x in demo.tolist():
+    traj.points.append(DMPPoint(positions=x))
+
+  start = time.time()
+  resp = lfd(traj, k_gains, d_gains, num_bases)
+  t_lfd = time.time() - start
+  start = time.time()
+  dmp, tau, _, _ = DiscreteDMP.learn(times, demo, k_gains, d_gains, num_bases)
+  t_learn = time.time() - start
+  sad(resp.dmp_list)
+  weight_error = np.abs(np.array([d.weights for d in resp.dmp_list]) - dmp.weights).max()
+
+  ok = True
+  print "Learning: service %.2f ms, local %.2f ms, max weight difference %g"%(
+      1e3 * t_lfd, 1e3 * t_learn, weight_error)
+  for offset in (0., 0.05, -0.1):
+    goal = demo[-1] + offset
+    args = (demo[0].tolist(), [0.] * dims, 0., goal.tolist(), [0.01] * dims, -1, tau, dt, 1)
+    start = time.time()
+    plan = gdp(*args).plan
+    t_service = time.time() - start
+    start = time.time()
+    local_times, x, v, at_goal = dmp.plan(*args)
+    t_local = time.time() - start
+
+    x_service = np.array([pt.positions for pt in plan.points])
+    v_service = np.array([pt.velocities for pt in plan.points])
+    if len(x) == len(x_service):
+      error = max(np.abs(x - x_service).max(), np.abs(v - v_service).max(),
+          np.abs(local_times - np.array(plan.times)).max())
+    else:
+      error = np.inf
+    ok = ok and error <= TOLERANCE
+    print "Goal offset %5.2f: %d/%d points, max difference %g, service %.2f ms, local %.2f ms"%(
+        offset, len(x_service), len(x), error, 1e3 * t_service, 1e3 * t_local)
+
+  print "PASSED" if ok else "FAILED"
+  sys.exit(0 if ok else 1)
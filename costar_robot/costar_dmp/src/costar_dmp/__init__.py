@@ -1,2 +1,4 @@
 import commands
-from dmp_server import CostarDMP 
\ No newline at end of file
+from dmp_server import CostarDMP
+from demo_recorder import DemoRecorder
+from dmp_learning import DiscreteDMP
@@ -0,0 +1,146 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import io
+import base64
+import numpy as np
+
+from threading import Lock
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    from time import time as clock
+
+def euler_from_matrices(R):
+    '''
+    Static xyz (roll, pitch, yaw) angles of (N, 3, 3) rotation matrices,
+    like tf.transformations.euler_from_matrix(R, 'sxyz') for each of them.
+    '''
+    roll = np.arctan2(R[:,2,1], R[:,2,2])
+    pitch = np.arctan2(-R[:,2,0], np.sqrt(R[:,0,0]**2 + R[:,1,0]**2))
+    yaw = np.arctan2(R[:,1,0], R[:,0,0])
+    return np.column_stack((roll, pitch, yaw))
+
+# DEMO RECORDER
+# Records a demonstration as joint positions with timestamps, straight from
+# the joint_states callback into a preallocated ring buffer: adding a sample
+# copies dof numbers and never allocates, so recording runs at the rate of
+# the joint states and not at the rate TF lookups can be done. When the
+# buffer is full the oldest samples are overwritten.
+#
+# Samples use the joint state header stamp (or a monotonic clock if it is
+# not set); samples that are not newer than the last one are dropped.
+# resample() returns the demonstration at a fixed rate; end effector poses
+# are computed for all samples at once with forward_batch, which maps
+# (N, dof) joint positions to (N, 4, 4) poses.
+class DemoRecorder(object):
+
+    def __init__(self, joint_names, forward_batch=None, capacity=60000):
+        self.joint_names = list(joint_names)
+        self.forward_batch = forward_batch
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.positions = np.zeros((capacity, len(self.joint_names)))
+        self.mtx = Lock()
+        self._msg_names = None
+        self._msg_index = None
+        self.clear()
+
+    def clear(self):
+        '''
+        Forget all samples.
+        '''
+        with self.mtx:
+            self.count = 0
+            self.next = 0
+            self.last_time = None
+            self.dropped = 0
+
+    def add(self, t, q):
+        '''
+        Store joint positions q (in the order of joint_names) at time t.
+        '''
+        with self.mtx:
+            if self.last_time is not None and t <= self.last_time:
+                self.dropped += 1
+                return
+            self.times[self.next] = t
+            self.positions[self.next] = q
+            self.last_time = t
+            self.next = (self.next + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def add_joint_state(self, msg):
+        '''
+        joint_states callback: store the positions of the recorded joints.
+        '''
+        names = tuple(msg.name)
+        if names != self._msg_names:
+            # joint states may list more joints (e.g. a gripper), in any order
+            if not all(name in names for name in self.joint_names):
+                return
+            self._msg_names = names
+            self._msg_index = [names.index(name) for name in self.joint_names]
+        t = msg.header.stamp.to_sec()
+        if t == 0:
+            t = clock()
+        self.add(t, [msg.position[i] for i in self._msg_index])
+
+    def samples(self):
+        '''
+        Recorded times (starting at 0) and joint positions, oldest first.
+        '''
+        with self.mtx:
+            order = (np.arange(self.count) + self.next - self.count) % self.capacity
+            times = self.times[order]
+            positions = self.positions[order]
+        if len(times) > 0:
+            times = times - times[0]
+        return times, positions
+
+    def wrapped(self):
+        '''
+        True if the buffer was full and the start of the demonstration is lost.
+        '''
+        return self.count == self.capacity
+
+    def resample(self, rate):
+        '''
+        Joint positions at rate Hz over the recorded time span, linearly
+        interpolated. Returns (times, positions).
+        '''
+        times, positions = self.samples()
+        if len(times) < 2:
+            return times, positions
+        t = np.arange(0., times[-1] + 0.5 / rate, 1. / rate)
+        t = np.minimum(t, times[-1])
+        Q = np.column_stack([np.interp(t, times, positions[:,j])
+            for j in xrange(positions.shape[1])])
+        return t, Q
+
+    def poses(self, positions):
+        '''
+        End effector position and unwrapped roll, pitch, yaw for every row of
+        joint positions, (N, 6); the representation the DMPs are learned in.
+        '''
+        Ts = np.asarray(self.forward_batch(positions))
+        rpy = np.unwrap(euler_from_matrices(Ts[:,0:3,0:3]), axis=0)
+        return np.column_stack((Ts[:,0:3,3], rpy))
+
+def dump_demo(**arrays):
+    '''
+    Demonstration arrays (times, joint positions, poses, ...) as a compressed
+    .npz archive, base64 encoded so it can be kept with the librarian.
+    '''
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **dict((key, np.asarray(value)) for key, value in arrays.items()))
+    return base64.b64encode(buf.getvalue())
+
+def load_demo(text):
+    '''
+    Arrays of a demonstration stored with dump_demo().
+    '''
+    data = np.load(io.BytesIO(base64.b64decode(text)))
+    return dict((key, data[key]) for key in data.files)
@@ -0,0 +1,218 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+# the phase decays to 1% at t = tau
+ALPHA = -np.log(0.01)
+# longest plan (in DMP time units) when the goal is not reached
+MAX_PLAN_LENGTH = 1000.
+
+def phase(t, tau):
+    '''
+    Canonical system: phase exp(-alpha t / tau) at times t.
+    '''
+    return np.exp(-(ALPHA / tau) * np.asarray(t, dtype=float))
+
+def fourier_features(x, num_bases):
+    '''
+    Fourier basis cos(pi i x), i = 0..num_bases-1, at the points x;
+    returns a (len(x), num_bases) array.
+    '''
+    return np.cos(np.pi * np.outer(x, np.arange(num_bases)))
+
+def matrix_powers(A, n):
+    '''
+    A^0 .. A^(n-1) for a stack of square matrices A (..., m, m), as an
+    (n, ..., m, m) array. Uses log2(n) batched products.
+    '''
+    P = np.empty((n,) + A.shape)
+    P[0] = np.eye(A.shape[-1])
+    k = 1
+    Ak = A
+    while k < n:
+        m = min(k, n - k)
+        P[k:k+m] = np.matmul(P[:m], Ak)
+        Ak = np.matmul(Ak, Ak)
+        k += m
+    return P
+
+def causal_convolve(h, u):
+    '''
+    y[n] = sum_{j<=n} h[n-j] u[j] along the first axis, with FFTs. h and u
+    have the same length; trailing axes broadcast.
+    '''
+    n = len(u)
+    size = 2 * n
+    H = np.fft.rfft(h, size, axis=0)
+    U = np.fft.rfft(u, size, axis=0)
+    return np.fft.irfft(H * U, size, axis=0)[:n]
+
+# DISCRETE DMP
+# In-process version of the discrete DMPs of the ROS dmp package
+# (learn_dmp_from_demo, get_dmp_plan), for all dimensions at once:
+#
+#   tau v' = K (g - x) - D v - K (g - x0) s + K f(t / tau) s,   tau x' = v
+#
+# with the phase s = exp(-alpha t / tau) (zero for t >= tau when planning,
+# like in the service) and f a Fourier series in the scaled time t / tau.
+# The weights of all dimensions are fit with one least squares solve.
+#
+# Plans are integrated with integrate_iter Euler steps per plan point. The
+# integration is linear in the start state and the goal, so it is not done
+# step by step: the response to the start state (powers of the step matrix)
+# and to the goal, start and forcing inputs (FFT convolutions) are computed
+# once for a tau, dt and plan length, and a plan for a new goal or start is
+# a weighted sum of them. Replanning with a new goal costs one small array
+# expression.
+class DiscreteDMP(object):
+
+    def __init__(self, k_gains, d_gains, weights):
+        self.k_gains = np.asarray(k_gains, dtype=float)
+        self.d_gains = np.asarray(d_gains, dtype=float)
+        self.weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        self.dims = len(self.k_gains)
+        self._response_key = None
+        self._response = None
+
+    @classmethod
+    def learn(cls, times, positions, k_gains, d_gains, num_bases):
+        '''
+        Fit a DMP to a demonstration: times (N,) and positions (N, dims).
+        Returns the DMP, its tau (the length of the demonstration), and the
+        function approximation domain and targets (N, dims) of the fit.
+        '''
+        times = np.asarray(times, dtype=float)
+        x = np.asarray(positions, dtype=float)
+        k_gains = np.asarray(k_gains, dtype=float)
+        d_gains = np.asarray(d_gains, dtype=float)
+        tau = times[-1]
+
+        # finite difference velocities and accelerations, zero at the start
+        dt = np.diff(times)[:,np.newaxis]
+        v = np.zeros(x.shape)
+        a = np.zeros(x.shape)
+        v[1:] = np.diff(x, axis=0) / dt
+        a[1:] = np.diff(v, axis=0) / dt
+
+        x0 = x[0]
+        goal = x[-1]
+        s = phase(times, tau)[:,np.newaxis]
+        f_domain = times / tau
+        f_targets = (tau**2 * a + d_gains * tau * v) / k_gains - (goal - x) + (goal - x0) * s
+        # fit f instead of f * s: no need to scale the basis by the phase
+        f_targets /= s
+
+        features = fourier_features(f_domain, num_bases)
+        weights = np.linalg.lstsq(features, f_targets, rcond=None)[0].T
+        return cls(k_gains, d_gains, weights), tau, f_domain, f_targets
+
+    def forcing(self, t, tau):
+        '''
+        Forcing term f(t / tau) s for times t, (len(t), dims).
+        '''
+        scaled = np.asarray(t, dtype=float) / tau
+        f = fourier_features(scaled, self.weights.shape[1]).dot(self.weights.T)
+        f *= phase(t, tau)[:,np.newaxis]
+        f[scaled >= 1.] = 0.
+        return f
+
+    def response(self, t_0, tau, dt, integrate_iter, num_steps):
+        '''
+        Responses of the plan points (the start at t_0 and num_steps more,
+        dt apart) to the start state, goal, start position and forcing term.
+        Cached for the last set of arguments.
+        '''
+        key = (t_0, tau, dt, integrate_iter, num_steps)
+        if key == self._response_key:
+            return self._response
+
+        h = dt / float(integrate_iter)
+        c = h / tau
+        n = num_steps * integrate_iter
+        # one Euler step: z' = A z + B u, z = (x, v)
+        A = np.zeros((self.dims, 2, 2))
+        A[:,0,0] = 1.
+        A[:,0,1] = c
+        A[:,1,0] = -c * self.k_gains
+        A[:,1,1] = 1. - c * self.d_gains
+        B = np.zeros((self.dims, 2))
+        B[:,1] = c * self.k_gains
+
+        P = matrix_powers(A, n + 1)
+        # z[k] = A^k z0 + sum_{j<k} A^(k-1-j) B u[j]
+        impulse = np.matmul(P[:n], B[:,:,np.newaxis])[...,0]
+
+        # times at the start of every step, added up one step at a time like
+        # the service does, so plans end on the same step; the phase is
+        # taken at the start of the step and is zero from t = tau on
+        t = np.add.accumulate(np.concatenate(([float(t_0)], np.repeat(h, n))))
+        s = phase(t[:n], tau)
+        s[t[:n] / tau >= 1.] = 0.
+        inputs = np.stack((np.broadcast_to((1. - s)[:,np.newaxis], (n, self.dims)),
+            np.broadcast_to(s[:,np.newaxis], (n, self.dims)),
+            self.forcing(t[:n], tau)), axis=-1)
+        # convolve the impulse response with each input, (n, dims, 2, 3)
+        forced = causal_convolve(impulse[:,:,:,np.newaxis], inputs[:,:,np.newaxis,:])
+
+        points = integrate_iter * np.arange(num_steps + 1)
+        forced = np.concatenate((np.zeros((1,) + forced.shape[1:]), forced[points[1:] - 1]))
+        self._response = (t[points], P[points], forced)
+        self._response_key = key
+        return self._response
+
+    def rollout(self, x, v, x_0, goal, t_0, tau, dt, integrate_iter, num_steps):
+        '''
+        The start and num_steps plan points from position x and velocity v
+        (= tau x') at time t_0. goal (and x_0, the start of the motion the
+        phase refers to) may have a leading batch axis to plan for many goals
+        at once. Returns times (num_steps + 1,), positions and velocities
+        (x'), both (..., num_steps + 1, dims).
+        '''
+        times, P, forced = self.response(t_0, tau, dt, integrate_iter, num_steps)
+        z0 = np.stack(np.broadcast_arrays(x, v), axis=-1)
+        goal = np.asarray(goal, dtype=float)[...,np.newaxis,:,np.newaxis]
+        x_0 = np.asarray(x_0, dtype=float)[...,np.newaxis,:,np.newaxis]
+        z = np.matmul(P, z0[...,np.newaxis,:,:,np.newaxis])[...,0] \
+            + forced[...,0] * goal + forced[...,1] * x_0 + forced[...,2]
+        return times, z[...,0], z[...,1] / tau
+
+    def plan(self, x_0, x_dot_0, t_0, goal, goal_thresh, seg_length, tau, dt, integrate_iter):
+        '''
+        Same arguments, points and behavior as the get_dmp_plan service: the
+        plan starts with x_0 at t_0 and adds points dt apart for at least tau,
+        then until every position with a positive goal_thresh is that close
+        to the goal (for at most MAX_PLAN_LENGTH), but not past seg_length if
+        it is positive. Like the service, the goal is checked before each
+        point is added. Returns times, positions, velocities and whether the
+        goal was reached.
+        '''
+        x_0 = np.asarray(x_0, dtype=float)
+        goal = np.asarray(goal, dtype=float)
+        goal_thresh = np.asarray(goal_thresh, dtype=float)
+        v_0 = np.asarray(x_dot_0, dtype=float) * tau
+        checked = goal_thresh > 0
+
+        if seg_length > 0:
+            num_steps = int(np.floor(min(seg_length, tau) / dt)) + 2
+        else:
+            num_steps = int(np.ceil(tau / dt)) + 1
+        max_steps = int(np.ceil(max(tau, MAX_PLAN_LENGTH) / dt)) + 2
+        num_steps = min(num_steps, max_steps)
+
+        while True:
+            times, x, v = self.rollout(x_0, v_0, x_0, goal, t_0, tau, dt, integrate_iter, num_steps)
+            elapsed = times - t_0
+            close = np.all(np.absolute(x[:,checked] - goal[checked]) <= goal_thresh[checked], axis=1)
+            # point k + 1 is the last one if the loop of the service stops
+            # after adding it: close[k] is the goal check made before that
+            done = (elapsed[1:] >= tau) & (close[:-1] | (elapsed[1:] >= MAX_PLAN_LENGTH))
+            if seg_length > 0:
+                done |= elapsed[1:] > seg_length
+            if np.any(done):
+                end = int(np.argmax(done)) + 2
+                return times[:end], x[:end], v[:end], bool(close[end - 2])
+            if num_steps >= max_steps:
+                return times, x, v, bool(close[-2])
+            num_steps = min(2 * num_steps, max_steps)
@@ -12,7 +12,12 @@ from dmp.msg import *
 import numpy as np
 from costar_dmp.srv import *
 from geometry_msgs.msg import *
-from costar_robot_msgs.srv import ServoToPose
+from costar_robot_msgs.srv import ExecuteCartesianPath
+from sensor_msgs.msg import JointState
+from urdf_parser_py.urdf import URDF
+from costar_robot.chain_kinematics import ChainKinematics
+from demo_recorder import DemoRecorder, dump_demo
+from dmp_learning import DiscreteDMP
 
 class CostarDMP(CostarComponent):
 
@@ -22,6 +27,18 @@ class CostarDMP(CostarComponent):
         self.collecting = False
         self.dmp_computed = False
         self.tau = 0 # A time constant (in seconds) that will cause the DMPs to replay at the same speed they were demonstrated.
+        self.sample_rate = 100. # Hz; demonstrations are resampled to this rate
+        self.demo_dt = 1 # DMP time units between two resampled samples: 100 per second, as for the stored DMPs
+        self.bases_per_second = 10 # DMP basis functions per second of demonstration
+
+        # demonstrations are recorded from the joint states of the arm; end
+        # effector poses (base_link to end_link) are computed when recording stops
+        robot = URDF.from_parameter_server()
+        base_link = rospy.get_param('/costar/robot/base_link')
+        end_link = rospy.get_param('/costar/robot/end_link')
+        self.kinematics = ChainKinematics(robot, base_link, end_link)
+        self.recorder = DemoRecorder(self.kinematics.joint_names, self.kinematics.forward_batch)
+        self.js_subscriber = None
 
         self.start_rec_srv = self.make_service('start_rec',DmpTeach, self.start_rec_cb)
         self.stop_rec_srv = self.make_service('stop_rec', EmptyService, self.stop_rec_cb)
@@ -35,80 +52,113 @@ class CostarDMP(CostarComponent):
         self.save_service = rospy.ServiceProxy('/librarian/save', librarian_msgs.srv.Save)
         self.load_service = rospy.ServiceProxy('/librarian/load', librarian_msgs.srv.Load)
 
-        rospy.wait_for_service('learn_dmp_from_demo')
-        self.lfd = rospy.ServiceProxy('learn_dmp_from_demo', LearnDMPFromDemo)
-        rospy.wait_for_service('set_active_dmp')
-        self.sad = rospy.ServiceProxy('set_active_dmp',SetActiveDMP)
-        rospy.wait_for_service('get_dmp_plan')
-        self.gdp = rospy.ServiceProxy('get_dmp_plan', GetDMPPlan)
+        # DMPs are learned and planned either in this node (DiscreteDMP) or
+        # by the dmp package services
+        self.use_local_dmp = rospy.get_param(self.namespace + '/use_local_dmp', False)
+        self.active_dmp = None
+        if self.use_local_dmp:
+            self.lfd = self.local_lfd
+            self.sad = self.local_sad
+            self.gdp = self.local_gdp
+        else:
+            rospy.wait_for_service('learn_dmp_from_demo')
+            self.lfd = rospy.ServiceProxy('learn_dmp_from_demo', LearnDMPFromDemo)
+            rospy.wait_for_service('set_active_dmp')
+            self.sad = rospy.ServiceProxy('set_active_dmp',SetActiveDMP)
+            rospy.wait_for_service('get_dmp_plan')
+            self.gdp = rospy.ServiceProxy('get_dmp_plan', GetDMPPlan)
 
-        rospy.wait_for_service('/costar/ServoToPose')
-        self.servo_to_pose_service = rospy.ServiceProxy('/costar/ServoToPose', ServoToPose)
+        rospy.wait_for_service('/costar/ExecuteCartesianPath')
+        self.cartesian_path_service = rospy.ServiceProxy('/costar/ExecuteCartesianPath', ExecuteCartesianPath)
 
         self.folder = 'dmp'
         self.add_type_service(self.folder)
         self.current_dmp_name = 'dmp_default'
 
-        self.old_trans = [0.0,0.0,0.0]
-        self.old_rot = [0.0,0.0,0.0,0.0]
-
         super(CostarDMP, self).__init__(self.name, self.namespace)
 
 
+    '''
+    In-process replacements for the learn_dmp_from_demo, set_active_dmp and
+    get_dmp_plan services, with the same arguments and responses.
+    '''
+    def local_lfd(self, demo, k_gains, d_gains, num_bases):
+        dmp, tau, f_domain, f_targets = DiscreteDMP.learn(demo.times,
+            [pt.positions for pt in demo.points],
+            k_gains, d_gains, num_bases)
+        dmp_list = [DMPData(k_gain=k_gains[i], d_gain=d_gains[i],
+            weights=dmp.weights[i].tolist(),
+            f_domain=f_domain.tolist(),
+            f_targets=f_targets[:,i].tolist()) for i in range(dmp.dims)]
+        return LearnDMPFromDemoResponse(dmp_list=dmp_list, tau=tau)
+
+    def local_sad(self, dmp_list):
+        self.active_dmp = DiscreteDMP([d.k_gain for d in dmp_list],
+            [d.d_gain for d in dmp_list],
+            [d.weights for d in dmp_list])
+        return SetActiveDMPResponse(success=True)
+
+    def local_gdp(self, x_0, x_dot_0, t_0, goal, goal_thresh, seg_length, tau, dt, integrate_iter):
+        times, positions, velocities, at_goal = self.active_dmp.plan(x_0, x_dot_0, t_0,
+            goal, goal_thresh, seg_length, tau, dt, integrate_iter)
+        plan = DMPTraj(times=times.tolist())
+        for x, v in zip(positions.tolist(), velocities.tolist()):
+            plan.points.append(DMPPoint(positions=x, velocities=v))
+        return GetDMPPlanResponse(plan=plan, at_goal=at_goal)
+
     def tick(self):
         if self.collecting == True:
-            try:
-                (new_trans,new_rot) = self.listener.lookupTransform('/base_link','/endpoint',rospy.Time(0))
-                if self.old_trans != new_trans and self.old_rot != new_rot:
-	                new_rot_euler = tf.transformations.euler_from_quaternion(new_rot);
-	                self.traj['trans'].append(new_trans);
-	                self.traj['rot'].append(new_rot_euler);
-	                self.old_trans = new_trans
-	                self.old_ros = new_rot 
-	                print new_trans, new_rot,
-
-            except Exception, e:
-                pass
-
-            print "DMP tick() method called with recording."
+            print "DMP tick() method called with recording, %d samples."%self.recorder.count
         else:
             print "DMP tick() method called without recording. "
 
     def start_rec_cb(self,req):
-        self.traj = {'trans':[], 'rot':[], 'traj_name':[], 'reference_frame':[]}
-        self.collecting = True
-        self.traj['traj_name']= req.dmp_name
-        self.traj['reference_frame'] = req.reference_frame
+        self.traj = {'traj_name':req.dmp_name, 'reference_frame':req.reference_frame}
         self.current_dmp_name = req.dmp_name
+        self.recorder.clear()
+        self.collecting = True
+        self.js_subscriber = rospy.Subscriber('joint_states', JointState, self.recorder.add_joint_state)
         return []
 
     def stop_rec_cb(self,req):
         self.collecting = False
+        if self.js_subscriber is not None:
+            self.js_subscriber.unregister()
+            self.js_subscriber = None
+        if self.recorder.count < 2:
+            rospy.logwarn("No demonstration was recorded")
+            return []
+        if self.recorder.wrapped():
+            rospy.logwarn("Demonstration longer than the recorder buffer, the start was dropped")
+
+        # resample to a fixed rate and compute all end effector poses at once
+        times, positions = self.recorder.resample(self.sample_rate)
+        poses = self.recorder.poses(positions)
 
         # call dmp service to compute/fit DMP from traj
         demotraj = DMPTraj()
-        dims = 7		      # 3 for position and 4 for quaternion                
-    	dt = 10               # here we use the same time interval as tick(), which is 10ms
-    	K = 100               # K_gain value
-    	D = 2.0 * np.sqrt(K)  # D_gain value
-    	k_gains = [K]*dims
-    	d_gains = [D]*dims
-    	num_bases = len(self.traj['trans'])       
-
-        for i in range(len(self.traj['trans'])):
-        	pt = DMPPoint();
-        	lfd_traj = [self.traj['trans'][i][0],self.traj['trans'][i][1], self.traj['trans'][i][2],
-        			self.traj['rot'][i][0], self.traj['rot'][i][1], self.traj['rot'][i][2]]
-        	pt.positions = lfd_traj
-        	demotraj.points.append(pt)
-        	demotraj.times.append(10*i) 
+        dims = 6              # 3 for position and 3 for roll, pitch, yaw
+        K = 100               # K_gain value
+        D = 2.0 * np.sqrt(K)  # D_gain value
+        k_gains = [K]*dims
+        d_gains = [D]*dims
+        num_bases = max(1, int(round(times[-1] * self.bases_per_second)))
+
+        for i in range(len(poses)):
+            demotraj.points.append(DMPPoint(positions=poses[i].tolist()))
+            demotraj.times.append(self.demo_dt*i)
 
         resp = self.lfd(demotraj, k_gains, d_gains, num_bases) # use service call to compute dmp
         self.tau = resp.tau
         self.sad(resp.dmp_list) # set the latest recorded dmp traj as active dmp
 
-        # save to yaml with:
-        self.save_service(id=self.name.strip('/'),type=self.folder,text=yaml.dump(self.traj)) # original teach_traj
+        # original teach_traj as a compressed binary recording, the dmp as yaml
+        self.save_service(id=self.name.strip('/'),type=self.folder,text=dump_demo(times=times,
+            positions=positions,
+            poses=poses,
+            joint_names=self.recorder.joint_names,
+            traj_name=self.traj['traj_name'],
+            reference_frame=self.traj['reference_frame']))
         self.save_service(id=self.traj['traj_name'],type=self.folder,text=yaml.dump(resp))
         self.dmp_computed = True
 
@@ -145,18 +195,18 @@ class CostarDMP(CostarComponent):
     	integrate_iter = req.integrate_iter       #dt is rather large, so this is > 1  
     	plan = self.gdp(start_pose, start_velocity, t_0, end_pose, end_thresh, 
                            	   seg_length, tau, dt, integrate_iter)
-    	plan_traj_points = plan.plan.points
-    	print(type(plan_traj_points),len(plan_traj_points))
-    	for i in range(len(plan_traj_points)):
-    		traj_point = plan_traj_points[i]
+    	# send the whole plan to the arm as one trajectory
+    	poses = []
+    	for traj_point in plan.plan.points:
     		traj_point_position = traj_point.positions
-
     		pose_msg = Pose()
     		pose_msg.position = Point(*traj_point_position[0:3])
     		pose_msg.orientation = Quaternion(*tf.transformations.quaternion_from_euler(traj_point_position[3],
     								traj_point_position[4],traj_point_position[5]))
-    		print(pose_msg)
-    		self.servo_to_pose_service(target=pose_msg,accel=1,vel=1) # set 1
+    		poses.append(pose_msg)
+    	times = [t / (self.demo_dt * self.sample_rate) for t in plan.plan.times]
+    	res = self.cartesian_path_service(poses=poses,times=times,accel=1,vel=1)
+    	rospy.loginfo("DMP plan with %d points: %s"%(len(poses),res.ack))
 
 
     	self.save_service(id="dmp_plan",type=self.folder,text=yaml.dump(plan))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Build a reachability map for CostarArm.query() and predicator_reachable by
+# sampling joint space with forward kinematics. Without --urdf the UR5 closed
+# form kinematics are used (joint limits -pi..pi, like CostarUR5Driver);
+# with --urdf the chain from --base-link to --end-link (ChainKinematics) and
+# the joint limits from the URDF.
+#
+# usage: rosrun costar_robot_manager build_reachability_map.py ur5_map.npy
+#        rosrun costar_robot_manager build_reachability_map.py iiwa_map.npy \
+#            --urdf iiwa14.urdf --base-link iiwa_link_0 --end-link iiwa_link_ee \
+#            --approach-axis 2
+#
+# Set the robot/reachability_map parameter of the arm to the output file.
+
+import argparse
+import time
+import numpy as np
+
+from costar_robot.reachability_map import build_reachability_map
+from costar_robot.chain_kinematics import ChainKinematics
+from costar_robot.inverseKinematicsUR5 import InverseKinematicsUR5
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Build a reachability map.')
+  parser.add_argument('output', help='map file (.npy); parameters go to <output>.yaml')
+  parser.add_argument('--urdf', help='URDF file; default: UR5 closed form kinematics')
+  parser.add_argument('--base-link', default='base_link')
+  parser.add_argument('--end-link', default='ee_link')
+  parser.add_argument('--samples', type=int, default=10000000)
+  parser.add_argument('--voxel-size', type=float, default=0.05)
+  parser.add_argument('--directions-per-face', type=int, default=2)
+  parser.add_argument('--roll-bins', type=int, default=4)
+  parser.add_argument('--approach-axis', type=int, default=0,
+      help='tool axis (0=x, 1=y, 2=z) binned as the approach direction')
+  parser.add_argument('--dilate', type=int, default=1)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  if args.urdf is None:
+    ik = InverseKinematicsUR5()
+    ik.setEERotationOffsetROS()
+    forward_batch = ik.solveFKBatch
+    limits_lower = [-np.pi] * 6
+    limits_upper = [np.pi] * 6
+  else:
+    from urdf_parser_py.urdf import URDF
+    robot = URDF.from_xml_string(open(args.urdf).read())
+    chain = ChainKinematics(robot, args.base_link, args.end_link)
+    forward_batch = chain.forward_batch
+    # continuous joints have no limits
+    limits_lower = np.maximum(chain.limits_lower, -np.pi)
+    limits_upper = np.minimum(chain.limits_upper, np.pi)
+
+  start = time.time()
+  reachability_map = build_reachability_map(forward_batch, limits_lower, limits_upper,
+      num_samples=args.samples,
+      dilate=args.dilate,
+      seed=args.seed,
+      voxel_size=args.voxel_size,
+      directions_per_face=args.directions_per_face,
+      roll_bins=args.roll_bins,
+      approach_axis=args.approach_axis,
+      base_link=args.base_link,
+      end_link=args.end_link)
+  reachability_map.save(args.output)
+
+  print "Built a %s map with %d orientation bins in %.1f s"%(
+      'x'.join(str(n) for n in reachability_map.shape),
+      reachability_map.num_orientations,
+      time.time() - start)
+  print "Reachable: %.1f%% of all cells, %d kB"%(
+      100 * reachability_map.fraction_reachable(),
+      reachability_map.data.nbytes / 1024)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Check the NumPy chain kinematics against KDL: forward kinematics and
+# Jacobians for random joint positions within the limits must agree to
+# 1e-9. Also prints how long both take per configuration.
+#
+# usage: rosrun costar_robot_manager chain_kinematics_test.py robot.urdf base_link end_link [num_samples]
+#        (without a URDF file the robot_description parameter is used)
+
+import sys
+import timeit
+import numpy as np
+
+from urdf_parser_py.urdf import URDF
+from pykdl_utils.kdl_kinematics import KDLKinematics
+
+from costar_robot.chain_kinematics import ChainKinematics
+
+TOLERANCE = 1e-9
+
+if __name__ == '__main__':
+  if len(sys.argv) < 3:
+    print "usage: chain_kinematics_test.py [URDF] BASE_LINK END_LINK [num_samples]"
+    sys.exit(2)
+  args = sys.argv[1:]
+  if args[0].endswith('.urdf'):
+    robot = URDF.from_xml_string(open(args.pop(0)).read())
+  else:
+    robot = URDF.from_parameter_server()
+  base_link, end_link = args[0], args[1]
+  num_samples = int(args[2]) if len(args) > 2 else 1000
+
+  kdl_kin = KDLKinematics(robot, base_link, end_link)
+  chain = ChainKinematics(robot, base_link, end_link)
+  np.random.seed(0)
+  Q = np.random.uniform(np.maximum(chain.limits_lower, -np.pi),
+      np.minimum(chain.limits_upper, np.pi), (num_samples, chain.dof))
+
+  T_kdl = np.array([kdl_kin.forward(q) for q in Q])
+  J_kdl = np.array([kdl_kin.jacobian(q) for q in Q])
+  fk_error = np.abs(chain.forward_batch(Q) - T_kdl).max()
+  jacobian_error = np.abs(chain.jacobian_batch(Q) - J_kdl).max()
+  single_error = max(np.abs(chain.forward(Q[0]) - T_kdl[0]).max(),
+      np.abs(chain.jacobian(Q[0]) - J_kdl[0]).max())
+
+  t_kdl_fk = timeit.timeit(lambda: [kdl_kin.forward(q) for q in Q], number=3) / 3
+  t_kdl_jac = timeit.timeit(lambda: [kdl_kin.jacobian(q) for q in Q], number=3) / 3
+  t_fk = timeit.timeit(lambda: chain.forward_batch(Q), number=3) / 3
+  t_jac = timeit.timeit(lambda: chain.jacobian_batch(Q), number=3) / 3
+  t_fk_single = timeit.timeit(lambda: chain.forward(Q[0]), number=1000) / 1000
+
+  print "Chain %s -> %s, %d joints"%(base_link, end_link, chain.dof)
+  print "Max FK error:       %g"%fk_error
+  print "Max Jacobian error: %g"%jacobian_error
+  print "FK:       KDL %.2f us, batch %.2f us, single %.2f us per configuration"%(
+      1e6 * t_kdl_fk / num_samples, 1e6 * t_fk / num_samples, 1e6 * t_fk_single)
+  print "Jacobian: KDL %.2f us, batch %.2f us per configuration"%(
+      1e6 * t_kdl_jac / num_samples, 1e6 * t_jac / num_samples)
+
+  ok = max(fk_error, jacobian_error, single_error) <= TOLERANCE
+  print "PASSED" if ok else "FAILED"
+  sys.exit(0 if ok else 1)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+# Compare the scalar UR5 closed form IK (solveIK) with the batched solver
+# (solveIKBatch) on random reachable poses.
+#
+# usage: rosrun costar_robot_manager ik_benchmark.py [num_poses ...]
+
+import sys
+import timeit
+import numpy as np
+
+from costar_robot.inverseKinematicsUR5 import InverseKinematicsUR5
+from costar_robot.inverseKinematicsUR5 import transformRobotParameter
+
+def make_poses(ik, n):
+  q = np.random.uniform(-np.pi, np.pi, (n, 6))
+  ee_offset_inv = np.linalg.inv(ik.ee_offset)
+  return np.array([transformRobotParameter(qi).dot(ee_offset_inv) for qi in q])
+
+def check_agreement(ik, poses):
+  Q, valid = ik.solveIKBatch(poses)
+  for i, T in enumerate(poses):
+    q = ik.solveIK(T)
+    q_batch = Q[i][valid[i]]
+    if q is None:
+      if len(q_batch) > 0:
+        return False
+    elif q.shape != q_batch.shape or not np.allclose(q, q_batch, atol=1e-9):
+      return False
+  return True
+
+if __name__ == '__main__':
+  sizes = [int(n) for n in sys.argv[1:]] or [1, 100, 10000]
+
+  ik = InverseKinematicsUR5()
+  ik.setEERotationOffsetROS()
+  ik.setJointLimits(-np.pi, np.pi)
+  np.random.seed(0)
+
+  print "Solutions agree: %s"%str(check_agreement(ik, make_poses(ik, 100)))
+  print "%8s %14s %14s %10s"%("poses", "scalar [ms]", "batch [ms]", "speedup")
+  for n in sizes:
+    poses = make_poses(ik, n)
+    repeat = max(1, 1000 / n)
+    t_scalar = timeit.timeit(lambda: [ik.solveIK(T) for T in poses], number=repeat) / repeat
+    t_batch = timeit.timeit(lambda: ik.solveIKBatch(poses), number=repeat) / repeat
+    print "%8d %14.3f %14.3f %9.1fx"%(n, 1000 * t_scalar, 1000 * t_batch, t_scalar / t_batch)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Check how the plan cache hands out plans that were made ahead of time:
+# a plan is used for about the same goal from about the predicted start
+# (hit), not from anywhere else (miss), a request waits for a plan that is
+# still being made, and a plan that collides in the current scene is
+# rejected by the revalidation.
+#
+# usage: rosrun costar_robot_manager plan_cache_test.py
+
+import sys
+import time
+import numpy as np
+
+from threading import Thread
+
+from costar_robot.plan_cache import PlanCache
+from costar_robot.trajectory import TrajectoryArrays
+
+DOF = 6
+JOINT_NAMES = ['joint%d'%i for i in xrange(DOF)]
+
+def make_plan(q_start, q_goal):
+  positions = np.linspace(q_start, q_goal, 20)
+  return TrajectoryArrays(positions, np.linspace(0., 2., 20), joint_names=JOINT_NAMES)
+
+def prefetch(cache, goal, q_start, q_goal, delay=None):
+  entry = cache.begin_prefetch(goal, q_start)
+  if delay is None:
+    cache.end_prefetch(entry, make_plan(q_start, q_goal))
+  else:
+    def plan():
+      time.sleep(delay)
+      cache.end_prefetch(entry, make_plan(q_start, q_goal))
+    thread = Thread(target=plan)
+    thread.daemon = True
+    thread.start()
+  return entry
+
+def check(name, ok):
+  print "%s %s"%("ok  " if ok else "FAIL", name)
+  return ok
+
+if __name__ == '__main__':
+  q_start = np.zeros(DOF)
+  q_goal = np.ones(DOF)
+  # the robot stops a little away from where it was predicted to
+  q = q_start + 0.002
+  results = []
+
+  cache = PlanCache()
+  goal = cache.goal(q_goal=q_goal, obj='block')
+  prefetch(cache, goal, q_start, q_goal)
+  # a goal found again from the live position is only about the same
+  traj = cache.take_prefetched(cache.goal(q_goal=q_goal + 1e-4, obj='block'), q)
+  results.append(check("hit", traj is not None and np.allclose(traj.positions[0], q)
+    and np.allclose(traj.positions[-1], q_goal) and cache.prefetch_hits == 1))
+  results.append(check("used only once", cache.take_prefetched(goal, q) is None))
+
+  prefetch(cache, goal, q_start, q_goal)
+  results.append(check("miss for another goal",
+    cache.take_prefetched(cache.goal(q_goal=q_goal + 0.1, obj='block'), q) is None))
+  results.append(check("miss for another object",
+    cache.take_prefetched(cache.goal(q_goal=q_goal, obj='cup'), q) is None))
+  results.append(check("miss for another start",
+    cache.take_prefetched(goal, q_start + 0.1) is None and cache.prefetch_misses == 1))
+
+  other_goal = cache.goal(q_goal=-q_goal, obj='block')
+  prefetch(cache, other_goal, q_start, -q_goal, delay=0.5)
+  prefetch(cache, goal, q_start, q_goal, delay=0.3)
+  results.append(check("no second prefetch to the same goal",
+    cache.begin_prefetch(goal, q_start) is None))
+  t = time.time()
+  traj = cache.take_prefetched(goal, q, timeout=5.)
+  elapsed = time.time() - t
+  results.append(check("wait for a running prefetch (%.2fs)"%elapsed,
+    traj is not None and 0.2 < elapsed < 5.))
+  traj = cache.take_prefetched(other_goal, q, timeout=5.)
+  results.append(check("wait for another running prefetch",
+    traj is not None and np.allclose(traj.positions[-1], -q_goal)))
+
+  entry = cache.begin_prefetch(goal, q_start)
+  t = time.time()
+  traj = cache.take_prefetched(goal, q, timeout=0.2)
+  elapsed = time.time() - t
+  cache.end_prefetch(entry, None)
+  results.append(check("give up waiting (%.2fs)"%elapsed, traj is None and elapsed < 1.))
+  results.append(check("failed prefetch leaves no plan", cache.take_prefetched(goal, q) is None))
+
+  prefetch(cache, goal, q_start, q_goal)
+  traj = cache.take_prefetched(goal, q)
+  results.append(check("revalidate in an unchanged scene",
+    cache.revalidate(traj, q, q_goal=q_goal, validity_checker=lambda Q: [True] * len(Q))))
+  results.append(check("reject after the scene changed",
+    not cache.revalidate(traj, q, q_goal=q_goal, validity_checker=lambda Q: [False] * len(Q))))
+
+  failures = len(results) - sum(results)
+  if failures > 0:
+    print "FAILURE -- %d of %d plan cache checks failed"%(failures, len(results))
+    sys.exit(1)
+  print "SUCCESS -- plans made ahead of time are handed out correctly"
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Check a UR5 reachability map against the closed form IK: random poses in
+# the bounds of the map are solved directly and looked up in the map. The map
+# must not reject more than a small fraction of the poses IK can reach; how
+# many unreachable poses it rejects shows how useful it is as a filter.
+#
+# usage: rosrun costar_robot_manager reachability_map_test.py ur5_map.npy [num_poses]
+
+import sys
+import timeit
+import numpy as np
+
+from costar_robot.reachability_map import ReachabilityMap
+from costar_robot.cartesian_path import matrices_from_quaternions
+from costar_robot.inverseKinematicsUR5 import InverseKinematicsUR5
+
+MAX_FALSE_NEGATIVES = 0.005
+
+def random_poses(bounds, n):
+  quaternions = np.random.randn(n, 4)
+  quaternions /= np.linalg.norm(quaternions, axis=1)[:,np.newaxis]
+  positions = np.random.uniform(bounds[:,0], bounds[:,1], (n, 3))
+  return matrices_from_quaternions(quaternions, positions)
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print "usage: reachability_map_test.py MAP [num_poses]"
+    sys.exit(2)
+  num_poses = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+  reachability_map = ReachabilityMap.load(sys.argv[1])
+  ik = InverseKinematicsUR5()
+  ik.setEERotationOffsetROS()
+  ik.setJointLimits(-np.pi, np.pi)
+  np.random.seed(0)
+
+  # poses from forward kinematics are reachable by construction
+  q = np.random.uniform(-np.pi, np.pi, (num_poses, 6))
+  fk_reachable = reachability_map.reachable(ik.solveFKBatch(q))
+
+  poses = random_poses(reachability_map.bounds, num_poses)
+  Q, valid = ik.solveIKBatch(poses)
+  ik_reachable = np.any(valid, axis=1)
+  map_reachable = reachability_map.reachable(poses)
+
+  false_negatives = np.sum(ik_reachable & ~map_reachable) / float(max(1, np.sum(ik_reachable)))
+  pruned = np.sum(~ik_reachable & ~map_reachable) / float(max(1, np.sum(~ik_reachable)))
+  t_map = timeit.timeit(lambda: reachability_map.reachable(poses), number=3) / 3
+  t_ik = timeit.timeit(lambda: ik.solveIKBatch(poses), number=3) / 3
+
+  print "FK poses rejected by the map:        %.3f%%"%(100 * (1 - fk_reachable.mean()))
+  print "IK reachable poses rejected:         %.3f%%"%(100 * false_negatives)
+  print "IK unreachable poses rejected:       %.1f%%"%(100 * pruned)
+  print "Lookup: %.3f us per pose, batch IK: %.3f us per pose"%(
+      1e6 * t_map / num_poses, 1e6 * t_ik / num_poses)
+
+  ok = false_negatives <= MAX_FALSE_NEGATIVES and 1 - fk_reachable.mean() <= MAX_FALSE_NEGATIVES
+  print "PASSED" if ok else "FAILED"
+  sys.exit(0 if ok else 1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Check the time optimal parameterization against the motion the robot
+# actually makes: the drivers and the StreamingExecutor follow cubic Hermite
+# segments between the trajectory points, so every retimed path is sampled
+# densely along those cubics and the joint velocities and accelerations of
+# the samples (by finite differences) are compared with the limits. A path
+# with a single noisy point should only be slowed down around that point,
+# and timed paths (like DMP plans) should keep their timing where it is
+# within the limits.
+#
+# usage: rosrun costar_robot_manager time_parameterization_test.py
+
+import sys
+import numpy as np
+
+from costar_robot.compression import hermite_positions
+from costar_robot.time_parameterization import time_optimal_parameterization
+
+# finite differences of the samples average the true derivatives, so they
+# never exceed the limits by more than rounding
+LIMIT_TOLERANCE = 1e-6
+SAMPLES_PER_SEGMENT = 50
+
+def sample_hermite(times, positions, velocities):
+  sample_times = []
+  samples = []
+  for k in xrange(len(times) - 1):
+    t = np.linspace(times[k], times[k+1], SAMPLES_PER_SEGMENT, endpoint=False)
+    sample_times.append(t)
+    samples.append(hermite_positions(times[k], positions[k], velocities[k],
+      times[k+1], positions[k+1], velocities[k+1], t))
+  sample_times.append(times[-1:])
+  samples.append(positions[-1:])
+  return np.concatenate(sample_times), np.concatenate(samples)
+
+def check(name, positions, max_velocities, max_accelerations, max_speeds=None):
+  positions = np.asarray(positions, dtype=float)
+  times, velocities = time_optimal_parameterization(positions,
+    max_velocities, max_accelerations, max_speeds=max_speeds)
+  t, q = sample_hermite(times, positions, velocities)
+  dt = np.diff(t)[:,np.newaxis]
+  v = np.diff(q, axis=0) / dt
+  a = np.diff(v, axis=0) / (0.5 * (dt[:-1] + dt[1:]))
+  v_ratio = np.max(np.absolute(v) / max_velocities)
+  a_ratio = np.max(np.absolute(a) / max_accelerations)
+  ok = v_ratio <= 1. + LIMIT_TOLERANCE and a_ratio <= 1. + LIMIT_TOLERANCE \
+    and np.all(np.diff(times) > 0) \
+    and np.allclose(velocities[0], 0) and np.allclose(velocities[-1], 0)
+  print "%s %s: %.3fs, peak velocity %.3f and acceleration %.3f of the limits"%(
+    "ok  " if ok else "FAIL", name, times[-1], v_ratio, a_ratio)
+  return ok
+
+if __name__ == '__main__':
+  np.random.seed(0)
+  dof = 6
+  max_velocities = np.array([2.0, 2.0, 3.0, 3.0, 3.0, 3.0])
+  max_accelerations = np.array([1.5, 1.5, 2.0, 3.0, 3.0, 3.0])
+  paths = []
+
+  paths.append(("straight line", np.linspace(np.zeros(dof), np.ones(dof), 30)))
+  paths.append(("long straight line", np.linspace(np.zeros(dof), 5 * np.ones(dof), 100)))
+  paths.append(("two points", [np.zeros(dof), np.ones(dof)]))
+  paths.append(("reversal", [np.zeros(dof), np.ones(dof), np.zeros(dof)]))
+  s = np.linspace(0, 1, 40)[:,np.newaxis]
+  paths.append(("smooth curve", np.hstack([np.sin(2 * np.pi * s + k) for k in xrange(dof)])))
+  for test in xrange(20):
+    paths.append(("random sparse %d"%test, np.cumsum(np.random.uniform(-0.5, 0.5, (20, dof)), axis=0)))
+  for test in xrange(5):
+    paths.append(("random dense %d"%test, np.cumsum(np.random.uniform(-0.01, 0.01, (300, dof)), axis=0)))
+  line = np.linspace(np.zeros(dof), np.ones(dof), 100)
+  for noise in [1e-4, 1e-3]:
+    paths.append(("straight line with %g rad of noise"%noise,
+      line + np.random.normal(0., noise, line.shape)))
+  bump = line.copy()
+  bump[50] += 1e-2
+  paths.append(("straight line with one noisy point", bump))
+
+  failures = 0
+  for name, positions in paths:
+    if not check(name, positions, max_velocities, max_accelerations):
+      failures += 1
+
+  # timed paths at 100 Hz: one that starts and stops at full speed, and a
+  # minimum jerk motion that is slow enough to be followed as it is
+  t = np.arange(100) * 0.01
+  s = np.arange(200) / 199.
+  timed_paths = [("timed path from rest at full speed", t, np.outer(1.9 * t, np.ones(dof))),
+    ("timed minimum jerk path", 2. * s, np.outer(0.5 * (10 * s**3 - 15 * s**4 + 6 * s**5), np.ones(dof)))]
+  for name, t, positions in timed_paths:
+    max_speeds = np.linalg.norm(np.diff(positions, axis=0), axis=1) / np.diff(t)
+    if not check(name, positions, max_velocities, max_accelerations, max_speeds):
+      failures += 1
+    paths.append((name, positions))
+  minimum_jerk_time = time_optimal_parameterization(positions,
+    max_velocities, max_accelerations, max_speeds=max_speeds)[0][-1]
+  kept = minimum_jerk_time < 1.05 * t[-1]
+  print "%s minimum jerk timing kept: %.3fs instead of %.3fs"%("ok  " if kept else "FAIL",
+    minimum_jerk_time, t[-1])
+
+  line_time = time_optimal_parameterization(line, max_velocities, max_accelerations)[0][-1]
+  bump_time = time_optimal_parameterization(bump, max_velocities, max_accelerations)[0][-1]
+  local = bump_time < 1.1 * line_time
+  print "%s one noisy point: %.3fs instead of %.3fs"%("ok  " if local else "FAIL",
+    bump_time, line_time)
+
+  if failures > 0:
+    print "FAILURE -- %d of %d retimed paths exceed the limits"%(failures, len(paths))
+    sys.exit(1)
+  if not local:
+    print "FAILURE -- one noisy point slows down the whole path"
+    sys.exit(1)
+  if not kept:
+    print "FAILURE -- a timed path within the limits is slowed down"
+    sys.exit(1)
+  print "SUCCESS -- all retimed paths stay within the joint limits"
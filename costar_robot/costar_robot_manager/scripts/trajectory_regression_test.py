@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Regression test for the array based trajectory generation: compares
+# interpolate_joint_move() with the original point-by-point implementation
+# of SimplePlanning.getJointMove for a set of random joint moves.
+#
+# usage: rosrun costar_robot_manager trajectory_regression_test.py
+
+import sys
+import numpy as np
+
+from costar_robot.trajectory import interpolate_joint_move
+from costar_robot.trajectory import trapezoidal_profile_parameters
+
+def legacy_step_time(step_index,
+  steps_to_max_speed,
+  const_velocity_max_step,
+  t_v_const_step,
+  t_to_reach_v_setting_max):
+  acceleration_step = np.min([step_index, steps_to_max_speed])
+  deceleration_step = np.min([np.max([step_index - const_velocity_max_step - steps_to_max_speed, 0]), steps_to_max_speed])
+  const_velocity_step = np.min([np.max([0, step_index - steps_to_max_speed]), const_velocity_max_step])
+  acceleration_time = 0
+  deceleration_time = 0
+  if steps_to_max_speed > 0.0001:
+    acceleration_time = np.sqrt(acceleration_step/steps_to_max_speed) * t_to_reach_v_setting_max
+    deceleration_time = t_to_reach_v_setting_max - np.sqrt((steps_to_max_speed-deceleration_step)/steps_to_max_speed) * t_to_reach_v_setting_max
+  const_vel_time = const_velocity_step * t_v_const_step
+
+  return acceleration_time + const_vel_time + deceleration_time
+
+def legacy_joint_move(q_goal, q0, steps, t_v_const_step, t_v_setting_max,
+    steps_to_max_speed, const_velocity_max_step):
+  delta_q = np.array(q_goal) - np.array(q0)
+  positions = [list(q0)]
+  velocities = [[0]*len(q0)]
+  times = [0.]
+  for i in range(1,steps + 1):
+    q = (np.array(q0) + (float(i)/steps) * delta_q).tolist()
+    dq_i = np.array(q) - np.array(positions[i-1])
+    total_time = legacy_step_time(i,
+      steps_to_max_speed,
+      const_velocity_max_step,
+      t_v_const_step,
+      t_v_setting_max)
+    velocities[i-1] = dq_i/(total_time - times[i-1])
+    positions.append(q)
+    velocities.append([0]*len(q))
+    times.append(total_time)
+  return np.array(positions), np.array(times), np.array(velocities)
+
+if __name__ == '__main__':
+  np.random.seed(0)
+  failures = 0
+  for test in xrange(100):
+    dof = np.random.choice([6, 7])
+    q0 = np.random.uniform(-np.pi, np.pi, dof)
+    q_goal = q0 + np.random.uniform(-1, 1, dof) * np.random.choice([0.01, 0.1, 1.])
+    base_steps = np.random.choice([5, 50, 1000])
+    time_multiplier = np.random.choice([1., 2., 10.])
+    percent_acc = np.random.choice([0.1, 0.5, 1.])
+
+    steps, ts, t_v_setting_max, steps_to_max_speed, const_velocity_max_step, _ = \
+        trapezoidal_profile_parameters(q_goal - q0, base_steps, 0, 2, 0,
+            time_multiplier, percent_acc)
+
+    positions, times, velocities = legacy_joint_move(q_goal, q0, steps, ts,
+        t_v_setting_max, steps_to_max_speed, const_velocity_max_step)
+    traj = interpolate_joint_move(q0, q_goal, steps, steps_to_max_speed,
+        const_velocity_max_step, ts, t_v_setting_max)
+
+    if not (np.allclose(traj.positions, positions, rtol=0, atol=1e-12)
+        and np.allclose(traj.times, times, rtol=0, atol=1e-12)
+        and np.allclose(traj.velocities, velocities, rtol=1e-9, atol=1e-12)):
+      failures += 1
+      print "Mismatch for move %d: q0=%s q_goal=%s steps=%d"%(test, str(q0), str(q_goal), steps)
+
+  if failures > 0:
+    print "FAILURE -- %d of 100 moves differ"%failures
+    sys.exit(1)
+  print "SUCCESS -- array trajectories match the point-by-point implementation"
@@ -12,7 +12,20 @@ def rospack_exists(module_name, module_exist_list, module_missing_list):
 installed_robot_driver = list()
 missing_robot_driver = list()
 
+from trajectory import TrajectoryArrays
+from time_parameterization import TimeParameterization
 from planning import SimplePlanning
+from chain_kinematics import ChainKinematics
+from kinematics_cache import KinematicsCache
+from collision_checker import CapsuleCollisionChecker
+from plan_cache import PlanCache
+from planning_scene_mirror import PlanningSceneMirror
+from path_smoothing import PathSmoother
+from execution import TrajectoryExecution
+from streaming import StreamingExecutor
+from compression import TrajectoryCompressor
+from cartesian_servo import CartesianServo
+from reachability_map import ReachabilityMap
 
 from costar_arm import CostarArm
 
@@ -39,4 +52,4 @@ else:
 # UR5
 from inverseKinematicsUR5 import InverseKinematicsUR5
 from ur_driver import CostarUR5Driver
-__all__ = ['CostarArm','SimplePlanning','InverseKinematicsUR5','CostarUR5Driver']
+__all__ = ['CostarArm','SimplePlanning','TrajectoryArrays','TimeParameterization','ChainKinematics','KinematicsCache','CapsuleCollisionChecker','PlanCache','PlanningSceneMirror','PathSmoother','TrajectoryExecution','StreamingExecutor','TrajectoryCompressor','CartesianServo','ReachabilityMap','InverseKinematicsUR5','CostarUR5Driver']
@@ -0,0 +1,163 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+from cartesian_path import quaternion_from_matrix
+from cartesian_path import quaternion_slerp
+from cartesian_path import matrices_from_quaternions
+from cartesian_path import rotation_angle
+
+# BLENDED PATHS
+# Paths through a list of waypoints that do not stop at every one of them:
+# the path follows the straight lines between the waypoints, but the corner
+# at an intermediate waypoint is rounded off with a quadratic Bezier curve
+# that leaves the line a blend distance before the waypoint and joins the
+# next line the same distance after it. The curve passes within half the
+# blend distance of the waypoint; a blend distance of zero keeps the sharp
+# corner, where the robot has to stop.
+#
+# The same code blends joint space paths and the translation of Cartesian
+# paths. Every sample of the path also gets a progress value (k + f is
+# fraction f of the way from waypoint k to waypoint k + 1), which is used to
+# interpolate the orientation of Cartesian paths.
+
+def blend_polyline(points, distances, segment_steps):
+    '''
+    Path through points (N x dim) with the corner at every intermediate
+    point k rounded off within distances[k]. Blends are limited to half of
+    each neighbouring segment; there is no blend next to a segment of
+    length zero. segment_steps[k] is the
+    number of samples for the whole segment from points[k] to points[k+1].
+    Returns the positions (M x dim) and the progress (M,) of the samples.
+    '''
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n < 2:
+        return points.copy(), np.zeros(n)
+    dq = np.diff(points, axis=0)
+    lengths = np.linalg.norm(dq, axis=1)
+
+    # fraction of the segment before and after each point used by its blend
+    before = np.zeros(n)
+    after = np.zeros(n)
+    if n > 2:
+        d = np.clip(np.asarray(distances, dtype=float)[1:-1], 0.,
+            0.5 * np.minimum(lengths[:-1], lengths[1:]))
+        blended = d > 0
+        before[1:-1][blended] = d[blended] / lengths[:-1][blended]
+        after[1:-1][blended] = d[blended] / lengths[1:][blended]
+
+    positions = []
+    progress = []
+    for k in xrange(n - 1):
+        # straight part of segment k, without its end point
+        start, end = after[k], 1. - before[k+1]
+        if end - start > 1e-12 or k == 0:
+            steps = max(1, int(np.ceil((end - start) * segment_steps[k])))
+            f = np.linspace(start, end, steps + 1)[:-1]
+            positions.append(points[k] + f[:,np.newaxis] * dq[k])
+            progress.append(k + f)
+
+        # blend around point k + 1, without its end point
+        c = k + 1
+        if c < n - 1 and before[c] > 0:
+            A = points[c] - before[c] * dq[c-1]
+            B = points[c] + after[c] * dq[c]
+            steps = max(1, int(np.ceil(before[c] * segment_steps[c-1] + after[c] * segment_steps[c])))
+            s = np.linspace(0., 1., steps + 1)[:-1, np.newaxis]
+            positions.append((1 - s)**2 * A + 2 * s * (1 - s) * points[c] + s**2 * B)
+            progress.append(c - before[c] + s[:,0] * (before[c] + after[c]))
+
+    positions.append(points[-1:])
+    progress.append([n - 1.])
+    return np.concatenate(positions), np.concatenate(progress)
+
+def blend_joint_path(q_start, waypoints, radii, resolution):
+    '''
+    Blended joint space path q_start -> waypoints[0] -> ... with steps of
+    about resolution radians; the corner at waypoints[k] is rounded within
+    radii[k] radians. Waypoints that repeat the previous one are skipped.
+    Returns the positions (q_start included) and the progress of every
+    position, counted in waypoints (so waypoints[k] is at k + 1).
+    '''
+    points = np.vstack((np.asarray(q_start, dtype=float), np.asarray(waypoints, dtype=float)))
+    kept = [0]
+    for k in xrange(1, len(points)):
+        if np.linalg.norm(points[k] - points[kept[-1]]) > 1e-9:
+            kept.append(k)
+    points = points[kept]
+    distances = np.concatenate(([0.], radii))[kept]
+    steps = np.ceil(np.linalg.norm(np.diff(points, axis=0), axis=1) / resolution)
+    positions, progress = blend_polyline(points, distances, steps)
+    return positions, np.interp(progress, np.arange(len(kept)), kept)
+
+def blend_cartesian_path(T_start, waypoints, radii, max_translation_step, max_rotation_step):
+    '''
+    Blended Cartesian path T_start -> waypoints[0] -> ... through 4x4 poses,
+    sampled so that no step moves further than max_translation_step or
+    rotates more than max_rotation_step. Corners of the translation are
+    rounded within radii[k] meters of waypoints[k]; the orientation is
+    interpolated with slerp along the progress of the path, so it turns
+    through the blends with the translation. Returns the poses (T_start
+    excluded), their progress (like blend_joint_path) and the total
+    translation along the path.
+    '''
+    Ts = [np.asarray(T_start, dtype=float)] + [np.asarray(T, dtype=float) for T in waypoints]
+    kept = [0]
+    for k in xrange(1, len(Ts)):
+        T_prev = Ts[kept[-1]]
+        if np.linalg.norm(Ts[k][0:3,3] - T_prev[0:3,3]) > 1e-9 \
+                or rotation_angle(T_prev, Ts[k]) > 1e-9:
+            kept.append(k)
+    Ts = [Ts[k] for k in kept]
+    if len(Ts) < 2:
+        return np.zeros((0, 4, 4)), np.zeros(0), 0.
+
+    points = np.array([T[0:3,3] for T in Ts])
+    quaternions = [quaternion_from_matrix(T) for T in Ts]
+    distances = np.concatenate(([0.], radii))[kept]
+    steps = [max(1, np.ceil(max(np.linalg.norm(points[k+1] - points[k]) / max_translation_step,
+        rotation_angle(Ts[k], Ts[k+1]) / max_rotation_step)))
+        for k in xrange(len(Ts) - 1)]
+    positions, progress = blend_polyline(points, distances, steps)
+
+    # orientation: slerp within the segment each sample is on
+    segment = np.minimum(np.floor(progress).astype(int), len(Ts) - 2)
+    fractions = progress - segment
+    orientations = np.zeros((len(progress), 4))
+    for k in xrange(len(Ts) - 1):
+        on_segment = segment == k
+        if np.any(on_segment):
+            orientations[on_segment] = quaternion_slerp(quaternions[k],
+                quaternions[k+1], fractions[on_segment])
+
+    poses = matrices_from_quaternions(orientations, positions)[1:]
+    path_length = np.sum(np.linalg.norm(np.diff(positions, axis=0), axis=1))
+    return poses, np.interp(progress[1:], np.arange(len(kept)), kept), path_length
+
+def stop_indices(progress, radii):
+    '''
+    Indices of the samples (with the given progress) at the intermediate
+    waypoints whose radius is zero: the path has a corner there, and the
+    robot has to stop.
+    '''
+    radii = np.asarray(radii, dtype=float)
+    sharp = np.flatnonzero(radii[:-1] <= 0) + 1.
+    return np.flatnonzero(np.in1d(progress, sharp))
+
+def waypoint_distances(radii, num_waypoints):
+    '''
+    Blend radius for each of num_waypoints waypoints from a list with one
+    radius per waypoint, a single radius for all of them, or no radius at
+    all (no blending). Returns None if the list has any other length.
+    '''
+    radii = np.asarray(radii, dtype=float).ravel()
+    if len(radii) == 0:
+        return np.zeros(num_waypoints)
+    elif len(radii) == 1:
+        return np.repeat(radii, num_waypoints)
+    elif len(radii) == num_waypoints:
+        return radii
+    return None
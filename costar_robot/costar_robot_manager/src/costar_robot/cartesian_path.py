@@ -0,0 +1,156 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+# CARTESIAN PATHS
+# Helpers for straight line moves in Cartesian space: poses are interpolated
+# linearly in translation and with quaternion slerp in rotation, and the IK
+# solutions along the path are chosen so that every step stays close to the
+# previous one. Everything works on 4x4 homogeneous matrices.
+
+def quaternion_from_matrix(T):
+    '''
+    Unit quaternion (x, y, z, w) of the rotation part of a 4x4 matrix.
+    '''
+    R = np.asarray(T)[0:3,0:3]
+    trace = np.trace(R)
+    if trace > 0:
+        s = 0.5 / np.sqrt(trace + 1.0)
+        q = [(R[2,1] - R[1,2]) * s, (R[0,2] - R[2,0]) * s, (R[1,0] - R[0,1]) * s, 0.25 / s]
+    elif R[0,0] > R[1,1] and R[0,0] > R[2,2]:
+        s = 2.0 * np.sqrt(1.0 + R[0,0] - R[1,1] - R[2,2])
+        q = [0.25 * s, (R[0,1] + R[1,0]) / s, (R[0,2] + R[2,0]) / s, (R[2,1] - R[1,2]) / s]
+    elif R[1,1] > R[2,2]:
+        s = 2.0 * np.sqrt(1.0 + R[1,1] - R[0,0] - R[2,2])
+        q = [(R[0,1] + R[1,0]) / s, 0.25 * s, (R[1,2] + R[2,1]) / s, (R[0,2] - R[2,0]) / s]
+    else:
+        s = 2.0 * np.sqrt(1.0 + R[2,2] - R[0,0] - R[1,1])
+        q = [(R[0,2] + R[2,0]) / s, (R[1,2] + R[2,1]) / s, 0.25 * s, (R[1,0] - R[0,1]) / s]
+    q = np.array(q)
+    return q / np.linalg.norm(q)
+
+def quaternion_slerp(q_start, q_goal, fractions):
+    '''
+    Spherical linear interpolation between two unit quaternions for an array
+    of fractions in [0, 1]. Returns a (len(fractions), 4) array and always
+    takes the shorter way around.
+    '''
+    q_start = np.asarray(q_start, dtype=float)
+    q_goal = np.asarray(q_goal, dtype=float)
+    fractions = np.asarray(fractions, dtype=float)[:,np.newaxis]
+    cos_angle = np.dot(q_start, q_goal)
+    if cos_angle < 0:
+        q_goal = -q_goal
+        cos_angle = -cos_angle
+    if cos_angle > 0.9995:
+        # nearly identical: linear interpolation is accurate and stable
+        q = q_start + fractions * (q_goal - q_start)
+    else:
+        angle = np.arccos(cos_angle)
+        q = (np.sin((1 - fractions) * angle) * q_start + np.sin(fractions * angle) * q_goal) \
+                / np.sin(angle)
+    return q / np.linalg.norm(q, axis=1)[:,np.newaxis]
+
+def matrices_from_quaternions(quaternions, positions):
+    '''
+    (N, 4, 4) homogeneous matrices from (N, 4) quaternions (x, y, z, w) and
+    (N, 3) positions.
+    '''
+    x, y, z, w = np.asarray(quaternions).T
+    T = np.zeros((len(x), 4, 4))
+    T[:,0,0] = 1 - 2*(y*y + z*z)
+    T[:,0,1] = 2*(x*y - z*w)
+    T[:,0,2] = 2*(x*z + y*w)
+    T[:,1,0] = 2*(x*y + z*w)
+    T[:,1,1] = 1 - 2*(x*x + z*z)
+    T[:,1,2] = 2*(y*z - x*w)
+    T[:,2,0] = 2*(x*z - y*w)
+    T[:,2,1] = 2*(y*z + x*w)
+    T[:,2,2] = 1 - 2*(x*x + y*y)
+    T[:,0:3,3] = positions
+    T[:,3,3] = 1
+    return T
+
+def rotation_angle(T_start, T_goal):
+    '''
+    Angle of the rotation between two poses.
+    '''
+    cos_angle = abs(np.dot(quaternion_from_matrix(T_start), quaternion_from_matrix(T_goal)))
+    return 2 * np.arccos(min(cos_angle, 1.0))
+
+def interpolate_poses(T_start, T_goal, steps):
+    '''
+    steps poses along the straight line from T_start (excluded) to T_goal
+    (included), shape (steps, 4, 4).
+    '''
+    T_start = np.asarray(T_start, dtype=float)
+    T_goal = np.asarray(T_goal, dtype=float)
+    fractions = np.arange(1, steps + 1) / float(steps)
+    positions = T_start[0:3,3] + fractions[:,np.newaxis] * (T_goal[0:3,3] - T_start[0:3,3])
+    quaternions = quaternion_slerp(quaternion_from_matrix(T_start),
+            quaternion_from_matrix(T_goal), fractions)
+    return matrices_from_quaternions(quaternions, positions)
+
+def interpolate_waypoints(T_start, waypoints, max_translation_step, max_rotation_step):
+    '''
+    Densely sample the piecewise straight path T_start -> waypoints[0] -> ...
+    so that no step moves further than max_translation_step (meters) or
+    rotates more than max_rotation_step (radians). Returns a (N, 4, 4) array
+    of poses (T_start excluded) and the total translation along the path.
+    '''
+    poses = []
+    path_length = 0.
+    T_prev = np.asarray(T_start, dtype=float)
+    for T in waypoints:
+        T = np.asarray(T, dtype=float)
+        translation = np.linalg.norm(T[0:3,3] - T_prev[0:3,3])
+        steps = max(1, int(np.ceil(max(translation / max_translation_step,
+            rotation_angle(T_prev, T) / max_rotation_step))))
+        poses.append(interpolate_poses(T_prev, T, steps))
+        path_length += translation
+        T_prev = T
+    if len(poses) == 0:
+        return np.zeros((0, 4, 4)), path_length
+    return np.concatenate(poses), path_length
+
+def select_continuous_solutions(Q, valid, q_seed, joint_weights=None):
+    '''
+    Pick one IK branch per path step so that every step is as close as
+    possible to the previous one, starting from q_seed. Q is a (N, B, dof)
+    array of candidate solutions and valid a (N, B) boolean array. Returns a
+    (n, dof) array with the selected solutions and the index of the first
+    step without any valid solution (None if every step has one); in that
+    case only the steps before it are returned.
+    '''
+    if joint_weights is None:
+        joint_weights = np.ones(Q.shape[2])
+    has_solution = np.any(valid, axis=1)
+    failure_index = None
+    if not np.all(has_solution):
+        failure_index = int(np.argmin(has_solution))
+        Q = Q[:failure_index]
+        valid = valid[:failure_index]
+
+    positions = np.zeros((len(Q), Q.shape[2]))
+    q_prev = np.asarray(q_seed, dtype=float)
+    for i in xrange(len(Q)):
+        distance = np.sum(np.absolute(Q[i] - q_prev) * joint_weights, axis=1)
+        distance[~valid[i]] = np.inf
+        q_prev = Q[i, np.argmin(distance)]
+        positions[i] = q_prev
+    return positions, failure_index
+
+def first_joint_jump(positions, q_seed, max_joint_jump):
+    '''
+    Index of the first step where any joint moves more than max_joint_jump
+    radians from the previous step (or from q_seed), None if there is none.
+    '''
+    if len(positions) == 0:
+        return None
+    steps = np.diff(np.vstack((np.asarray(q_seed, dtype=float), positions)), axis=0)
+    jumps = np.any(np.absolute(steps) > max_joint_jump, axis=1)
+    if not np.any(jumps):
+        return None
+    return int(np.argmax(jumps))
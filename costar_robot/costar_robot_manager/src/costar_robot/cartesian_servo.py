@@ -0,0 +1,228 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import time
+import rospy
+import numpy as np
+
+from threading import Lock
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    from time import time as clock
+
+def rotation_vector(R):
+    '''
+    Axis times angle of the 3x3 rotation matrix R.
+    '''
+    angle = np.arccos(np.clip((np.trace(R) - 1.) / 2., -1., 1.))
+    w = np.array([R[2,1] - R[1,2], R[0,2] - R[2,0], R[1,0] - R[0,1]])
+    if angle < 1e-9:
+        return 0.5 * w
+    elif np.pi - angle < 1e-6:
+        # the skew part vanishes at pi; R + I = 2 a a^T instead
+        k = np.argmax(np.diag(R))
+        axis = R[:,k] + np.eye(3)[k]
+        return angle * axis / np.linalg.norm(axis)
+    return angle / (2. * np.sin(angle)) * w
+
+def clamp_norm(v, max_norm):
+    '''
+    Scale v down to max_norm if it is longer.
+    '''
+    norm = np.linalg.norm(v)
+    if norm > max_norm:
+        return v * (max_norm / norm)
+    return v
+
+# CARTESIAN SERVO
+# Fixed rate control loop that moves the end effector with a commanded
+# Cartesian velocity, or towards a commanded pose, instead of planning and
+# executing a trajectory for every target. Commands are twists (linear and
+# angular velocity, base frame) or 4x4 pose targets; for a pose target the
+# twist is gain times the pose error.
+#
+# Every cycle the twist is turned into joint velocities with a damped least
+# squares step, dq = J^T (J J^T + damping^2 I)^-1 v, which stays bounded near
+# singularities. Joint velocities are scaled down together to the velocity
+# limits (so the direction of motion is kept), and the integrated joint
+# positions are kept limit_margin inside the joint limits.
+#
+# Commands have to be repeated: if none arrived for watchdog_timeout seconds
+# the robot is stopped and run() returns. If the servo is preempted (e.g. by
+# a service call that moves the arm), the command stream that was running is
+# ignored from then on; a new stream, after a pause of at least
+# watchdog_timeout, is needed to servo again.
+#
+# Every cycle starts from the measured joint positions if run() is given a
+# way to read them, so the pose error and the next setpoint follow the real
+# robot and tracking errors do not add up. Without measurements the joint
+# positions are integrated from where the loop started. The loop calls
+# send(q, dq, period) with the new setpoint every cycle.
+class CartesianServo(object):
+
+    def __init__(self, kinematics, send,
+            rate=125.,
+            damping=0.05,
+            gain=2.,
+            max_joint_velocity=None,
+            max_linear_velocity=0.25,
+            max_angular_velocity=0.5,
+            limit_margin=0.02,
+            watchdog_timeout=0.2):
+        self.kinematics = kinematics
+        self.send = send
+        self.rate = rate
+        self.damping = damping
+        self.gain = gain
+        self.max_linear_velocity = max_linear_velocity
+        self.max_angular_velocity = max_angular_velocity
+        self.watchdog_timeout = watchdog_timeout
+
+        self.max_joint_velocity = kinematics.velocity_limits.copy()
+        if max_joint_velocity is not None:
+            self.max_joint_velocity = np.minimum(self.max_joint_velocity, max_joint_velocity)
+        self.lower = kinematics.limits_lower + limit_margin
+        self.upper = kinematics.limits_upper - limit_margin
+
+        self.mtx = Lock()
+        self.mode = None
+        self.command = None
+        self.command_time = None
+        self.preempted = False
+        self.q = None
+        self.stats = {}
+
+    def set_velocity(self, twist):
+        '''
+        Command a (linear, angular) end effector velocity in the base frame.
+        Returns False if the command is ignored because it belongs to a
+        stream that was preempted.
+        '''
+        return self.set_command('velocity', np.asarray(twist, dtype=float))
+
+    def set_target(self, T):
+        '''
+        Command a 4x4 end effector pose in the base frame. Returns False like
+        set_velocity().
+        '''
+        return self.set_command('pose', np.asarray(T, dtype=float))
+
+    def set_command(self, mode, command):
+        with self.mtx:
+            now = clock()
+            if self.preempted and self.command_time is not None \
+                    and now - self.command_time <= self.watchdog_timeout:
+                # still the stream that was preempted
+                self.command_time = now
+                return False
+            self.preempted = False
+            self.mode = mode
+            self.command = command
+            self.command_time = now
+            return True
+
+    def clear(self):
+        '''
+        Drop the current command; the robot stops on the next cycle.
+        '''
+        with self.mtx:
+            self.mode = None
+            self.command = None
+
+    def twist(self, q):
+        '''
+        Twist to follow in joint position q, or None if there is no current
+        command (none at all, or the watchdog expired).
+        '''
+        with self.mtx:
+            mode, command, command_time = self.mode, self.command, self.command_time
+        if mode is None or clock() - command_time > self.watchdog_timeout:
+            return None
+        if mode == 'pose':
+            T = self.kinematics.forward(q)
+            linear = self.gain * (command[0:3,3] - T[0:3,3])
+            angular = self.gain * rotation_vector(command[0:3,0:3].dot(T[0:3,0:3].T))
+        else:
+            linear, angular = command[0:3], command[3:6]
+        return np.concatenate((clamp_norm(linear, self.max_linear_velocity),
+            clamp_norm(angular, self.max_angular_velocity)))
+
+    def step(self, q, v, dt):
+        '''
+        One damped least squares step of length dt along the twist v from
+        joint position q. Returns the next joint position and velocity.
+        '''
+        J = self.kinematics.jacobian(q)
+        JJt = J.dot(J.T) + self.damping**2 * np.eye(J.shape[0])
+        dq = J.T.dot(np.linalg.solve(JJt, v))
+
+        scale = np.max(np.abs(dq) / self.max_joint_velocity)
+        if scale > 1.:
+            dq /= scale
+
+        q_next = np.clip(q + dq * dt, self.lower, self.upper)
+        # joints already outside the margin may only move back towards it
+        q_next = np.where(q < self.lower, np.maximum(q, q_next), q_next)
+        q_next = np.where(q > self.upper, np.minimum(q, q_next), q_next)
+        return q_next, (q_next - q) / dt
+
+    def run(self, q0, is_valid=None, measured=None):
+        '''
+        Servo from joint position q0 until the watchdog expires or is_valid
+        returns False, then stop. measured (if given) returns the latest
+        measured joint positions, or None. Runs on the calling thread.
+        '''
+        period = 1. / self.rate
+        self.q = np.array(q0, dtype=float)
+        res = 'SUCCESS -- servo stopped'
+        cycles = 0
+        missed = 0
+        start = clock()
+        cycle = 0
+        last_cycle = -1
+        while not rospy.is_shutdown():
+            if is_valid is not None and not is_valid():
+                with self.mtx:
+                    self.mode = None
+                    self.command = None
+                    self.preempted = True
+                res = 'FAILURE -- preempted'
+                break
+
+            q_measured = measured() if measured is not None else None
+            if q_measured is not None:
+                self.q = np.array(q_measured, dtype=float)
+                dt = period
+            else:
+                # integrate over the cycles that were skipped, too
+                dt = (cycle - last_cycle) * period
+            v = self.twist(self.q)
+            if v is None:
+                break
+
+            self.q, dq = self.step(self.q, v, dt)
+            last_cycle = cycle
+            self.send(self.q, dq, period)
+            cycles += 1
+
+            cycle += 1
+            lateness = clock() - (start + cycle * period)
+            if lateness > period:
+                skip = int(lateness / period)
+                missed += skip
+                cycle += skip
+                lateness -= skip * period
+            if lateness < 0:
+                time.sleep(-lateness)
+
+        self.send(self.q, np.zeros(len(self.q)), period)
+        self.stats = {'cycles': cycles,
+                'missed_cycles': missed,
+                'duration': clock() - start}
+        if missed > 0:
+            rospy.logwarn("Servoing at %g Hz missed %d of %d cycles"%(
+                self.rate, missed, cycles + missed))
+        return res
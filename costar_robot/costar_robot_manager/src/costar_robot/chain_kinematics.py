@@ -0,0 +1,175 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+def rpy_to_matrix(rpy):
+    '''
+    URDF fixed axis roll-pitch-yaw to a 3x3 rotation matrix.
+    '''
+    r, p, y = rpy
+    cr, sr = np.cos(r), np.sin(r)
+    cp, sp = np.cos(p), np.sin(p)
+    cy, sy = np.cos(y), np.sin(y)
+    return np.array([
+        [cy*cp, cy*sp*sr - sy*cr, cy*sp*cr + sy*sr],
+        [sy*cp, sy*sp*sr + cy*cr, sy*sp*cr - cy*sr],
+        [-sp,   cp*sr,            cp*cr]])
+
+def origin_to_matrix(origin):
+    '''
+    URDF origin element (or None) to a 4x4 homogeneous transform.
+    '''
+    T = np.eye(4)
+    if origin is not None:
+        if origin.rpy is not None:
+            T[0:3,0:3] = rpy_to_matrix(origin.rpy)
+        if origin.xyz is not None:
+            T[0:3,3] = origin.xyz
+    return T
+
+def axis_rotation_batch(axis, theta):
+    '''
+    Rotations by the angles theta (shape (M,)) about one fixed unit axis,
+    returned as a (M, 4, 4) array. Rodrigues' formula.
+    '''
+    x, y, z = axis
+    c = np.cos(theta)
+    s = np.sin(theta)
+    v = 1 - c
+    T = np.zeros((len(theta), 4, 4))
+    T[:,0,0] = c + x*x*v
+    T[:,0,1] = x*y*v - z*s
+    T[:,0,2] = x*z*v + y*s
+    T[:,1,0] = y*x*v + z*s
+    T[:,1,1] = c + y*y*v
+    T[:,1,2] = y*z*v - x*s
+    T[:,2,0] = z*x*v - y*s
+    T[:,2,1] = z*y*v + x*s
+    T[:,2,2] = c + z*z*v
+    T[:,3,3] = 1
+    return T
+
+# CHAIN KINEMATICS
+# Forward kinematics and geometric Jacobians of the URDF chain from base_link
+# to end_link, evaluated with NumPy for whole arrays of joint positions at
+# once. The chain is parsed into one fixed transform (the joint origin) and
+# one axis per joint, the same way pykdl_utils builds its KDL chain, so the
+# results agree with KDLKinematics.forward() and jacobian() to rounding
+# error; there is just no KDL call and no conversion per configuration.
+#
+# Jacobians are 6 x dof (linear velocity rows first), with the reference
+# point at the end of the chain and expressed in the base frame, like KDL's.
+class ChainKinematics(object):
+
+    def __init__(self, robot, base_link, end_link):
+        self.base_link = base_link
+        self.end_link = end_link
+
+        self.joints = []
+        self.link_names = []
+        self.joint_names = []
+        limits_lower = []
+        limits_upper = []
+        velocity_limits = []
+        for name in robot.get_chain(base_link, end_link, links=False):
+            joint = robot.joint_map[name]
+            if joint.type in ('revolute', 'continuous', 'prismatic'):
+                index = len(self.joint_names)
+                axis = np.array(joint.axis if joint.axis is not None else [1., 0., 0.], dtype=float)
+                axis = axis / np.linalg.norm(axis)
+                self.joint_names.append(name)
+                limit = getattr(joint, 'limit', None)
+                if not getattr(limit, 'velocity', None):
+                    velocity_limits.append(np.inf)
+                else:
+                    velocity_limits.append(limit.velocity)
+                if joint.type == 'continuous' or limit is None:
+                    limits_lower.append(-np.inf)
+                    limits_upper.append(np.inf)
+                else:
+                    limits_lower.append(limit.lower)
+                    limits_upper.append(limit.upper)
+            else:
+                index = None
+                axis = None
+            self.joints.append((origin_to_matrix(joint.origin), joint.type, axis, index))
+            self.link_names.append(joint.child)
+        self.dof = len(self.joint_names)
+        self.limits_lower = np.array(limits_lower, dtype=float)
+        self.limits_upper = np.array(limits_upper, dtype=float)
+        self.velocity_limits = np.array(velocity_limits, dtype=float)
+
+    def _joint_motion(self, joint_type, axis, theta):
+        if joint_type == 'prismatic':
+            motion = np.tile(np.eye(4), (len(theta), 1, 1))
+            motion[:,0:3,3] = theta[:,np.newaxis] * axis
+            return motion
+        return axis_rotation_batch(axis, theta)
+
+    def link_transforms(self, Q):
+        '''
+        Frames of every link in the chain for a (M, dof) array of joint
+        positions. Returns a (M, num_links, 4, 4) array.
+        '''
+        Q = np.atleast_2d(np.asarray(Q, dtype=float))
+        T = np.tile(np.eye(4), (len(Q), 1, 1))
+        frames = []
+        for origin, joint_type, axis, index in self.joints:
+            T = np.matmul(T, origin)
+            if index is not None:
+                T = np.matmul(T, self._joint_motion(joint_type, axis, Q[:,index]))
+            frames.append(T)
+        return np.stack(frames, axis=1)
+
+    def forward_batch(self, Q):
+        '''
+        End link poses for a (M, dof) array of joint positions, (M, 4, 4).
+        '''
+        Q = np.atleast_2d(np.asarray(Q, dtype=float))
+        T = np.tile(np.eye(4), (len(Q), 1, 1))
+        for origin, joint_type, axis, index in self.joints:
+            T = np.matmul(T, origin)
+            if index is not None:
+                T = np.matmul(T, self._joint_motion(joint_type, axis, Q[:,index]))
+        return T
+
+    def forward(self, q):
+        '''
+        End link pose for one joint position, (4, 4).
+        '''
+        return self.forward_batch(np.asarray(q, dtype=float)[np.newaxis])[0]
+
+    def jacobian_batch(self, Q):
+        '''
+        Geometric Jacobians for a (M, dof) array of joint positions,
+        (M, 6, dof).
+        '''
+        Q = np.atleast_2d(np.asarray(Q, dtype=float))
+        T = np.tile(np.eye(4), (len(Q), 1, 1))
+        axes = np.zeros((len(Q), self.dof, 3))
+        points = np.zeros((len(Q), self.dof, 3))
+        prismatic = np.zeros(self.dof, dtype=bool)
+        for origin, joint_type, axis, index in self.joints:
+            T = np.matmul(T, origin)
+            if index is not None:
+                # joint axis in the base frame; it is not moved by the joint itself
+                axes[:,index] = np.matmul(T[:,0:3,0:3], axis)
+                points[:,index] = T[:,0:3,3]
+                prismatic[index] = joint_type == 'prismatic'
+                T = np.matmul(T, self._joint_motion(joint_type, axis, Q[:,index]))
+
+        J = np.zeros((len(Q), 6, self.dof))
+        lever = T[:,np.newaxis,0:3,3] - points
+        J[:,0:3,:] = np.swapaxes(np.where(prismatic[np.newaxis,:,np.newaxis],
+            axes, np.cross(axes, lever)), 1, 2)
+        J[:,3:6,:] = np.swapaxes(np.where(prismatic[np.newaxis,:,np.newaxis],
+            0., axes), 1, 2)
+        return J
+
+    def jacobian(self, q):
+        '''
+        Geometric Jacobian for one joint position, (6, dof).
+        '''
+        return self.jacobian_batch(np.asarray(q, dtype=float)[np.newaxis])[0]
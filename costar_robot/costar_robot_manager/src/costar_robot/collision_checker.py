@@ -0,0 +1,256 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+import tf_conversions.posemath as pm
+
+from moveit_msgs.msg import ContactInformation
+from moveit_msgs.srv import GetStateValidityResponse
+from shape_msgs.msg import SolidPrimitive
+
+from chain_kinematics import ChainKinematics
+
+# CAPSULE COLLISION CHECKER
+# A fast, approximate, in-process replacement for MoveIt's check_state_validity
+# service. Every link in the kinematic chain is modeled as a capsule spanning
+# from its own frame to the origin of the next joint, and each capsule is
+# sampled as a row of spheres. Planning scene objects are approximated as
+# oriented boxes (boxes) or capsules (spheres, cylinders, cones and the
+# bounding spheres of meshes).
+#
+# All checks are vectorized over many joint configurations at once. Self
+# collisions and attached objects are not modeled, so the final choice
+# should still be confirmed by MoveIt.
+class CapsuleCollisionChecker(object):
+
+    def __init__(self, robot, base_link, end_link,
+            link_radius=0.06,
+            padding=0.0,
+            ignored_links=None,
+            kinematics=None):
+        self.base_link = base_link
+        self.end_link = end_link
+        self.link_radius = link_radius
+        self.padding = padding
+        if ignored_links is None:
+            ignored_links = [base_link]
+        self.ignored_links = ignored_links
+
+        self._parse_chain(robot, kinematics)
+
+        # Obstacles: object ids, boxes and capsules in the base frame
+        self.clear()
+
+    def _link_radius(self, link):
+        '''
+        Take the capsule radius from the URDF collision geometry if it is a
+        simple shape, otherwise use the default radius.
+        '''
+        collision = getattr(link, 'collision', None)
+        if collision is None or collision.geometry is None:
+            return self.link_radius
+        geometry = collision.geometry
+        if hasattr(geometry, 'radius'):
+            return geometry.radius
+        elif hasattr(geometry, 'size'):
+            return 0.5 * sorted(geometry.size)[1]
+        return self.link_radius
+
+    def _parse_chain(self, robot, kinematics=None):
+        '''
+        Convert the URDF chain from base_link to end_link into fixed
+        transforms, joint axes and capsules. The chain can be shared with an
+        existing ChainKinematics for the same links.
+        '''
+        if kinematics is None:
+            kinematics = ChainKinematics(robot, self.base_link, self.end_link)
+        self.kinematics = kinematics
+        self.joints = self.kinematics.joints
+        self.link_names = self.kinematics.link_names
+        self.dof = self.kinematics.dof
+
+        # capsule for link i: from its frame origin to the origin of joint i+1
+        self.capsule_links = []
+        self.capsule_ends = []
+        self.capsule_radii = []
+        for i, link_name in enumerate(self.link_names):
+            if link_name in self.ignored_links:
+                continue
+            if i + 1 < len(self.joints):
+                end = self.joints[i + 1][0][0:3,3]
+            else:
+                end = np.zeros(3)
+            self.capsule_links.append(i)
+            self.capsule_ends.append(end)
+            self.capsule_radii.append(self._link_radius(robot.link_map[link_name]))
+
+        # sample every capsule with spheres no further apart than its radius
+        self.sample_link = []
+        self.sample_offsets = []
+        self.sample_radii = []
+        self.sample_capsule = []
+        for k, (i, end, radius) in enumerate(zip(self.capsule_links, self.capsule_ends, self.capsule_radii)):
+            num = max(1, int(np.ceil(np.linalg.norm(end) / max(radius, 1e-3)))) + 1
+            for s in np.linspace(0., 1., num):
+                self.sample_link.append(i)
+                self.sample_offsets.append(s * end)
+                self.sample_radii.append(radius)
+                self.sample_capsule.append(k)
+        self.sample_link = np.array(self.sample_link)
+        self.sample_offsets = np.array(self.sample_offsets)
+        self.sample_radii = np.array(self.sample_radii)
+        self.sample_capsule = np.array(self.sample_capsule)
+        self.capsule_starts = np.flatnonzero(np.r_[True, np.diff(self.sample_capsule) != 0])
+
+    def link_transforms(self, Q):
+        '''
+        Frames of every link in the chain for a (M, dof) array of joint
+        positions. Returns a (M, num_links, 4, 4) array.
+        '''
+        return self.kinematics.link_transforms(Q)
+
+    def clear(self):
+        '''
+        Remove every obstacle.
+        '''
+        self.object_ids = []
+        self.box_objects = []
+        self.box_inv_transforms = np.zeros((0, 4, 4))
+        self.box_half_extents = np.zeros((0, 3))
+        self.capsule_objects = []
+        self.capsule_a = np.zeros((0, 3))
+        self.capsule_b = np.zeros((0, 3))
+        self.capsule_r = np.zeros(0)
+
+    def set_objects(self, collision_objects, frame_transforms):
+        '''
+        Mirror a list of moveit_msgs/CollisionObject. frame_transforms maps
+        each header.frame_id to a 4x4 transform into the base frame; objects
+        in unknown frames are skipped.
+        '''
+        self.clear()
+        box_inv, box_half = [], []
+        cap_a, cap_b, cap_r = [], [], []
+        for obj in collision_objects:
+            T_frame = frame_transforms.get(obj.header.frame_id.strip('/'))
+            if T_frame is None:
+                continue
+            self.object_ids.append(obj.id)
+            obj_idx = len(self.object_ids) - 1
+            for primitive, pose in zip(obj.primitives, obj.primitive_poses):
+                T = T_frame.dot(pm.toMatrix(pm.fromMsg(pose)))
+                dims = primitive.dimensions
+                if primitive.type == SolidPrimitive.BOX:
+                    self.box_objects.append(obj_idx)
+                    box_inv.append(np.linalg.inv(T))
+                    box_half.append(0.5 * np.array(dims[0:3]))
+                elif primitive.type == SolidPrimitive.SPHERE:
+                    self.capsule_objects.append(obj_idx)
+                    cap_a.append(T[0:3,3])
+                    cap_b.append(T[0:3,3])
+                    cap_r.append(dims[0])
+                elif primitive.type in (SolidPrimitive.CYLINDER, SolidPrimitive.CONE):
+                    half_height, radius = 0.5 * dims[0], dims[1]
+                    self.capsule_objects.append(obj_idx)
+                    cap_a.append(T[0:3,3] - half_height * T[0:3,2])
+                    cap_b.append(T[0:3,3] + half_height * T[0:3,2])
+                    cap_r.append(radius)
+            for mesh, pose in zip(obj.meshes, obj.mesh_poses):
+                if len(mesh.vertices) == 0:
+                    continue
+                T = T_frame.dot(pm.toMatrix(pm.fromMsg(pose)))
+                vertices = np.array([(v.x, v.y, v.z) for v in mesh.vertices])
+                center = 0.5 * (vertices.min(axis=0) + vertices.max(axis=0))
+                radius = np.max(np.linalg.norm(vertices - center, axis=1))
+                center = T[0:3,0:3].dot(center) + T[0:3,3]
+                self.capsule_objects.append(obj_idx)
+                cap_a.append(center)
+                cap_b.append(center)
+                cap_r.append(radius)
+
+        if len(box_inv) > 0:
+            self.box_inv_transforms = np.array(box_inv)
+            self.box_half_extents = np.array(box_half)
+        if len(cap_a) > 0:
+            self.capsule_a = np.array(cap_a)
+            self.capsule_b = np.array(cap_b)
+            self.capsule_r = np.array(cap_r)
+
+    def sample_points(self, Q):
+        '''
+        Centers of the sphere samples on every link capsule, shape (M, P, 3).
+        '''
+        frames = self.link_transforms(Q)[:, self.sample_link]
+        return np.einsum('mpij,pj->mpi', frames[...,0:3,0:3], self.sample_offsets) + frames[...,0:3,3]
+
+    def distances(self, Q, padding=None):
+        '''
+        Signed clearance between every link capsule and every obstacle
+        primitive, shape (M, num_capsules, num_primitives). Negative values
+        are collisions. padding overrides the padding of the checker.
+        '''
+        if padding is None:
+            padding = self.padding
+        P = self.sample_points(Q)
+        radii = self.sample_radii + padding
+        dists = []
+
+        if len(self.box_objects) > 0:
+            local = np.einsum('bij,mpj->mpbi', self.box_inv_transforms[:,0:3,0:3], P) \
+                    + self.box_inv_transforms[:,0:3,3]
+            outside = np.maximum(np.absolute(local) - self.box_half_extents, 0.)
+            dists.append(np.linalg.norm(outside, axis=-1) - radii[:,np.newaxis])
+
+        if len(self.capsule_objects) > 0:
+            ab = self.capsule_b - self.capsule_a
+            ab_sq = np.maximum(np.sum(ab**2, axis=1), 1e-12)
+            ap = P[:,:,np.newaxis,:] - self.capsule_a
+            t = np.clip(np.sum(ap * ab, axis=-1) / ab_sq, 0., 1.)
+            closest = ap - t[...,np.newaxis] * ab
+            dists.append(np.linalg.norm(closest, axis=-1) - self.capsule_r - radii[:,np.newaxis])
+
+        if len(dists) == 0:
+            return np.zeros((P.shape[0], len(self.capsule_starts), 0))
+        dists = np.concatenate(dists, axis=2)
+        return np.minimum.reduceat(dists, self.capsule_starts, axis=1)
+
+    def check(self, Q, padding=None):
+        '''
+        Vectorized collision check for a (M, dof) array of joint positions.
+        Returns a boolean (M,) array of valid configurations and, for every
+        configuration, a list of (link name, object id, depth) contacts.
+        '''
+        Q = np.atleast_2d(np.asarray(Q, dtype=float))
+        dists = self.distances(Q, padding)
+        colliding = dists < 0
+        valid = ~np.any(colliding, axis=(1, 2))
+
+        primitive_objects = self.box_objects + self.capsule_objects
+        contacts = [list() for _ in xrange(len(Q))]
+        for m, k, o in zip(*np.nonzero(colliding)):
+            link_name = self.link_names[self.capsule_links[k]]
+            obj_id = self.object_ids[primitive_objects[o]]
+            contacts[m].append((link_name, obj_id, -dists[m, k, o]))
+        return valid, contacts
+
+    def check_state_validity(self, Q, padding=None):
+        '''
+        Same as check(), but returns one moveit_msgs GetStateValidityResponse
+        per configuration so results can be used in place of the
+        /check_state_validity service.
+        '''
+        valid, contacts = self.check(Q, padding)
+        responses = []
+        for valid_i, contacts_i in zip(valid, contacts):
+            response = GetStateValidityResponse(valid=bool(valid_i))
+            for link_name, obj_id, depth in contacts_i:
+                response.contacts.append(ContactInformation(
+                    contact_body_1=link_name,
+                    body_type_1=ContactInformation.ROBOT_LINK,
+                    contact_body_2=obj_id,
+                    body_type_2=ContactInformation.WORLD_OBJECT,
+                    depth=depth))
+            responses.append(response)
+        return responses
@@ -0,0 +1,101 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import copy
+import numpy as np
+
+from trajectory import TrajectoryArrays
+
+def hermite_positions(t0, p0, v0, t1, p1, v1, t):
+    '''
+    Positions at the times t (M,) on the cubic Hermite segment from (t0, p0,
+    v0) to (t1, p1, v1); the interpolation the drivers and the
+    StreamingExecutor use between two trajectory points. Returns (M, dof).
+    '''
+    h = t1 - t0
+    s = ((np.asarray(t, dtype=float) - t0) / h)[:,np.newaxis]
+    return (2*s**3 - 3*s**2 + 1) * p0 + (s**3 - 2*s**2 + s) * (v0 * h) \
+        + (3*s**2 - 2*s**3) * p1 + (s**3 - s**2) * (v1 * h)
+
+# TRAJECTORY COMPRESSOR
+# Drops trajectory points that the robot would follow anyway: interpolation
+# planners emit a point for every step and MoveIt plans can be dense, but
+# most of those points lie on the cubic segment between their neighbours.
+#
+# Time-aware Douglas-Peucker: a span between two kept points is accepted if
+# the cubic Hermite segment through the positions and velocities of its ends
+# passes within tolerance (radians, every joint) of every point in between
+# at that point's time; otherwise the worst point is kept and both halves
+# are checked. Kept points keep their own times and velocities, so the
+# compressed trajectory is still continuous in velocity.
+#
+# stats holds the number of points before and after and the largest
+# deviation of the last compressed trajectory.
+class TrajectoryCompressor(object):
+
+    def __init__(self, tolerance=1e-3):
+        self.tolerance = tolerance
+        self.stats = {}
+
+    def select(self, times, positions, velocities):
+        '''
+        Indices of the points to keep, in order; the first and last point are
+        always kept.
+        '''
+        n = len(times)
+        keep = np.zeros(n, dtype=bool)
+        keep[0] = keep[-1] = True
+        max_error = 0.
+        spans = [(0, n - 1)]
+        while len(spans) > 0:
+            a, b = spans.pop()
+            if b - a < 2:
+                continue
+            if times[b] <= times[a]:
+                # no time to interpolate over: keep everything
+                keep[a:b] = True
+                continue
+            interpolated = hermite_positions(times[a], positions[a], velocities[a],
+                times[b], positions[b], velocities[b], times[a+1:b])
+            errors = np.max(np.absolute(interpolated - positions[a+1:b]), axis=1)
+            worst = int(np.argmax(errors))
+            if errors[worst] > self.tolerance:
+                split = a + 1 + worst
+                keep[split] = True
+                spans.append((a, split))
+                spans.append((split, b))
+            else:
+                max_error = max(max_error, errors[worst])
+        self.stats = {'points': n,
+                'kept_points': int(np.sum(keep)),
+                'ratio': n / float(np.sum(keep)),
+                'max_error': max_error}
+        return np.flatnonzero(keep)
+
+    def compress(self, traj):
+        '''
+        Compressed copy of the TrajectoryArrays traj.
+        '''
+        self.stats = {}
+        if len(traj) < 3:
+            return traj
+        keep = self.select(traj.times, traj.positions, traj.velocities)
+        return TrajectoryArrays(traj.positions[keep], traj.times[keep],
+            traj.velocities[keep], joint_names=traj.joint_names)
+
+    def compress_msg(self, traj):
+        '''
+        JointTrajectory message with only the points of traj that are needed;
+        the points themselves are not changed. Trajectories without
+        velocities for every point are returned as they are, because the
+        drivers do not interpolate them with the same cubic.
+        '''
+        self.stats = {}
+        if len(traj.points) < 3 or not all(len(pt.velocities) == len(pt.positions) for pt in traj.points):
+            return traj
+        arrays = TrajectoryArrays.from_msg(traj)
+        keep = self.select(arrays.times, arrays.positions, arrays.velocities)
+        compressed = copy.copy(traj)
+        compressed.points = [traj.points[i] for i in keep]
+        return compressed
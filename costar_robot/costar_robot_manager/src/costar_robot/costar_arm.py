@@ -4,12 +4,17 @@ import tf
 import rospy
 from costar_component import CostarComponent
 from costar_robot_msgs.srv import *
+from costar_robot_msgs.msg import ExecuteTrajectoryAction
+from costar_robot_msgs.msg import ExecuteTrajectoryFeedback
+from costar_robot_msgs.msg import ExecuteTrajectoryResult
 from std_msgs.msg import String
 from trajectory_msgs.msg import JointTrajectoryPoint
 from std_srvs.srv import Empty as EmptyService
 from sensor_msgs.msg import JointState
+from geometry_msgs.msg import PoseStamped, TwistStamped
 import tf_conversions.posemath as pm
 import numpy as np
+import actionlib
 
 import PyKDL as kdl
 import urdf_parser_py
@@ -18,14 +23,32 @@ from pykdl_utils.kdl_parser import kdl_tree_from_urdf_model
 from pykdl_utils.kdl_kinematics import KDLKinematics
 
 from costar_robot import SimplePlanning
+from costar_robot import KinematicsCache
+from costar_robot import CapsuleCollisionChecker
+from costar_robot import ChainKinematics
+from costar_robot import PlanCache
+from costar_robot import PlanningSceneMirror
+from costar_robot import TimeParameterization
+from costar_robot import PathSmoother
+from costar_robot import TrajectoryExecution
+from costar_robot import StreamingExecutor
+from costar_robot import TrajectoryCompressor
+from costar_robot import CartesianServo
+from costar_robot import ReachabilityMap
+from costar_robot.blending import waypoint_distances
+from costar_robot.time_parameterization import retimed_point_times
 
 from moveit_msgs.msg import *
 from moveit_msgs.srv import *
+from librarian_msgs.srv import *
 
 from predicator_landmark import GetWaypointsService
 
 import copy
-from threading import Lock
+import time
+from Queue import Queue, Empty
+from threading import Lock, Event, Condition, Thread
+from multiprocessing.pool import ThreadPool
 
 class CostarArm(CostarComponent):
 
@@ -49,6 +72,32 @@ class CostarArm(CostarComponent):
             state_validity_penalty = 1e5,
             max_dist_from_table = 0.75,
             dof=7,
+            kinematics_cache_size=1024,
+            local_collision_checking=True,
+            moveit_validation_candidates=3,
+            query_threads=4,
+            query_max_valid_candidates=None,
+            rank_by_time=False,
+            plan_cache_size=64,
+            plan_cache_id=None,
+            plan_cache_save_period=10.,
+            smartmove_goals_per_plan=5,
+            planning_threads=4,
+            speculative_sequences=6,
+            straight_approach=True,
+            time_optimal=True,
+            smooth_plans=True,
+            smoothing_time_budget=0.25,
+            smoothing_padding=0.03,
+            fk_resolution=1e-4,
+            tf_rate=30,
+            table_rate=1,
+            stream_rate=250,
+            compression_tolerance=1e-3,
+            servo_rate=125,
+            servo_damping=0.05,
+            servo_watchdog=0.2,
+            servo_max_joint_velocity=1.0,
             debug=False,
             perception_ns="/costar",):
 
@@ -94,6 +143,28 @@ class CostarArm(CostarComponent):
 
         self.backoff_waypoints = list()
 
+        # smart_move_cb asks MoveIt for a plan to any of this many candidates at once
+        self.smartmove_goals_per_plan = smartmove_goals_per_plan
+
+        # smartmove_multipurpose_gripper plans both legs of this many
+        # sequences at once, with at most planning_threads planning requests
+        # in flight
+        self.planning_pool = ThreadPool(planning_threads)
+        self.planning_threads = planning_threads
+        self.speculative_sequences = speculative_sequences
+        # the grasp leg (backup waypoint to grasp pose) is a straight line
+        # computed locally if it is reachable and collision free, and only
+        # planned with MoveIt otherwise
+        self.straight_approach = straight_approach
+
+        # query() scores candidate poses on this pool; it may stop as soon as
+        # query_max_valid_candidates valid poses are found (None: score all)
+        self.query_pool = ThreadPool(query_threads)
+        self.query_max_valid_candidates = query_max_valid_candidates
+        # rank query() candidates by the estimated duration of the move
+        # instead of the weighted joint and Cartesian distance
+        self.rank_by_time = rank_by_time
+
         self.traj_step_t = traj_step_t
 
         self.max_goal_diff = max_goal_diff
@@ -107,6 +178,14 @@ class CostarArm(CostarComponent):
         #[0] * self.dof
         self.old_q0 = [0] * self.dof
 
+        # at_goal, near_goal and moving are updated for every joint state
+        # message; wait_for_goal() and wait_until_stopped() block on
+        # motion_cv until they change. Forward kinematics is only redone once
+        # a joint has moved more than fk_resolution since the last time.
+        self.motion_cv = Condition()
+        self.fk_resolution = fk_resolution
+        self.fk_q = None
+
         self.cur_stamp_mtx = Lock()
 
         self.cur_stamp = 0
@@ -130,6 +209,13 @@ class CostarArm(CostarComponent):
         self.servo_mode = self.make_service('SetServoMode',SetServoMode,self.set_servo_mode_cb)
         self.shutdown = self.make_service('ShutdownArm',EmptyService,self.shutdown_arm_cb)
         self.servo = self.make_service('ServoToPose',ServoToPose,self.servo_to_pose_cb)
+        self.cartesian_path_srv = self.make_service('ExecuteCartesianPath',ExecuteCartesianPath,self.execute_cartesian_path_cb)
+        self.waypoints_srv = self.make_service('ServoToWaypoints',ServoToWaypoints,self.servo_to_waypoints_cb)
+        self.cycle_time_srv = self.make_service('EstimateCycleTime',EstimateCycleTime,self.estimate_cycle_time_cb)
+        self.prefetch_srv = self.make_service('PrefetchPlan',PrefetchPlan,self.prefetch_plan_cb)
+        self.prefetch_grasp_srv = self.make_service('PrefetchSmartGrasp',SmartMove,self.prefetch_smartmove_grasp_cb)
+        self.prefetch_release_srv = self.make_service('PrefetchSmartRelease',SmartMove,self.prefetch_smartmove_release_cb)
+        self.prefetch_place_srv = self.make_service('PrefetchSmartPlace',SmartMove,self.prefetch_smartmove_place_cb)
         self.plan = self.make_service('PlanToPose',ServoToPose,self.plan_to_pose_cb)
         self.cancel_trajectory = self.make_service('StopTrajectory',EmptyService,self.stop_robot_trajectory_cb)
 
@@ -146,6 +232,16 @@ class CostarArm(CostarComponent):
         self.enable_collisions_srv = self.make_service('EnableCollision',Object,self.enable_collision_cb)
         self.disable_collisions_srv = self.make_service('DisableCollision',Object,self.disable_collision_cb)
 
+        # Trajectories run in the background (see execute_trajectory). The
+        # ExecuteTrajectory action reports their progress and can cancel them;
+        # the services above wait for them to finish.
+        self.execution = None
+        self.execution_mtx = Lock()
+        self.execute_server = actionlib.SimpleActionServer(os.path.join(self.namespace, 'ExecuteTrajectory'),
+                ExecuteTrajectoryAction,
+                execute_cb=self.execute_trajectory_action_cb,
+                auto_start=False)
+
         self.get_waypoints_srv = GetWaypointsService(world=world,
                                                      service=False,
                                                      ns=perception_ns)
@@ -154,6 +250,14 @@ class CostarArm(CostarComponent):
         # Create publishers. These will send necessary information out about the state of the robot.
         # TODO(ahundt): this is for the KUKA robot. Make sure it still works.
         self.pt_publisher = rospy.Publisher('/joint_traj_pt_cmd',JointTrajectoryPoint,queue_size=1000)
+        # drivers that take one joint position at a time stream interpolated
+        # setpoints to pt_publisher at stream_rate
+        self.streaming_executor = StreamingExecutor(self.pt_publisher.publish, rate=stream_rate)
+        # trajectories are sent with only the points needed to follow them
+        # within compression_tolerance radians (None to send every point)
+        self.trajectory_compressor = None
+        if compression_tolerance is not None and compression_tolerance > 0:
+            self.trajectory_compressor = TrajectoryCompressor(compression_tolerance)
 
         self.status_pub = self.make_pub('DriverStatus',String,queue_size=1000)
         self.info_pub = self.make_pub('info',String,queue_size=1000)
@@ -161,12 +265,14 @@ class CostarArm(CostarComponent):
         self.display_pub = self.make_pub('display_trajectory',DisplayTrajectory,queue_size=1000)
 
         self.robot = URDF.from_parameter_server()
-        self.js_subscriber = rospy.Subscriber('joint_states',JointState,self.js_cb)
         self.tree = kdl_tree_from_urdf_model(self.robot)
         self.chain = self.tree.getChain(base_link, end_link)
 
         # Create reference to pyKDL kinematics
         self.kdl_kin = KDLKinematics(self.robot, base_link, end_link)
+        # the same chain in NumPy: forward kinematics and Jacobians without
+        # going through KDL, also for many joint positions at once
+        self.chain_kinematics = ChainKinematics(self.robot, base_link, end_link)
 
         #self.set_goal(self.q0)
         self.goal = None
@@ -183,6 +289,52 @@ class CostarArm(CostarComponent):
         if self.closed_form_IK_solver is not None:
             self.closed_form_IK_solver.setJointWeights(self.joint_weights)
 
+        # Memoized forward/inverse kinematics, shared with the planner
+        self.kinematics = KinematicsCache(self.kdl_kin,
+                closed_form_IK_solver=self.closed_form_IK_solver,
+                chain_kinematics=self.chain_kinematics,
+                size=kinematics_cache_size)
+
+        # Streaming Cartesian servoing in SERVO mode: twists or pose targets
+        # published on servo/twist and servo/pose are followed at servo_rate
+        # until they stop coming for servo_watchdog seconds; every cycle starts
+        # from the measured joint states
+        self.cartesian_servo = CartesianServo(self.chain_kinematics, self.send_servo,
+                rate=servo_rate,
+                damping=servo_damping,
+                watchdog_timeout=servo_watchdog,
+                max_joint_velocity=servo_max_joint_velocity)
+        self.servo_thread = None
+        self.servo_mtx = Lock()
+        self.servo_twist_sub = rospy.Subscriber(os.path.join(self.namespace, 'servo', 'twist'),
+                TwistStamped, self.servo_twist_cb)
+        self.servo_pose_sub = rospy.Subscriber(os.path.join(self.namespace, 'servo', 'pose'),
+                PoseStamped, self.servo_pose_cb)
+        self.js_subscriber = rospy.Subscriber('joint_states',JointState,self.js_cb)
+
+        # Retime trajectories to the joint limits. URDF only has velocity
+        # limits; acceleration limits come from the MoveIt joint_limits.yaml.
+        self.time_parameterization = None
+        if time_optimal:
+            acceleration_limits = {}
+            for name in self.joint_names:
+                limits = rospy.get_param('robot_description_planning/joint_limits/%s'%name, {})
+                if limits.get('has_acceleration_limits', False):
+                    acceleration_limits[name] = limits['max_acceleration']
+            self.time_parameterization = TimeParameterization.from_urdf(self.robot,
+                    self.joint_names,
+                    acceleration_limits)
+
+        # optional precomputed reachability map (scripts/build_reachability_map.py)
+        # used by query() to drop poses the arm cannot reach before solving IK
+        self.reachability_map = None
+        reachability_map_file = rospy.get_param(os.path.join(self.namespace, "robot", "reachability_map"), None)
+        if reachability_map_file:
+            self.reachability_map = ReachabilityMap.load(reachability_map_file)
+            if self.reachability_map.end_link not in ("", self.end_link):
+                rospy.logwarn("Reachability map was built for %s, not %s"%(
+                    self.reachability_map.end_link, self.end_link))
+
         self.state_validity_penalty = state_validity_penalty
 
         # how important is it to choose small rotations in goal poses
@@ -192,6 +344,11 @@ class CostarArm(CostarComponent):
 
         # for checking robot configuration validity
         self.state_validity_service = rospy.ServiceProxy("/check_state_validity", GetStateValidity)
+        # approximate in-process collision checking; only the best few query
+        # results are confirmed with the MoveIt service
+        self.collision_checker = None
+        self.collision_scene_mtx = Lock()
+        self.moveit_validation_candidates = moveit_validation_candidates
         # self.robot_state = RobotState()
         # self.robot_state.joint_state.name = self.joint_names
 
@@ -202,18 +359,61 @@ class CostarArm(CostarComponent):
           self.gripper_close = self.make_service_proxy('gripper/close',EmptyService)
           self.gripper_open = self.make_service_proxy('gripper/open',EmptyService)
 
+        # MoveIt plans are reused for repeated moves; with a plan_cache_id
+        # they are also stored with the librarian across sessions
+        self.plan_cache = None
+        self.plan_cache_id = plan_cache_id
+        self.plan_cache_folder = 'plan_cache'
+
         if has_planning_scene:
-            self.get_planning_scene = self.make_service_proxy('get_planning_scene',
-                GetPlanningScene,
-                use_namespace=False)
+            # local copy of the MoveIt planning scene, edited through diffs
+            self.planning_scene = PlanningSceneMirror()
+            if local_collision_checking:
+                self.collision_checker = CapsuleCollisionChecker(self.robot,
+                        base_link, end_link,
+                        kinematics=self.chain_kinematics)
+            if plan_cache_size > 0:
+                self.plan_cache = PlanCache(size=plan_cache_size)
+            # shortcutting checks many positions, so only do it with the
+            # local collision checker
+            path_smoother = None
+            if smooth_plans and self.collision_checker is not None:
+                path_smoother = PathSmoother(time_budget=smoothing_time_budget)
             self.planner = SimplePlanning(self.robot,base_link,end_link,
                 self.planning_group,
                 kdl_kin=self.kdl_kin,
                 joint_names=self.joint_names,
-                closed_form_IK_solver=closed_form_IK_solver)
+                closed_form_IK_solver=closed_form_IK_solver,
+                kinematics_cache=self.kinematics,
+                plan_cache=self.plan_cache,
+                max_planner_clients=planning_threads,
+                planning_scene_mirror=self.planning_scene,
+                time_parameterization=self.time_parameterization,
+                path_smoother=path_smoother)
+            self.planner.validity_checker = self.check_plan_validity
+            if path_smoother is not None:
+                # shortcuts keep smoothing_padding meters from the obstacles
+                # in the local checker, which models neither the gripper nor
+                # self collisions; the result is confirmed with MoveIt
+                self.planner.smoothing_validity_checker = lambda Q, obj: \
+                        self.check_plan_validity(Q, obj, padding=smoothing_padding)
+                self.planner.path_validator = self.check_path_validity
+            if self.plan_cache is not None and self.plan_cache_id is not None:
+                self.load_plan_cache()
 
         rospy.loginfo("Simple planning interface created successfully.")
 
+        self.execute_server.start()
+
+        # TF frames and the table pose are kept up to date on their own
+        # timers, so tick() never waits for TF
+        self.tf_timer = rospy.Timer(rospy.Duration(1. / tf_rate), self.tf_timer_cb)
+        self.table_timer = rospy.Timer(rospy.Duration(1. / table_rate), self.table_timer_cb)
+
+        # new plans are stored with the librarian on a timer too
+        if self.plan_cache_id is not None:
+            self.plan_cache_timer = rospy.Timer(rospy.Duration(plan_cache_save_period), self.plan_cache_timer_cb)
+
     '''
     Preemption logic -- acquire at the beginning of a trajectory.
     This returns the next stamp, and updates the current master stamp.
@@ -263,40 +463,75 @@ class CostarArm(CostarComponent):
         if len(msg.position) is self.dof:
             self.old_q0 = self.q0
             self.q0 = np.array(msg.position)
+            self.update_position()
         else:
             rospy.logwarn('Incorrect joint dimensionality')
 
     '''
     update current position information
+    called for every joint state message; wakes up everyone waiting on motion_cv
     '''
     def update_position(self):
 
         if self.q0 is None or self.old_q0 is None:
             return
 
-        self.ee_pose = pm.fromMatrix(self.kdl_kin.forward(self.q0))
+        with self.motion_cv:
+            if self.fk_q is None or np.max(np.abs(self.q0 - self.fk_q)) > self.fk_resolution:
+                self.ee_pose = pm.fromMatrix(self.kinematics.forward(self.q0))
+                self.fk_q = self.q0
+
+            if self.goal is not None:
 
-        if self.goal is not None:
+                cart_diff = (self.ee_pose.p - self.goal.p).Norm()
+                rot_diff = self.goal_rotation_weight * \
+                  (pm.Vector(*self.ee_pose.M.GetRPY()) - pm.Vector(*self.goal.M.GetRPY())).Norm()
+                goal_diff = cart_diff + rot_diff
+
+                if goal_diff < self.max_goal_diff:
+                    self.at_goal = True
+                else:
+                    self.at_goal = False
 
-            cart_diff = (self.ee_pose.p - self.goal.p).Norm()
-            rot_diff = self.goal_rotation_weight * \
-              (pm.Vector(*self.ee_pose.M.GetRPY()) - pm.Vector(*self.goal.M.GetRPY())).Norm()
-            goal_diff = cart_diff + rot_diff
+                if goal_diff < 10*self.max_goal_diff:
+                    self.near_goal = True
 
-            if goal_diff < self.max_goal_diff:
-                self.at_goal = True
+            q_diff = np.abs(self.old_q0 - self.q0).sum()
+
+            if q_diff < self.max_q_diff:
+                self.moving = False
             else:
-                self.at_goal = False
+                self.moving = True
 
-            if goal_diff < 10*self.max_goal_diff:
-                self.near_goal = True
+            self.motion_cv.notify_all()
 
-        q_diff = np.abs(self.old_q0 - self.q0).sum()
+    '''
+    Block until the robot is at the goal set with set_goal(). Gives up after
+    timeout seconds, or as soon as stamp (if given) has been preempted.
+    Returns at_goal.
+    '''
+    def wait_for_goal(self, timeout, stamp=None):
+        return self.wait_for_motion_state(lambda: self.at_goal, timeout, stamp)
 
-        if q_diff < self.max_q_diff:
-            self.moving = False
-        else:
-            self.moving = True
+    '''
+    Block until the joints stop moving; same arguments as wait_for_goal().
+    Returns True if the robot stopped.
+    '''
+    def wait_until_stopped(self, timeout, stamp=None):
+        return self.wait_for_motion_state(lambda: not self.moving, timeout, stamp)
+
+    def wait_for_motion_state(self, condition, timeout, stamp=None):
+        end_t = time.time() + timeout
+        with self.motion_cv:
+            while not condition():
+                remaining = end_t - time.time()
+                if remaining <= 0 or rospy.is_shutdown():
+                    break
+                if stamp is not None and not self.valid_verify(stamp):
+                    break
+                # wake up now and then to notice preemption and shutdown
+                self.motion_cv.wait(min(remaining, 0.1))
+            return condition()
 
     def check_req_speed_params(self,req):
         if req.accel > self.MAX_ACC:
@@ -312,24 +547,33 @@ class CostarArm(CostarComponent):
     def ik(self, T, q0, dist=0.5):
         '''
         ik: handles calls to KDL inverse kinematics
+        Results are memoized in self.kinematics.
         '''
-        q = None
-        if self.closed_form_IK_solver is not None:
-        #T = pm.toMatrix(F)
-          q = self.closed_form_IK_solver.findClosestIK(T,q0)
-        else:
-          q = self.kdl_kin.inverse(T,q0)
+        q = self.kinematics.ik(T,q0)
 
         # NOTE: this results in unsafe behavior; do not use without checks
         #if q is None:
         #    q = self.kdl_kin.inverse(T)
         return q
 
+    def ik_batch(self, Ts):
+        '''
+        ik_batch: solve IK for a whole list of kdl frames with one call to the
+        closed form solver. Returns one (num_solutions x dof) array per frame,
+        empty where there is no solution. Returns None if there is no closed
+        form solver, in which case callers should fall back to ik().
+        '''
+        if self.closed_form_IK_solver is None:
+            return None
+        if len(Ts) == 0:
+            return []
+        return self.kinematics.solve_ik_batch([pm.toMatrix(T) for T in Ts])
+
     def forward_kinematics_cb(self, req):
         ''' Run forward kinematics on a joint space pose and return the result.
         '''
         q = req.joint_state.position
-        kdl_pose = pm.fromMatrix(self.kdl_kin.forward(q))
+        kdl_pose = pm.fromMatrix(self.kinematics.forward(q))
         pose_msg = pm.toMsg(kdl_pose)
         response = ForwardKinematicsResponse(pose=pose_msg, ack="SUCCESS")
         return response
@@ -354,15 +598,30 @@ class CostarArm(CostarComponent):
         if len(possible_goals) == 0:
             return 'FAILURE -- no valid poses found. see costar_arm.py'
 
-        for (dist,T,obj,name) in possible_goals:
-            rospy.logwarn("Trying to move to frame at distance %f"%(dist))
+        # Candidates are planned for in groups: up to smartmove_goals_per_plan
+        # consecutive candidates for the same object go into one request.
+        # Collisions with that object are allowed while planning, so objects
+        # are never mixed within a group.
+        i = 0
+        while i < len(possible_goals):
+            obj = possible_goals[i][2]
+            group = [possible_goals[i]]
+            for goal in possible_goals[i+1:i+self.smartmove_goals_per_plan]:
+                if goal[2] != obj:
+                    break
+                group.append(goal)
+            i += len(group)
+
+            rospy.logwarn("Trying to move to one of %d frames at distance %f to %f"%(len(group),group[0][0],group[-1][0]))
 
-            # plan to T
+            # plan to any T in the group
             if not self.valid_verify(stamp):
                 msg = 'FAILURE - Stopping smart move action because robot has been preempted by another process. see costar_arm.py'
                 rospy.logwarn(msg)
                 return msg
-            (code,res) = self.planner.getPlan(T,self.q0,obj=obj)
+            (code,res,idx) = self.planner.getPlanAnyOf([goal[1] for goal in group],self.q0,obj=obj)
+            if idx is not None:
+                rospy.logwarn("Planned to frame at distance %f"%(group[idx][0]))
             msg = self.send_and_publish_planning_result(res,stamp,acceleration,velocity)
 
             if msg[0:7] == 'SUCCESS':
@@ -376,13 +635,19 @@ class CostarArm(CostarComponent):
         return []
 
     def set_goal(self,q):
-        self.at_goal = False
-        self.near_goal = False
-        self.goal = pm.fromMatrix(self.kdl_kin.forward(q))
+        goal = pm.fromMatrix(self.kinematics.forward(q))
+        with self.motion_cv:
+            self.at_goal = False
+            self.near_goal = False
+            self.goal = goal
         # rospy.logwarn("set goal to " + str(self.goal))
 
     def send_and_publish_planning_result(self,res,stamp,acceleration,velocity):
         if (not res is None) and len(res.planned_trajectory.joint_trajectory.points) > 0:
+            if self.time_parameterization is not None:
+                res.planned_trajectory.joint_trajectory = self.time_parameterization.retime_msg(
+                    res.planned_trajectory.joint_trajectory, velocity, acceleration)
+
             disp = DisplayTrajectory()
             disp.trajectory.append(res.planned_trajectory)
             disp.trajectory_start = res.trajectory_start
@@ -392,7 +657,7 @@ class CostarArm(CostarComponent):
 
             if stamp is not None:
                 rospy.loginfo("Sending trajectory of length " + str(len(traj.points)))
-                res = self.send_trajectory(traj,stamp,acceleration,velocity,cartesian=False)
+                res = self.execute_trajectory(traj,stamp,acceleration,velocity).wait()
             else:
                 res = 'FAILURE -- could not preempt current arm control.'
 
@@ -425,6 +690,94 @@ class CostarArm(CostarComponent):
             rospy.logerr('DRIVER -- not in servo mode!')
             return 'FAILURE -- not in servo mode'
 
+    '''
+    Where the next motion will start: the end of the trajectory that is
+    executing, or the current position if the robot is not moving.
+    '''
+    def predicted_start(self):
+        with self.execution_mtx:
+            execution = self.execution
+        if execution is not None and not execution.done():
+            return execution.end_position
+        return self.q0
+
+    '''
+    Plan ahead for the next motion while the current one executes: start
+    planning to the goal (a kdl frame or joint positions) from where the
+    current trajectory ends. When the next planning call asks for about the
+    same goal from about that position, it reuses the plan if the plan is
+    still valid.
+    '''
+    def prefetch_plan(self,frame=None,q_goal=None,obj=None):
+        q_start = self.predicted_start()
+        if q_start is None:
+            return 'FAILURE -- robot state not yet received'
+        if not self.planner.prefetchPlan(q_start, frame=frame, q_goal=q_goal, obj=obj):
+            return 'FAILURE -- not planning ahead (no plan cache, or already planning to this goal)'
+        return 'SUCCESS -- planning ahead'
+
+    def prefetch_plan_cb(self,req):
+        obj = req.obj if len(req.obj) > 0 else None
+        if len(req.joints.position) > 0:
+            return self.prefetch_plan(q_goal=list(req.joints.position),obj=obj)
+        return self.prefetch_plan(frame=pm.fromMsg(req.target),obj=obj)
+
+    '''
+    Plan ahead for a smartmove: choose the sequences from q_start the way
+    smartmove_multipurpose_gripper will choose them once the robot is there,
+    and plan both legs of the sequences it will plan first.
+    '''
+    def prefetch_smartmove(self, possible_goals, distance, backup_in_gripper_frame, q_start):
+        sequences, backoff_waypoints = self.smartmove_sequences(possible_goals,
+                distance,
+                backup_in_gripper_frame,
+                q_start)
+        started = 0
+        for sequence in sequences[:self.speculative_sequences]:
+            goals = self.sequence_joint_goals(sequence, q_start)
+            if goals is None:
+                continue
+            q_backup, q_grasp = goals
+            obj = sequence[2]
+            if self.planner.prefetchPlan(q_start, q_goal=q_backup):
+                started += 1
+            if self.planner.prefetchPlan(list(q_backup), q_goal=q_grasp, obj=obj):
+                started += 1
+        if started == 0:
+            return 'FAILURE -- not planning ahead (no plan cache, no reachable sequence, or already planning to these goals)'
+        return 'SUCCESS -- planning ahead for %d motions'%started
+
+    '''
+    Plan ahead for the SmartGrasp and SmartRelease requests req; the
+    candidates are found and ranked from where the current motion ends.
+    '''
+    def prefetch_smartmove_grasp_cb(self, req):
+        return self.prefetch_smartmove_query(req, True)
+
+    def prefetch_smartmove_release_cb(self, req):
+        return self.prefetch_smartmove_query(req, False)
+
+    def prefetch_smartmove_query(self, req, backup_in_gripper_frame):
+        q_start = self.predicted_start()
+        if q_start is None:
+            return 'FAILURE -- robot state not yet received'
+        list_of_waypoints = self.query(req, True, q0=q_start)
+        if len(list_of_waypoints) == 0:
+            return 'FAILURE -- no suitable waypoints found to plan ahead for'
+        return self.prefetch_smartmove(list_of_waypoints, req.backoff, backup_in_gripper_frame, q_start)
+
+    '''
+    Plan ahead for the SmartPlace request req.
+    '''
+    def prefetch_smartmove_place_cb(self, req):
+        q_start = self.predicted_start()
+        if q_start is None:
+            return 'FAILURE -- robot state not yet received'
+        T_base_world = pm.fromTf(self.listener.lookupTransform(self.world,self.base_link,rospy.Time(0)))
+        T = T_base_world.Inverse()*pm.fromMsg(req.pose)
+        list_of_waypoints = [(0.,T,req.name,str(req.name)+"_goal")]
+        return self.prefetch_smartmove(list_of_waypoints, req.backoff, False, q_start)
+
     '''
     Definitely do a planned motion to the home joint state.
     '''
@@ -454,6 +807,80 @@ class CostarArm(CostarComponent):
         rospy.logerr("Function 'send_trajectory' not implemented for base class!")
         return "FAILURE -- running base class!"
 
+    '''
+    Start sending a trajectory to the robot in the background and return the
+    TrajectoryExecution. wait() on it blocks until the robot is done; in the
+    meantime the next motion can be planned starting from its end_position.
+    '''
+    def execute_trajectory(self,traj,stamp,acceleration=0.5,velocity=0.5,cartesian=False,point_times=None):
+        if self.trajectory_compressor is not None and len(traj.points) > 2:
+            traj = self.trajectory_compressor.compress_msg(traj)
+            stats = self.trajectory_compressor.stats
+            if len(stats) > 0:
+                rospy.loginfo("Compressed trajectory from %d to %d points (%.1fx, max error %.2g rad)"%(
+                    stats['points'], stats['kept_points'], stats['ratio'], stats['max_error']))
+        execution = TrajectoryExecution(traj,
+                lambda: self.send_trajectory(traj,stamp,acceleration,velocity,cartesian=cartesian),
+                point_times=point_times)
+        with self.execution_mtx:
+            self.execution = execution
+        return execution.start()
+
+    '''
+    Stop the trajectory that is currently executing, if any.
+    '''
+    def cancel_execution(self):
+        self.acquire()
+
+    '''
+    ExecuteTrajectory action: follow a planned trajectory, publishing the
+    progress every 0.1 s. Cancelling the goal stops the robot.
+    '''
+    def execute_trajectory_action_cb(self,goal):
+        if not self.driver_status == 'SERVO':
+            rospy.logerr('DRIVER -- Not in servo mode!')
+            self.execute_server.set_aborted(ExecuteTrajectoryResult(ack='FAILURE -- not in servo mode'))
+            return
+        if len(goal.trajectory.points) == 0:
+            self.execute_server.set_aborted(ExecuteTrajectoryResult(ack='FAILURE -- no trajectory points'))
+            return
+
+        (acceleration, velocity) = self.check_req_speed_params(goal)
+        stamp = self.acquire()
+        if stamp is None:
+            self.execute_server.set_aborted(ExecuteTrajectoryResult(ack='FAILURE -- could not preempt current arm control.'))
+            return
+
+        # the feedback refers to the points of the goal, which are reached
+        # at other times after retiming; compression keeps the times
+        traj = goal.trajectory
+        point_times = [pt.time_from_start.to_sec() for pt in traj.points]
+        if self.time_parameterization is not None:
+            traj = self.time_parameterization.retime_msg(traj, velocity, acceleration)
+            point_times = retimed_point_times(np.array([pt.positions for pt in goal.trajectory.points]),
+                    [pt.time_from_start.to_sec() for pt in traj.points])
+        execution = self.execute_trajectory(traj,stamp,acceleration,velocity,point_times=point_times)
+
+        rate = rospy.Rate(10)
+        while not execution.done():
+            if self.execute_server.is_preempt_requested() or rospy.is_shutdown():
+                if self.valid_verify(stamp):
+                    self.cancel_execution()
+                execution.wait()
+                self.execute_server.set_preempted(ExecuteTrajectoryResult(ack='FAILURE -- preempted'))
+                return
+            (progress, time_remaining, segment) = execution.feedback()
+            self.execute_server.publish_feedback(ExecuteTrajectoryFeedback(progress=progress,
+                time_remaining=time_remaining,
+                segment=segment))
+            rate.sleep()
+
+        ack = str(execution.result)
+        if ack[0:7] == 'SUCCESS':
+            self.execute_server.set_succeeded(ExecuteTrajectoryResult(ack=ack))
+        else:
+            self.execute_server.set_aborted(ExecuteTrajectoryResult(ack=ack))
+
     def info(self, msg, object_name):
         self.info_pub.publish(data=msg)
         self.object_pub.publish(data=object_name)
@@ -485,7 +912,7 @@ class CostarArm(CostarComponent):
             if len(traj.points) > 0:
                 if stamp is not None:
                     rospy.logwarn("Robot moving to " + str(traj.points[-1].positions))
-                    res = self.send_trajectory(traj,stamp,acceleration,velocity,cartesian=False)
+                    res = self.execute_trajectory(traj,stamp,acceleration,velocity).wait()
                     self.release()
                 else:
                     res = 'FAILURE -- could not preempt current arm control.'
@@ -497,6 +924,187 @@ class CostarArm(CostarComponent):
             rospy.logerr('SIMPLE DRIVER -- Not in servo mode')
             return 'FAILURE -- not in servo mode'
 
+    '''
+    Follow a list of timed poses (e.g. a DMP plan) as one joint trajectory,
+    instead of one ServoToPose call per pose.
+    '''
+    def execute_cartesian_path_cb(self,req):
+        if self.driver_status != 'SERVO':
+            rospy.logerr('SIMPLE DRIVER -- Not in servo mode')
+            return 'FAILURE -- not in servo mode'
+        if len(req.poses) == 0 or len(req.poses) != len(req.times):
+            return 'FAILURE -- need one time for every pose'
+
+        (acceleration, velocity) = self.check_req_speed_params(req)
+        stamp = self.acquire()
+        if stamp is None:
+            return 'FAILURE -- could not preempt current arm control.'
+
+        poses = [pm.toMatrix(pm.fromMsg(pose)) for pose in req.poses]
+        traj, failure_index = self.planner.getTimedCartesianPath(poses,
+                req.times,
+                self.q0,
+                time_multiplier = (1./velocity))
+        if traj is None:
+            self.release()
+            return 'FAILURE -- no IK solution for pose %d of the path'%failure_index
+
+        rospy.loginfo("Following a Cartesian path of %d points for %.2f s"%(
+            len(traj), traj.times[-1]))
+        res = self.execute_trajectory(traj.to_msg(),stamp,acceleration,velocity).wait()
+        self.release()
+        return res
+
+    '''
+    Move through a list of waypoints without stopping at each one: joint
+    positions, or end effector poses (4x4 matrices in the base frame) if
+    cartesian is set. The corner at waypoint k is rounded off within
+    blend_radii[k] (radians or meters); a radius of zero stops there. The
+    whole motion is planned, checked for collisions and executed as a single
+    trajectory under one preemption stamp.
+    '''
+    def servo_to_waypoints(self,waypoints,blend_radii,cartesian,acceleration,velocity):
+        stamp = self.acquire()
+        if stamp is None:
+            return 'FAILURE -- could not preempt current arm control.'
+
+        if cartesian:
+            traj, failure_index = self.planner.getBlendedCartesianPath(
+                    [pm.fromMatrix(T) for T in waypoints],
+                    blend_radii,
+                    self.q0,
+                    time_multiplier = (1./velocity),
+                    percent_acc = acceleration)
+            if traj is None:
+                self.release()
+                return 'FAILURE -- no IK solution on the way to waypoint %d'%failure_index
+        else:
+            traj = self.planner.getBlendedJointMove(waypoints,
+                    blend_radii,
+                    self.q0,
+                    time_multiplier = (1./velocity),
+                    percent_acc = acceleration)
+            if traj is None:
+                self.release()
+                return 'FAILURE -- no trajectory points'
+
+        if len(traj) < 2:
+            self.release()
+            return 'SUCCESS -- already at every waypoint'
+
+        # without the local collision checker every position is a service
+        # call, so only check a subset of the path (always with the end)
+        positions = traj.positions
+        if self.collision_checker is None:
+            stride = int(np.ceil(len(positions) / 50.))
+            if (len(positions) - 1) % stride == 0:
+                positions = positions[::stride]
+            else:
+                positions = np.vstack((positions[::stride], positions[-1:]))
+        valid = self.check_plan_validity(positions)
+        if not all(valid):
+            self.release()
+            return 'FAILURE -- waypoint path is in collision'
+
+        rospy.loginfo("Moving through %d waypoints in %.2f s"%(len(waypoints), traj.times[-1]))
+        res = self.execute_trajectory(traj.to_msg(),stamp,acceleration,velocity).wait()
+        self.release()
+        return res
+
+    def servo_to_waypoints_cb(self,req):
+        if self.driver_status != 'SERVO':
+            rospy.logerr('SIMPLE DRIVER -- Not in servo mode')
+            return 'FAILURE -- not in servo mode'
+        if len(req.poses) > 0 and len(req.joints) > 0:
+            return 'FAILURE -- give either poses or joint states as waypoints'
+
+        cartesian = len(req.poses) > 0
+        if cartesian:
+            waypoints = [pm.toMatrix(pm.fromMsg(pose)) for pose in req.poses]
+        else:
+            waypoints = []
+            for js in req.joints:
+                if len(js.position) != self.dof:
+                    return 'FAILURE -- every joint waypoint needs %d positions'%self.dof
+                # joint states without names are in the order of joint_names
+                if len(js.name) == 0:
+                    waypoints.append(np.array(js.position))
+                elif sorted(js.name) == sorted(self.joint_names):
+                    position = dict(zip(js.name, js.position))
+                    waypoints.append(np.array([position[name] for name in self.joint_names]))
+                else:
+                    return 'FAILURE -- joint waypoints must name the joints %s'%(', '.join(self.joint_names))
+        if len(waypoints) == 0:
+            return 'FAILURE -- no waypoints'
+        blend_radii = waypoint_distances(req.blend_radii, len(waypoints))
+        if blend_radii is None:
+            return 'FAILURE -- need one blend radius for every waypoint'
+
+        (acceleration, velocity) = self.check_req_speed_params(req)
+        return self.servo_to_waypoints(waypoints,blend_radii,cartesian,acceleration,velocity)
+
+    '''
+    Estimated durations (seconds) of straight joint moves from q_start to
+    each of the joint positions in goals, then to the closest IK solution of
+    each of the 4x4 poses (inf if there is none), timed like servo moves.
+    '''
+    def estimate_move_times(self,q_start,goals=[],poses=[],acceleration=1.,velocity=1.):
+        times = []
+        if len(goals) > 0:
+            times.extend(self.planner.estimateMoveTimes(goals,
+                    q_start,
+                    self.base_steps,
+                    0,
+                    self.steps_per_radians,
+                    time_multiplier = (1./velocity),
+                    percent_acc = acceleration))
+        if len(poses) > 0:
+            pose_times = np.full(len(poses), np.inf)
+            qs = [self.ik(T, q_start) for T in poses]
+            reachable = [i for i, q in enumerate(qs) if q is not None]
+            if len(reachable) > 0:
+                T_start = self.kinematics.forward(q_start)
+                pose_times[reachable] = self.planner.estimateMoveTimes([qs[i] for i in reachable],
+                        q_start,
+                        self.base_steps,
+                        self.steps_per_meter,
+                        self.steps_per_radians,
+                        time_multiplier = (1./velocity),
+                        percent_acc = acceleration,
+                        delta_translation = np.array([np.linalg.norm(poses[i][0:3,3] - T_start[0:3,3])
+                            for i in reachable]))
+            times.extend(pose_times)
+        return np.array(times)
+
+    '''
+    Score candidate motions by how long they would take, without executing
+    them: moves to goal joint states or poses, or a whole trajectory.
+    '''
+    def estimate_cycle_time_cb(self,req):
+        (acceleration, velocity) = self.check_req_speed_params(req)
+        if acceleration <= 0 or velocity <= 0:
+            return EstimateCycleTimeResponse(ack='FAILURE -- accel and vel must be positive')
+
+        if len(req.trajectory.points) > 0:
+            t = self.planner.estimatePathTime([pt.positions for pt in req.trajectory.points],
+                    time_multiplier = (1./velocity),
+                    percent_acc = acceleration)
+            return EstimateCycleTimeResponse(times=[t], ack='SUCCESS -- estimated trajectory time')
+
+        q_start = self.q0
+        if len(req.start.position) > 0:
+            q_start = np.array(req.start.position)
+        if q_start is None:
+            return EstimateCycleTimeResponse(ack='FAILURE -- robot state not yet received')
+
+        times = self.estimate_move_times(q_start,
+                [np.array(js.position) for js in req.goals],
+                [pm.toMatrix(pm.fromMsg(pose)) for pose in req.poses],
+                acceleration,
+                velocity)
+        return EstimateCycleTimeResponse(times=times.tolist(),
+                ack='SUCCESS -- estimated %d move times'%len(times))
+
     def servo_to_home_cb(self,req):
         if self.driver_status == 'SERVO':
 
@@ -520,7 +1128,7 @@ class CostarArm(CostarComponent):
             if len(traj.points) > 0:
                 if stamp is not None:
                     rospy.logwarn("Robot moving to " + str(traj.points[-1].positions))
-                    res = self.send_trajectory(traj,stamp,acceleration,velocity,cartesian=False)
+                    res = self.execute_trajectory(traj,stamp,acceleration,velocity).wait()
                     self.release()
                 else:
                     res = 'FAILURE -- could not preempt current arm control.'
@@ -555,7 +1163,7 @@ class CostarArm(CostarComponent):
             if len(traj.points) > 0:
                 if stamp is not None:
                     rospy.logwarn("Robot moving to " + str(traj.points[-1].positions))
-                    res = self.send_trajectory(traj,stamp,acceleration,velocity,cartesian=False)
+                    res = self.execute_trajectory(traj,stamp,acceleration,velocity).wait()
                     self.release()
                 else:
                     res = 'FAILURE -- could not preempt current arm control.'
@@ -605,6 +1213,82 @@ class CostarArm(CostarComponent):
 
         self.pt_publisher.publish(pt)
 
+    '''
+    send one servo setpoint: joint positions q and velocities dq, valid for
+    period seconds. Robots with a velocity interface can override this.
+    '''
+    def send_servo(self,q,dq,period):
+        pt = JointTrajectoryPoint(positions=q.tolist(),
+                velocities=dq.tolist(),
+                time_from_start=rospy.Duration(period))
+        self.pt_publisher.publish(pt)
+
+    '''
+    Transform from frame_id to the base link as a 4x4 matrix; identity for
+    an empty frame_id. None if TF does not know the transform.
+    '''
+    def servo_frame(self, frame_id):
+        if frame_id in ("", self.base_link, "/" + self.base_link):
+            return np.eye(4)
+        try:
+            trans, rot = self.listener.lookupTransform(self.base_link, frame_id, rospy.Time(0))
+        except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException), e:
+            rospy.logwarn(str(e))
+            return None
+        return pm.toMatrix(pm.fromTf((trans, rot)))
+
+    '''
+    Streaming servo input: end effector velocity (linear and angular).
+    '''
+    def servo_twist_cb(self, msg):
+        T = self.servo_frame(msg.header.frame_id)
+        if T is None:
+            return
+        v = T[0:3,0:3].dot([msg.twist.linear.x, msg.twist.linear.y, msg.twist.linear.z])
+        w = T[0:3,0:3].dot([msg.twist.angular.x, msg.twist.angular.y, msg.twist.angular.z])
+        if self.cartesian_servo.set_velocity(np.concatenate((v, w))):
+            self.start_servo()
+
+    '''
+    Streaming servo input: end effector pose target.
+    '''
+    def servo_pose_cb(self, msg):
+        T = self.servo_frame(msg.header.frame_id)
+        if T is None:
+            return
+        if self.cartesian_servo.set_target(T.dot(pm.toMatrix(pm.fromMsg(msg.pose)))):
+            self.start_servo()
+
+    '''
+    Start the servo loop for the current command unless it is running.
+    Like a trajectory, it takes over the arm with acquire(), and it stops as
+    soon as anything else does.
+    '''
+    def start_servo(self):
+        if self.driver_status != 'SERVO' or self.q0 is None:
+            self.cartesian_servo.clear()
+            rospy.logwarn_throttle(1.0, 'SIMPLE DRIVER -- Not in servo mode, ignoring servo command')
+            return
+        with self.servo_mtx:
+            if self.servo_thread is not None and self.servo_thread.is_alive():
+                return
+            stamp = self.acquire()
+            if stamp is None:
+                self.cartesian_servo.clear()
+                return
+            self.servo_thread = Thread(target=self.servo_loop, args=(stamp,))
+            self.servo_thread.daemon = True
+            self.servo_thread.start()
+
+    def servo_loop(self, stamp):
+        res = self.cartesian_servo.run(self.q0,
+                lambda: self.valid_verify(stamp) and self.driver_status == 'SERVO',
+                lambda: self.q0)
+        self.set_goal(self.cartesian_servo.q)
+        self.release()
+        rospy.loginfo("Servo loop finished after %d cycles: %s"%(
+            self.cartesian_servo.stats['cycles'], res))
+
     def enable_collision_cb(self, msg):
         self.planner.updateAllowedCollisions(msg.object,False)
         return "SUCCESS"
@@ -612,25 +1296,9 @@ class CostarArm(CostarComponent):
     def disable_collision_cb(self, msg):
         rospy.logerr("DISABLING COLLISIONS WITH" + str(msg))
         self.planner.updateAllowedCollisions(msg.object,True)
-        remove_object = None
-
-        res = self.get_planning_scene(components=
-            PlanningSceneComponents(components=PlanningSceneComponents.WORLD_OBJECT_GEOMETRY))
-        all_objects = res.scene.world.collision_objects
-        for col_obj in all_objects:
-            if col_obj.id == msg.object:
-                remove_object = col_obj
-                break
 
         # self.planning_group.attachObject(object_name, self.end_link)
-        if remove_object is not None:
-            self.planning_scene_publisher = rospy.Publisher('planning_scene', PlanningScene, queue_size = 10)
-            planning_scene_diff = PlanningScene(is_diff=True)
-            remove_object.operation = CollisionObject.REMOVE
-            del planning_scene_diff.world.collision_objects[:];
-            planning_scene_diff.world.collision_objects.append(copy.deepcopy(remove_object));
-
-            self.planning_scene_publisher.publish(planning_scene_diff)
+        self.planning_scene.removeObject(msg.object)
         return "SUCCESS"
 
     '''
@@ -661,7 +1329,13 @@ class CostarArm(CostarComponent):
     '''
     # TODO: Modify this part
     def handle_tick(self):
-        br = tf.TransformBroadcaster()
+        pass
+
+    '''
+    Broadcast the frames this arm provides; called on a timer at tf_rate.
+    '''
+    def broadcast_tf(self):
+        br = self.broadcaster
         br.sendTransform((0,0,0),tf.transformations.quaternion_from_euler(0,0,0),rospy.Time.now(),"/endpoint",self.end_link)
         if not self.base_link == "base_link":
             br.sendTransform((0,0,0),tf.transformations.quaternion_from_euler(0,0,0),rospy.Time.now(),"/base_link",self.base_link)
@@ -676,11 +1350,18 @@ class CostarArm(CostarComponent):
                     trans, rot = pm.toTf(transform)
                     br.sendTransform(trans, rot, rospy.Time.now(),tf_name,self.world)
 
+    def tf_timer_cb(self, event):
+        self.broadcast_tf()
+
+    '''
+    Look up the table pose; called on a timer at table_rate. Keeps the last
+    known pose if the transform is not available right now.
+    '''
+    def table_timer_cb(self, event):
         if self.table_frame is not None:
-            self.listener.waitForTransform(self.world, self.table_frame, rospy.Time(), rospy.Duration(1.0))
             try:
                 self.table_pose = self.listener.lookupTransform(self.world, self.table_frame, rospy.Time(0))
-            except tf.ExtrapolationException, e:
+            except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException), e:
                 rospy.logwarn(str(e))
 
     '''
@@ -688,9 +1369,45 @@ class CostarArm(CostarComponent):
     '''
     def tick(self):
         self.status_pub.publish(self.driver_status)
-        self.update_position()
         self.handle_tick()
 
+    '''
+    Load the plans stored with the librarian under plan_cache_id.
+    '''
+    def load_plan_cache(self):
+        try:
+            rospy.wait_for_service('/librarian/add_type',5)
+            rospy.wait_for_service('/librarian/load',5)
+            self.add_type_service = rospy.ServiceProxy('/librarian/add_type', librarian_msgs.srv.AddType)
+            self.save_service = rospy.ServiceProxy('/librarian/save', librarian_msgs.srv.Save)
+            self.load_service = rospy.ServiceProxy('/librarian/load', librarian_msgs.srv.Load)
+            self.add_type_service(self.plan_cache_folder)
+            text = self.load_service(id=self.plan_cache_id,type=self.plan_cache_folder).text
+            if len(text) > 0:
+                self.plan_cache.from_yaml(text, self.planner.sceneSignature())
+            rospy.loginfo("Loaded %d cached plans."%len(self.plan_cache.plans))
+        except (rospy.ROSException, rospy.ServiceException), e:
+            rospy.logwarn("Could not load plan cache: %s"%str(e))
+            self.plan_cache_id = None
+
+    '''
+    Save the plan cache; called on a timer every plan_cache_save_period
+    seconds, so the YAML dump and the service call stay out of tick().
+    '''
+    def plan_cache_timer_cb(self, event):
+        self.save_plan_cache()
+
+    '''
+    Store the plan cache with the librarian if it changed since the last save.
+    '''
+    def save_plan_cache(self):
+        if self.plan_cache is None or self.plan_cache_id is None or not self.plan_cache.modified:
+            return
+        try:
+            self.save_service(id=self.plan_cache_id,type=self.plan_cache_folder,text=self.plan_cache.to_yaml())
+        except rospy.ServiceException, e:
+            rospy.logwarn("Could not save plan cache: %s"%str(e))
+
     '''
     call this to get rough estimate whether the input robot configuration is in collision or not
     '''
@@ -710,6 +1427,76 @@ class CostarArm(CostarComponent):
 
             return self.state_validity_service.call(get_state_validity_req)
 
+    '''
+    call this to get rough estimates for a whole list of robot configurations at once
+    uses the local collision checker if there is one, otherwise the MoveIt service
+    '''
+    def check_robot_position_validity_batch(self, robot_joint_positions, padding=None):
+        if self.collision_checker is None or len(robot_joint_positions) == 0:
+            return [self.check_robot_position_validity(list(q)) for q in robot_joint_positions]
+        return self.collision_checker.check_state_validity(np.array(robot_joint_positions), padding)
+
+    '''
+    Copy the current world geometry from the planning scene into the local collision checker.
+    '''
+    def update_collision_scene(self):
+        if self.collision_checker is None:
+            return
+        all_objects = self.planning_scene.getCollisionObjects()
+        frame_transforms = {}
+        for col_obj in all_objects:
+            frame = col_obj.header.frame_id.strip('/')
+            if frame in frame_transforms:
+                continue
+            try:
+                frame_transforms[frame] = pm.toMatrix(pm.fromTf(
+                    self.listener.lookupTransform(self.base_link, frame, rospy.Time(0))))
+            except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException), e:
+                rospy.logwarn("Could not place collision objects in %s: %s"%(frame,str(e)))
+        self.collision_checker.set_objects(all_objects, frame_transforms)
+
+    '''
+    Collision recheck for cached plans: one bool per row of robot_joint_positions.
+    Contacts with obj_name are ignored. padding overrides the padding of the
+    local collision checker.
+    '''
+    def check_plan_validity(self, robot_joint_positions, obj_name=None, padding=None):
+        with self.collision_scene_mtx:
+            self.update_collision_scene()
+            results = self.check_robot_position_validity_batch(robot_joint_positions, padding)
+        return [self.ignore_object_contacts(result, obj_name).valid for result in results]
+
+    '''
+    Check every position of a joint space path with the MoveIt state validity
+    service, which also knows about self collisions, the gripper and attached
+    objects. Contacts with obj_name are ignored. Stops at the first invalid
+    position.
+    '''
+    def check_path_validity(self, robot_joint_positions, obj_name=None):
+        for q in robot_joint_positions:
+            result = self.check_robot_position_validity(list(q))
+            if not self.ignore_object_contacts(result, obj_name).valid:
+                return False
+        return True
+
+    '''
+    A collision with obj_name itself does not make a pose invalid; we are going to
+    pick it up or put it down. Updates result.valid accordingly.
+    '''
+    def ignore_object_contacts(self, result, obj_name):
+        if obj_name is not None and not result.valid:
+            other_obj_collision = False
+            contacts = result.contacts
+            for collision in contacts:
+                if collision.contact_body_1 != obj_name and collision.contact_body_2 != obj_name:
+                    other_obj_collision = True
+                    break
+            # if not other_obj_collision:
+            #     rospy.logwarn('[Query] State Pose is actually valid')
+            #     rospy.logwarn(str(contacts))
+            result.valid = not other_obj_collision
+        return result
+
     '''
     Attach an object to the planning scene.
 
@@ -720,35 +1507,10 @@ class CostarArm(CostarComponent):
             # attach the collision object to the gripper
             self.gripper_close.call()
 
-        # get the actual collision obj from planning scene
-        remove_object = None
-
+        # move the collision obj from the world onto the gripper
         rospy.logwarn('Attaching object: %s'% object_name)
-        res = self.get_planning_scene(components=
-            PlanningSceneComponents(components=PlanningSceneComponents.WORLD_OBJECT_GEOMETRY))
-        all_objects = res.scene.world.collision_objects
-        for col_obj in all_objects:
-            if col_obj.id == object_name:
-                remove_object = col_obj
-                break
-
         # self.planning_group.attachObject(object_name, self.end_link)
-        if remove_object is not None:
-            self.planning_scene_publisher = rospy.Publisher('planning_scene', PlanningScene, queue_size = 10)
-            planning_scene_diff = PlanningScene(is_diff=True)
-            remove_object.operation = CollisionObject.REMOVE
-            del planning_scene_diff.world.collision_objects[:];
-            planning_scene_diff.world.collision_objects.append(copy.deepcopy(remove_object));
-
-            attached_object = AttachedCollisionObject()
-            attached_object.object = remove_object
-            attached_object.link_name = self.end_link
-            attached_object.object.header.frame_id = self.joint_names[-1]
-            attached_object.object.operation = CollisionObject.ADD
-            del planning_scene_diff.robot_state.attached_collision_objects[:];
-            planning_scene_diff.robot_state.attached_collision_objects.append(attached_object);
-
-            self.planning_scene_publisher.publish(planning_scene_diff)
+        self.planning_scene.attachObject(object_name, self.end_link, self.joint_names[-1])
 
     '''
     Detach an object from the planning scene.
@@ -758,14 +1520,11 @@ class CostarArm(CostarComponent):
             # detach the collision object to the gripper
             self.gripper_open.call()
         # self.planning_group.detachObject(object_name, self.end_link)
-        self.planning_scene_publisher = rospy.Publisher('planning_scene', PlanningScene, queue_size=100)
         planning_scene_diff = PlanningScene(is_diff=True)
-        T_fwd = pm.fromMatrix(self.kdl_kin.forward(self.q0))
+        T_fwd = pm.fromMatrix(self.kinematics.forward(self.q0))
 
         # get the actual collision obj from planning scene
-        res = self.get_planning_scene(components=
-            PlanningSceneComponents(components=PlanningSceneComponents.ROBOT_STATE_ATTACHED_OBJECTS))
-        all_objects = res.scene.robot_state.attached_collision_objects
+        all_objects = self.planning_scene.getAttachedObjects()
         for col_obj in all_objects:
             rospy.logwarn(str(object_name)+", "+str(col_obj.link_name)+", "+str(col_obj.object.id))
 
@@ -798,20 +1557,24 @@ class CostarArm(CostarComponent):
 
         # add_object = CollisionObject()
 
-        self.planning_scene_publisher.publish(planning_scene_diff)
+        if len(all_objects) > 0:
+            self.planning_scene.publish(planning_scene_diff)
     '''
     Calculate the best distance between current joint position to the target pose given a IK solution or list of IK solutions
+    ik_solutions can hold the precomputed IK solutions for T (see ik_batch).
     '''
-    def get_best_distance(self, T, T_fwd, q0, check_closest_only = False, obj_name = None):
+    def get_best_distance(self, T, T_fwd, q0, check_closest_only = False, obj_name = None, ik_solutions = None):
         quaternion_dot = np.dot(np.array(T_fwd.M.GetQuaternion()),np.array(T.M.GetQuaternion()))
         delta_rotation = np.arccos(2 * quaternion_dot ** 2 - 1)
 
         q_new = list()
 
-        if self.closed_form_IK_solver == None or check_closest_only:
-            q_new.append(self.ik(pm.toMatrix(T),self.q0))
+        if ik_solutions is not None and not check_closest_only:
+            q_new = ik_solutions
+        elif self.closed_form_IK_solver == None or check_closest_only:
+            q_new.append(self.ik(pm.toMatrix(T),q0))
         else:
-            q_new = self.closed_form_IK_solver.solveIK(pm.toMatrix(T))
+            q_new = self.kinematics.solve_ik(pm.toMatrix(T))
 
         if q_new is not None and len(q_new) > 0:
             message_print = ''
@@ -822,29 +1585,29 @@ class CostarArm(CostarComponent):
             best_q = None
             best_q_invalid = None
 
-            for q_i in q_new:
-                if q_i is None:
-                    continue
-                dq = np.absolute(q_i - self.q0) * self.joint_weights
-                combined_distance = (T.p - T_fwd.p).Norm() * self.translation_weight + \
-                      self.rotation_weight * delta_rotation + \
-                      self.joint_space_weight * np.sum(dq)
+            q_new = [q_i for q_i in q_new if q_i is not None]
+            results = self.check_robot_position_validity_batch(q_new)
+
+            move_times = None
+            if self.rank_by_time and len(q_new) > 0:
+                move_times = self.planner.estimateMoveTimes(q_new,
+                        q0,
+                        self.base_steps,
+                        self.steps_per_meter,
+                        self.steps_per_radians,
+                        delta_translation = (T.p - T_fwd.p).Norm())
+
+            for i, (q_i, result) in enumerate(zip(q_new, results)):
+                dq = np.absolute(q_i - q0) * self.joint_weights
+                if move_times is not None:
+                    combined_distance = move_times[i]
+                else:
+                    combined_distance = (T.p - T_fwd.p).Norm() * self.translation_weight + \
+                          self.rotation_weight * delta_rotation + \
+                          self.joint_space_weight * np.sum(dq)
 
                 # rospy.loginfo(str(q_i))
-                result = self.check_robot_position_validity(q_i.tolist())
-
-                other_obj_collisions = ''
-                if obj_name is not None and not result.valid:
-                    other_obj_collision = False
-                    contacts = result.contacts
-                    for collision in contacts:
-                        if collision.contact_body_1 != obj_name and collision.contact_body_2 != obj_name:
-                            other_obj_collision = True
-                            break
-                    # if not other_obj_collision:
-                    #     rospy.logwarn('[Query] State Pose is actually valid')
-                    #     rospy.logwarn(str(contacts))
-                    result.valid = not other_obj_collision
+                self.ignore_object_contacts(result, obj_name)
                 # ik_joint_solution_validity += '%s ' % result.valid
 
                 if result.valid and combined_distance < best_dist:
@@ -870,11 +1633,12 @@ class CostarArm(CostarComponent):
 
         return False, float('inf'), float('inf'), '%s: No valid IK solution'%obj_name,'%s: No valid IK solution'%obj_name, list()
 
-    def query(self, req, disable_target_object_collision = False):
+    def query(self, req, disable_target_object_collision = False, q0 = None):
         # Get the best object to manipulate, just like smart move, but without the actual movement
         # This will check robot collision and reachability on all possible object grasp position based on its symmetry.
         # Then, it will returns one of the best symmetry to work with for grasp and release.
         # it will be put on parameter server
+        # Candidates are ranked for a motion from q0 (the current position by default).
 
         # Find possible poses
         res = self.get_waypoints_srv.get_waypoints(
@@ -898,44 +1662,89 @@ class CostarArm(CostarComponent):
         selected_objs, selected_names = [], []
         dists = []
         Ts = []
-        if self.q0 is None:
+        qs = []
+        if q0 is None:
+            q0 = self.q0
+        if q0 is None:
             rospy.logerr("Robot state has not yet been received!")
             return "FAILURE -- robot state not yet received!"
-        T_fwd = pm.fromMatrix(self.kdl_kin.forward(self.q0))
+        T_fwd = pm.fromMatrix(self.kinematics.forward(q0))
+        self.update_collision_scene()
 
         number_of_valid_query_poses, number_of_invalid_query_poses = 0, 0
-        for (pose,name,obj) in zip(poses,names,objects):
-
-            # figure out which tf frame we care about
-            tf_path = name.split('/')
-            tf_frame = ''
-            for part in tf_path:
-                if len(part) > 0:
-                    tf_frame = part
-                    break
-
-            if len(tf_frame) == 0:
-                continue
 
-            # try to move to the pose until one succeeds
-            T_base_world = pm.fromTf(self.listener.lookupTransform(self.world,self.base_link,rospy.Time(0)))
-            T = T_base_world.Inverse()*pm.fromMsg(pose)
+        # Only keep poses that belong to an actual tf frame
+        candidates = [(pose,name,obj) for (pose,name,obj) in zip(poses,names,objects)
+                if len([part for part in name.split('/') if len(part) > 0]) > 0]
+        if len(candidates) == 0:
+            rospy.loginfo("[QUERY] There are no poses with a valid frame name")
+            return []
 
-            # Ignore anything below the table: we don't need to even bother
-            # checking that position.
-            if self.table_pose is not None:
-                if T.p[2] < self.table_pose[0][2]:
-                    rospy.logwarn("[QUERY] Ignoring due to relative z: %f < %f x=%f y=%f %s"%(T.p[2],self.table_pose[0][2],T.p[0],T.p[1], obj))
-                    continue
-                dist_from_table = (T.p - pm.Vector(*self.table_pose[0])).Norm()
-            if dist_from_table > self.max_dist_from_table:
+        # Move every pose into the robot base frame at once; the base
+        # transform is the same for the whole query.
+        T_base_world = pm.fromTf(self.listener.lookupTransform(self.world,self.base_link,rospy.Time(0)))
+        T_world_base = np.linalg.inv(pm.toMatrix(T_base_world))
+        frames = np.matmul(T_world_base,
+                np.array([pm.toMatrix(pm.fromMsg(pose)) for (pose,name,obj) in candidates]))
+        positions = frames[:,0:3,3]
+
+        # Ignore anything below the table or too far away from it: we don't
+        # need to even bother checking those positions.
+        keep = np.ones(len(candidates), dtype=bool)
+        if self.table_pose is not None:
+            table_position = np.array(self.table_pose[0])
+            below_table = positions[:,2] < table_position[2]
+            dist_from_table = np.linalg.norm(positions - table_position, axis=1)
+            too_far = np.logical_and(~below_table, dist_from_table > self.max_dist_from_table)
+            for i in np.flatnonzero(below_table):
+                rospy.logwarn("[QUERY] Ignoring due to relative z: %f < %f x=%f y=%f %s"%(
+                    positions[i,2],table_position[2],positions[i,0],positions[i,1],candidates[i][2]))
+            for i in np.flatnonzero(too_far):
                 rospy.logwarn("[QUERY] Ignoring due to table distance: %f > %f"%(
-                    dist_from_table,
+                    dist_from_table[i],
                     self.max_dist_from_table))
-                continue
-
+            keep = np.logical_and(~below_table, ~too_far)
+
+        # Cheap first pass: drop poses the arm cannot reach at all
+        if self.reachability_map is not None:
+            reachable = self.reachability_map.reachable(frames)
+            for i in np.flatnonzero(np.logical_and(keep, ~reachable)):
+                rospy.logwarn("[QUERY] Ignoring unreachable pose x=%f y=%f z=%f %s"%(
+                    positions[i,0],positions[i,1],positions[i,2],candidates[i][2]))
+            keep = np.logical_and(keep, reachable)
+
+        candidates = [(pm.fromMatrix(frames[i]),candidates[i][1],candidates[i][2])
+                for i in np.flatnonzero(keep)]
+
+        # Solve IK for every remaining candidate pose at once
+        ik_solutions = self.ik_batch([T for (T,name,obj) in candidates])
+        if ik_solutions is None:
+            ik_solutions = [None] * len(candidates)
+
+        # Score the candidates in parallel, stopping early if we were asked
+        # to stop after a given number of valid poses.
+        stop_scoring = Event()
+        num_valid = [0]
+        num_valid_mtx = Lock()
+        def score(candidate):
+            (T,name,obj), q_new = candidate
+            if stop_scoring.is_set():
+                return None
             # Get metrics for the best distance to a matching objet
-            valid_pose, best_dist, best_invalid, message_print, message_print_invalid, best_q = self.get_best_distance(T,T_fwd,self.q0, check_closest_only = False, obj_name = obj)
+            result = self.get_best_distance(T,T_fwd,q0, check_closest_only = False, obj_name = obj, ik_solutions = q_new)
+            if result[0] and self.query_max_valid_candidates is not None:
+                with num_valid_mtx:
+                    num_valid[0] += 1
+                    if num_valid[0] >= self.query_max_valid_candidates:
+                        stop_scoring.set()
+            return result
+
+        scores = self.query_pool.map(score, zip(candidates, ik_solutions))
+
+        for (T,name,obj), result in zip(candidates,scores):
+            if result is None:
+                continue
+            valid_pose, best_dist, best_invalid, message_print, message_print_invalid, best_q = result
 
             if best_q is None or len(best_q) == 0:
                 rospy.logwarn("[QUERY] DID NOT ADD:"+message_print)
@@ -943,6 +1752,7 @@ class CostarArm(CostarComponent):
             elif valid_pose:
                 rospy.loginfo('[QUERY] %s'%message_print)
                 Ts.append(T)
+                qs.append(best_q)
                 selected_objs.append(obj)
                 selected_names.append(name)
                 dists.append(best_dist)
@@ -950,11 +1760,15 @@ class CostarArm(CostarComponent):
             else:
                 rospy.loginfo('[QUERY] %s'%message_print_invalid)
                 Ts.append(T)
+                qs.append(best_q)
                 selected_objs.append(obj)
                 selected_names.append(name)
                 dists.append(best_invalid + self.state_validity_penalty)
                 number_of_invalid_query_poses += 1
 
+        if stop_scoring.is_set():
+            rospy.loginfo("[QUERY] Stopped scoring after %i valid poses"%num_valid[0])
+
 
         if len(Ts) is not len(dists):
             raise RuntimeError('You miscounted the number of transforms somehow.')
@@ -966,53 +1780,75 @@ class CostarArm(CostarComponent):
         if len(Ts) == 0:
             possible_goals = []
         else:
-            possible_goals = [(d,T,o,n) for (d,T,o,n) in zip(dists,Ts,selected_objs,selected_names) if T is not None]
-            possible_goals.sort()
+            possible_goals = [(d,T,o,n,q) for (d,T,o,n,q) in zip(dists,Ts,selected_objs,selected_names,qs) if T is not None]
+            possible_goals.sort(key=lambda goal: goal[0])
+
+            if self.collision_checker is not None:
+                # The local collision checker is approximate; confirm the best
+                # few candidates with MoveIt before handing them out.
+                for i, (d,T,o,n,q) in enumerate(possible_goals[:self.moveit_validation_candidates]):
+                    if d >= self.state_validity_penalty:
+                        break
+                    result = self.ignore_object_contacts(self.check_robot_position_validity(list(q)), o)
+                    if not result.valid:
+                        rospy.logwarn("[QUERY] MoveIt rejected %s: %s"%(n,
+                            ' '.join(['(%s and %s)'%(c.contact_body_1,c.contact_body_2) for c in result.contacts])))
+                        possible_goals[i] = (d + self.state_validity_penalty,T,o,n,q)
+                        number_of_valid_query_poses -= 1
+                        number_of_invalid_query_poses += 1
+                possible_goals.sort(key=lambda goal: goal[0])
+
+            possible_goals = [(d,T,o,n) for (d,T,o,n,q) in possible_goals]
 
 
         joint = JointState()
         # joint.position = self.ik(T,self.q0)
         rospy.loginfo("[QUERY] There are %i valid poses and %i invalid poses" %
                 (number_of_valid_query_poses, number_of_invalid_query_poses))
+        rospy.logdebug("[QUERY] kinematics cache: %s"%str(self.kinematics.stats()))
 
         return possible_goals
 
-    def smartmove_multipurpose_gripper(self,
-            stamp,
-            possible_goals,
-            distance,
-            gripper_function,
-            velocity,
-            acceleration,
-            backup_in_gripper_frame):
-        '''
-        Basic function that handles collecting and aggregating smartmoves
-        '''
-
+    '''
+    Candidate sequences for a smartmove from q0, best first: move to a backup
+    waypoint distance away from each of the possible_goals, then to the goal.
+    Every sequence with a valid goal and backup waypoint comes first, then
+    up to five invalid ones. Each sequence is (backup_waypoint, T, obj,
+    backup_dist, query_dist, name). Returns the sequences (None if the robot
+    is preempted; only checked with a stamp) and the named backup and goal
+    frames for debugging.
+    '''
+    def smartmove_sequences(self, possible_goals, distance, backup_in_gripper_frame, q0, stamp=None):
         list_of_valid_sequence = list()
         list_of_invalid_sequence = list()
-        self.backoff_waypoints = []
+        backoff_waypoints = []
 
-        if self.q0 is None:
-            return "FAILURE -- Initial joint position is None"
+        T_fwd = pm.fromMatrix(self.kinematics.forward(q0))
+        self.update_collision_scene()
 
-        T_fwd = pm.fromMatrix(self.kdl_kin.forward(self.q0))
+        backup_waypoints = list()
         for (dist,T,obj,name) in possible_goals:
-            if not self.valid_verify(stamp):
-                rospy.logwarn('Stopping action because robot has been preempted by another process,')
-                return "FAILURE -- Robot has been preempted by another process"
-
-            rospy.loginfo("check: " + str(dist) + " " + str(name))
-
             if backup_in_gripper_frame:
                 backup_waypoint = kdl.Frame(kdl.Vector(-distance,0.,0.))
                 backup_waypoint = T * backup_waypoint
             else:
                 backup_waypoint = kdl.Frame(kdl.Vector(0.,0.,distance))
                 backup_waypoint = backup_waypoint * T
+            backup_waypoints.append(backup_waypoint)
+
+        # Solve IK for every backup waypoint at once
+        backup_ik_solutions = self.ik_batch(backup_waypoints)
+        if backup_ik_solutions is None:
+            backup_ik_solutions = [None] * len(backup_waypoints)
+
+        for (dist,T,obj,name), backup_waypoint, q_new in zip(possible_goals,backup_waypoints,backup_ik_solutions):
+            if stamp is not None and not self.valid_verify(stamp):
+                return None, backoff_waypoints
+
+            rospy.loginfo("check: " + str(dist) + " " + str(name))
 
-            self.backoff_waypoints.append(("%s/%s_backoff/%f"%(obj,name,dist),backup_waypoint))
-            self.backoff_waypoints.append(("%s/%s_grasp/%f"%(obj,name,dist),T))
+            backoff_waypoints.append(("%s/%s_backoff/%f"%(obj,name,dist),backup_waypoint))
+            backoff_waypoints.append(("%s/%s_grasp/%f"%(obj,name,dist),T))
 
             query_backup_message = ''
             if dist < self.state_validity_penalty:
@@ -1020,7 +1856,7 @@ class CostarArm(CostarComponent):
             else:
                 query_backup_message = "invalid query's(dist = %.3f) backup msg"%(dist - self.state_validity_penalty)
 
-            valid_pose, best_backup_dist, best_invalid, message_print, message_print_invalid,best_q = self.get_best_distance(backup_waypoint,T_fwd,self.q0, check_closest_only = False,  obj_name = obj)
+            valid_pose, best_backup_dist, best_invalid, message_print, message_print_invalid,best_q = self.get_best_distance(backup_waypoint,T_fwd,q0, check_closest_only = False,  obj_name = obj, ik_solutions = q_new)
             if best_q is None or len(best_q) == 0:
                 rospy.loginfo('Skipping %s: %s'%(query_backup_message,message_print_invalid))
                 continue
@@ -1036,74 +1872,206 @@ class CostarArm(CostarComponent):
                     rospy.loginfo('Invalid sequence: %s: %s'%(query_backup_message, message_print_invalid))
                     list_of_invalid_sequence.append((backup_waypoint,T,obj,best_invalid,dist,name))
 
-        sequence_to_execute = list()
+        rospy.loginfo('There is %i valid sequence and %i invalid sequence to try'%(len(list_of_valid_sequence),len(list_of_invalid_sequence)))
         if len(list_of_valid_sequence) > 0:
-            sequence_to_execute = list_of_valid_sequence + list_of_invalid_sequence[:5]
+            return list_of_valid_sequence + list_of_invalid_sequence[:5], backoff_waypoints
         else:
             rospy.logwarn("WARNING -- no sequential valid grasp action found")
-            sequence_to_execute = list_of_invalid_sequence[:5]
+            return list_of_invalid_sequence[:5], backoff_waypoints
+
+    '''
+    Joint goals (q_backup, q_grasp) of the two legs of a smartmove sequence
+    that starts at q0, or None if there is no IK solution.
+    '''
+    def sequence_joint_goals(self, sequence, q0):
+        (backup_waypoint,T,obj,backup_dist,query_dist,name) = sequence
+        q_backup = self.planner.ik(pm.toMatrix(backup_waypoint), q0)
+        if q_backup is None:
+            return None
+        q_grasp = self.planner.ik(pm.toMatrix(T), q_backup)
+        if q_grasp is None:
+            return None
+        return (q_backup, q_grasp)
+
+    def smartmove_multipurpose_gripper(self,
+            stamp,
+            possible_goals,
+            distance,
+            gripper_function,
+            velocity,
+            acceleration,
+            backup_in_gripper_frame):
+        '''
+        Basic function that handles collecting and aggregating smartmoves
+        '''
+
+        self.backoff_waypoints = []
+
+        if self.q0 is None:
+            return "FAILURE -- Initial joint position is None"
+
+        sequence_to_execute, self.backoff_waypoints = self.smartmove_sequences(possible_goals,
+                distance,
+                backup_in_gripper_frame,
+                self.q0,
+                stamp)
+        if sequence_to_execute is None:
+            rospy.logwarn('Stopping action because robot has been preempted by another process,')
+            return "FAILURE -- Robot has been preempted by another process"
 
-        rospy.loginfo('There is %i valid sequence and %i invalid sequence to try'%(len(list_of_valid_sequence),len(list_of_invalid_sequence)))
         # print 'Number of sequence to execute:', len(sequence_to_execute)
         msg = None
-        for sequence_number, (backup_waypoint,T,obj,backup_dist,query_dist,name) in enumerate(sequence_to_execute,1):
-            rospy.loginfo(str(sequence_number) + " moving to " + str(name))
+        remaining = list(enumerate(sequence_to_execute,1))
+        while len(remaining) > 0:
             if not self.valid_verify(stamp):
                 rospy.logwarn('Stopping action because robot has been preempted by another process,')
                 return "FAILURE -- Robot has been preempted by another process"
 
-            rospy.loginfo("Trying sequence number %i: backup_dist: %.3f query_dist: %.3f"%(sequence_number,backup_dist,query_dist))
-            # plan to T
-            rospy.sleep(0.01)
-            (code,res) = self.planner.getPlan(backup_waypoint,self.q0,obj=None)
-            if (not res is None) and len(res.planned_trajectory.joint_trajectory.points) > 0:
-                q_2 = res.planned_trajectory.joint_trajectory.points[-1].positions
-                (code2,res2) = self.planner.getPlan(T,q_2,obj=obj)
-
-                if ((not res2 is None) and len(res2.planned_trajectory.joint_trajectory.points) > 0):
-                    q_3 = res.planned_trajectory.joint_trajectory.points[-1].positions
-                    print(q_2,q_3)
-                    dist = np.linalg.norm(np.array(q_2)-np.array(q_3))
-                    if dist > 2 * backup_dist:
-                        rospy.logwarn("Backoff failed for pose %i: distance was %f vs %f"%(sequence_number,dist,2*backup_dist))
-                        continue
-                    self.info("appoach_%s"%obj, obj)
-                    msg = self.send_and_publish_planning_result(res,stamp,acceleration,velocity)
-                    rospy.sleep(0.1)
-
-                    if msg[0:7] == 'SUCCESS':
-                        self.info("move_to_grasp_%s"%obj, obj)
-                        msg = self.send_and_publish_planning_result(res2,stamp,acceleration,velocity)
-                        rospy.sleep(0.1)
-
-                        if msg[0:7] == 'SUCCESS':
-                            self.info("take_%s"%obj, obj)
-                            gripper_function(obj)
-
-                            traj = res2.planned_trajectory.joint_trajectory
-                            traj.points.reverse()
-                            end_t = traj.points[0].time_from_start
-                            for i, pt in enumerate(traj.points):
-                                pt.velocities = [-v for v in pt.velocities]
-                                pt.accelerations = []
-                                pt.effort = []
-                                pt.time_from_start = end_t - pt.time_from_start
-                            traj.points[0].positions = self.q0
-                            traj.points[-1].velocities = [0.]*len(self.q0)
-
-                            self.info("backoff_from_%s"%obj, obj)
-                            msg = self.send_and_publish_planning_result(res2,stamp,acceleration,velocity)
-                            return msg
-                        else:
-                            rospy.logwarn("Fail to move to grasp pose in sequence %i" % sequence_number)
-                    else:
-                        rospy.logwarn("Fail to move to backup pose in sequence %i" % sequence_number)
+            # plan the next few sequences at once
+            window = remaining[:self.speculative_sequences]
+            planned = self.plan_sequences(window, stamp)
+            if planned is None:
+                remaining = remaining[len(window):]
+                continue
+
+            sequence_number, res, res2 = planned
+            remaining = [sequence for sequence in remaining if sequence[0] != sequence_number]
+            (backup_waypoint,T,obj,backup_dist,query_dist,name) = sequence_to_execute[sequence_number - 1]
+            rospy.loginfo(str(sequence_number) + " moving to " + str(name))
+
+            self.info("appoach_%s"%obj, obj)
+            msg = self.send_and_publish_planning_result(res,stamp,acceleration,velocity)
+
+            if msg[0:7] == 'SUCCESS':
+                self.info("move_to_grasp_%s"%obj, obj)
+                msg = self.send_and_publish_planning_result(res2,stamp,acceleration,velocity)
+
+                if msg[0:7] == 'SUCCESS':
+                    self.info("take_%s"%obj, obj)
+                    gripper_function(obj)
+
+                    traj = res2.planned_trajectory.joint_trajectory
+                    traj.points.reverse()
+                    end_t = traj.points[0].time_from_start
+                    for i, pt in enumerate(traj.points):
+                        pt.velocities = [-v for v in pt.velocities]
+                        pt.accelerations = []
+                        pt.effort = []
+                        pt.time_from_start = end_t - pt.time_from_start
+                    traj.points[0].positions = self.q0
+                    traj.points[-1].velocities = [0.]*len(self.q0)
+
+                    self.info("backoff_from_%s"%obj, obj)
+                    msg = self.send_and_publish_planning_result(res2,stamp,acceleration,velocity)
+                    return msg
                 else:
-                    rospy.logwarn("Plan to pose in sequence %i does not work" % sequence_number)
+                    rospy.logwarn("Fail to move to grasp pose in sequence %i" % sequence_number)
             else:
-                rospy.logwarn("Plan Backoff pose in sequence %i does not work" % sequence_number)
+                rospy.logwarn("Fail to move to backup pose in sequence %i" % sequence_number)
         return "FAILURE -- No sequential motions work."
 
+    '''
+    Plan the approach (current position to backup waypoint) and grasp (backup
+    waypoint to grasp pose) legs of a list of numbered sequences concurrently.
+    The grasp leg is planned speculatively from the IK solution of the backup
+    waypoint, so it does not have to wait for the approach leg; with
+    straight_approach it is a straight line if that line is collision free.
+    Sequences are ranked by their order in the list: a sequence is chosen as
+    soon as both its legs are planned and every sequence ranked above it has
+    failed, so a slow plan for a better sequence is waited for. The outstanding
+    requests are then cancelled.
+    Returns (sequence_number, approach result, grasp result) or None.
+    '''
+    def plan_sequences(self, sequences, stamp):
+        q0 = list(self.q0)
+        cancel = Event()
+        finished = Queue()
+        started = time.time()
+
+        def plan_leg(sequence_number, leg, q_start, q_goal, obj, T=None):
+            t = time.time()
+            res = None
+            try:
+                if T is not None and not cancel.is_set():
+                    res = self.plan_straight_approach(q_start, T, obj)
+                if res is None and not cancel.is_set():
+                    (code,res) = self.planner.getPlan(q=q_start,q_goal=q_goal,obj=obj,cancel_event=cancel)
+            except Exception, e:
+                rospy.logerr("Planning %s leg in sequence %i failed: %s"%(leg,sequence_number,str(e)))
+                res = None
+            finally:
+                # always report back, or plan_sequences waits for this leg forever
+                finished.put((sequence_number, leg, res, time.time() - t))
+
+        legs = {}
+        ranking = []
+        for sequence_number, sequence in sequences:
+            (backup_waypoint,T,obj,backup_dist,query_dist,name) = sequence
+            goals = self.sequence_joint_goals(sequence, q0)
+            if goals is None:
+                rospy.logwarn("No IK solution for the poses in sequence %i" % sequence_number)
+                continue
+            q_backup, q_grasp = goals
+            rospy.loginfo("Planning sequence number %i: backup_dist: %.3f query_dist: %.3f"%(sequence_number,backup_dist,query_dist))
+            legs[sequence_number] = {}
+            ranking.append(sequence_number)
+            self.planning_pool.apply_async(plan_leg, (sequence_number, 'approach', q0, q_backup, None))
+            self.planning_pool.apply_async(plan_leg, (sequence_number, 'grasp', list(q_backup), q_grasp, obj,
+                T if self.straight_approach else None))
+
+        outstanding = 2 * len(legs)
+        try:
+            while outstanding > 0:
+                if not self.valid_verify(stamp):
+                    return None
+                try:
+                    sequence_number, leg, res, elapsed = finished.get(timeout=0.1)
+                except Empty:
+                    continue
+                outstanding -= 1
+
+                if res is None or len(res.planned_trajectory.joint_trajectory.points) == 0:
+                    rospy.logwarn("Plan %s leg in sequence %i does not work (%.2fs)"%(leg,sequence_number,elapsed))
+                    legs[sequence_number] = None
+                else:
+                    rospy.loginfo("Planned %s leg in sequence %i in %.2fs"%(leg,sequence_number,elapsed))
+                    if legs[sequence_number] is not None:
+                        legs[sequence_number][leg] = res
+
+                # best ranked sequence that has not failed yet
+                for best in ranking:
+                    if legs[best] is not None:
+                        break
+                else:
+                    continue
+                if len(legs[best]) == 2:
+                    rospy.loginfo("Sequence %i is feasible, found after %.2fs"%(best,time.time() - started))
+                    return (best, legs[best]['approach'], legs[best]['grasp'])
+            rospy.logwarn("None of the %i planned sequences work (%.2fs)"%(len(legs),time.time() - started))
+            return None
+        finally:
+            cancel.set()
+
+    '''
+    Straight line from q_start to the pose T (a kdl frame), for the short
+    approach from a backup waypoint, without a round trip to MoveIt.
+    Returns a MotionPlanResponse like planner.getPlan(), or None if the
+    line cannot be followed or is in collision (contacts with obj are
+    allowed).
+    '''
+    def plan_straight_approach(self, q_start, T, obj):
+        traj, failure_index = self.planner.getCartesianPath([T], q_start)
+        if traj is None or failure_index is not None or len(traj) < 2:
+            return None
+        if not all(self.check_plan_validity(traj.positions, obj)):
+            return None
+        res = MotionPlanResponse()
+        res.error_code.val = MoveItErrorCodes.SUCCESS
+        res.trajectory_start.joint_state.name = self.joint_names
+        res.trajectory_start.joint_state.position = list(q_start)
+        res.planned_trajectory.joint_trajectory = traj.to_msg()
+        return res
+
     def execute_planning_sequence(self, list_of_sequence, obj):
         pass
 
@@ -0,0 +1,79 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+from time_parameterization import segment_durations
+
+# CYCLE TIME ESTIMATES
+# How long a straight joint space move takes, without planning or executing
+# it, for many candidate moves at once (one row of dq per candidate). These
+# are the durations SimplePlanning gives its joint moves: the trapezoidal
+# profile of calculateAccelerationProfileParameters, or, with a
+# TimeParameterization, the time optimal profile for the per-joint limits
+# that the move is retimed to. Retimed moves follow a spline that rounds off
+# the acceleration steps of that profile and take longer than estimated, by
+# about 1% to 15% depending on the move and on how many points it has; the
+# estimates are for comparing candidates, not for scheduling.
+
+def trapezoidal_move_durations(dq,
+        base_steps,
+        steps_per_meter,
+        steps_per_radians,
+        delta_translation=0.,
+        time_multiplier=1,
+        percent_acc=1):
+    '''
+    Durations of moves by dq (N x dof) with the trapezoidal profile of
+    trajectory.trapezoidal_profile_parameters; delta_translation (scalar or
+    (N,)) is the end effector translation of Cartesian moves.
+    '''
+    dq = np.atleast_2d(np.asarray(dq, dtype=float))
+    delta_translation = np.broadcast_to(np.asarray(delta_translation, dtype=float), (len(dq),))
+    delta_q_norm = np.linalg.norm(dq, axis=1)
+    dq_max = np.max(np.absolute(dq), axis=1)
+    durations = np.zeros(len(dq))
+    moving = dq_max > 0
+    if not np.any(moving):
+        return durations
+
+    delta_q_norm = delta_q_norm[moving]
+    dq_max = dq_max[moving]
+    delta_translation = delta_translation[moving]
+    steps = np.round(base_steps + delta_translation * steps_per_meter
+        + delta_q_norm * steps_per_radians)
+    t_v_constant = delta_translation + delta_q_norm
+    ts = (t_v_constant / steps) * time_multiplier
+    v_max = dq_max / t_v_constant
+    acceleration = v_max * percent_acc
+    t_v_setting_max = (v_max / time_multiplier) / acceleration
+    steps_to_max_speed = 0.5 * acceleration * t_v_setting_max**2 / (dq_max / steps)
+
+    # too short to reach full speed: triangular profile
+    triangle = steps_to_max_speed * 2 > steps
+    t_v_setting_max = np.where(triangle, np.sqrt(0.5 * dq_max / acceleration), t_v_setting_max)
+    steps_to_max_speed = np.where(triangle, 0.5 * steps, steps_to_max_speed)
+    const_velocity_steps = np.maximum(steps - 2 * steps_to_max_speed, 0)
+
+    durations[moving] = 2 * t_v_setting_max + const_velocity_steps * ts
+    return durations
+
+def time_optimal_move_durations(dq, max_velocities, max_accelerations):
+    '''
+    Durations of straight moves by dq (N x dof) from rest to rest as fast as
+    the per-joint velocity and acceleration limits allow.
+    '''
+    dq = np.atleast_2d(np.asarray(dq, dtype=float))
+    lengths = np.linalg.norm(dq, axis=1)
+    durations = np.zeros(len(dq))
+    moving = lengths > 0
+    if not np.any(moving):
+        return durations
+    directions = np.absolute(dq[moving]) / lengths[moving,np.newaxis]
+    # the joint that has to move fastest limits the speed along the line
+    with np.errstate(divide='ignore'):
+        v_path = np.min(max_velocities / directions, axis=1)
+        a_path = np.min(max_accelerations / directions, axis=1)
+    durations[moving] = segment_durations(lengths[moving], 0., 0., v_path, a_path)
+    return durations
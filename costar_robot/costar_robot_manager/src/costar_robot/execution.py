@@ -0,0 +1,76 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import rospy
+import numpy as np
+
+from threading import Thread, Event
+
+# TRAJECTORY EXECUTION
+# One trajectory being executed in the background. send is a function that
+# blocks until the robot is done (a driver's send_trajectory bound to its
+# arguments) and returns the usual 'SUCCESS...'/'FAILURE...' string; it is
+# run on its own thread so the caller can go on planning the next motion.
+#
+# Progress is estimated from the time since the trajectory was started and
+# the time_from_start of its points. If traj was made from another trajectory
+# (retimed or compressed), point_times gives the times at which the points of
+# that one are reached, and segment indices refer to those points. Cancelling
+# is done by the owner through the usual stamp preemption, which makes send
+# return early.
+class TrajectoryExecution(object):
+
+    def __init__(self, traj, send, point_times=None):
+        self.times = np.array([pt.time_from_start.to_sec() for pt in traj.points])
+        self.point_times = self.times if point_times is None else np.asarray(point_times, dtype=float)
+        self.end_position = list(traj.points[-1].positions)
+        self.send = send
+        self.result = None
+        self.start_time = None
+        self.finished = Event()
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.start_time = rospy.Time.now().to_sec()
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            self.result = self.send()
+        except Exception, e:
+            rospy.logerr("Trajectory execution failed: %s"%str(e))
+            self.result = 'FAILURE -- %s'%str(e)
+        finally:
+            self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the trajectory to finish. Returns the result string, or None
+        if it is still running after timeout seconds.
+        '''
+        self.finished.wait(timeout)
+        return self.result
+
+    def feedback(self):
+        '''
+        Returns (progress, time_remaining, segment): the fraction of the
+        trajectory duration that has passed, the seconds left and the index
+        of the point the robot is moving towards.
+        '''
+        duration = self.times[-1]
+        if self.done() or self.start_time is None:
+            elapsed = duration if self.done() else 0.
+        else:
+            elapsed = min(rospy.Time.now().to_sec() - self.start_time, duration)
+        if duration > 0:
+            progress = elapsed / duration
+        else:
+            progress = 1. if self.done() else 0.
+        segment = min(int(np.searchsorted(self.point_times, elapsed, side='right')), len(self.point_times) - 1)
+        return progress, duration - elapsed, segment
@@ -41,36 +41,16 @@ class CostarIIWADriver(CostarArm):
     '''
     def send_trajectory(self,traj,stamp,acceleration=0.5,velocity=0.5,cartesian=False, linear=False):
 
-        rate = rospy.Rate(30)
-        t = rospy.Time(0)
-
-        for pt in traj.points[:-1]:
-          self.pt_publisher.publish(pt)
-          self.set_goal(pt.positions)
-
-          print " -- %s"%(str(pt.positions))
-          start_t = rospy.Time.now()
-
-          if not self.valid_verify(stamp):
-            return 'FAILURE -- preempted'
-
-          rospy.sleep(rospy.Duration(pt.time_from_start.to_sec() - t.to_sec()))
-          t = pt.time_from_start
-
         print " -- GOAL: %s"%(str(traj.points[-1].positions))
-        self.pt_publisher.publish(traj.points[-1])
         self.set_goal(traj.points[-1].positions)
-        start_t = rospy.Time.now()
 
-        while not self.at_goal:
-            if (rospy.Time.now() - start_t).to_sec() > 3:
-                return 'FAILURE - timeout'
-            rate.sleep()
+        if not self.streaming_executor.execute(traj, lambda: self.valid_verify(stamp)):
+          return 'FAILURE -- preempted'
 
-        if self.at_goal:
+        if self.wait_for_goal(3):
             return 'SUCCESS -- moved to pose'
         else:
-            return 'FAILURE -- did not reach destination'
+            return 'FAILURE - timeout'
 
     def handle_tick(self):
         super(CostarIIWADriver,self).handle_tick()
@@ -26,6 +26,36 @@ def transformDHParameter(a,d,alpha,theta):
 		])
 	return T
 
+def invTransformBatch(Transform):
+	# Vectorized invTransform: Transform is a (..., 4, 4) array of homogeneous transforms
+	T = np.asarray(Transform)
+	R_transpose = np.swapaxes(T[...,0:3,0:3],-1,-2)
+	inverseT = np.zeros(T.shape)
+	inverseT[...,0:3,0:3] = R_transpose
+	inverseT[...,0:3,3] = -np.einsum('...ij,...j->...i',R_transpose,T[...,0:3,3])
+	inverseT[...,3,3] = 1
+	return inverseT
+
+def transformDHParameterBatch(a,d,alpha,theta):
+	# Vectorized transformDHParameter: theta may have any shape, result has shape theta.shape + (4, 4)
+	theta = np.asarray(theta, dtype=float)
+	ct = np.cos(theta)
+	st = np.sin(theta)
+	T = np.zeros(theta.shape + (4,4))
+	T[...,0,0] = ct
+	T[...,0,1] = -st*cos(alpha)
+	T[...,0,2] = st*sin(alpha)
+	T[...,0,3] = a*ct
+	T[...,1,0] = st
+	T[...,1,1] = ct*cos(alpha)
+	T[...,1,2] = -ct*sin(alpha)
+	T[...,1,3] = a*st
+	T[...,2,1] = sin(alpha)
+	T[...,2,2] = cos(alpha)
+	T[...,2,3] = d
+	T[...,3,3] = 1
+	return T
+
 def transformRobotParameter(theta):
 	d = [0.089159,0,0,0.10915,0.09465,0.0823]
 	a = [0,-0.425,-0.39225,0,0,0]
@@ -35,6 +65,17 @@ def transformRobotParameter(theta):
 		T = T.dot(transformDHParameter(a[i],d[i],alpha[i],theta[i]))
 	return T
 
+def transformRobotParameterBatch(theta):
+	# Vectorized transformRobotParameter: theta is a N x 6 array, result is N x 4 x 4
+	d = [0.089159,0,0,0.10915,0.09465,0.0823]
+	a = [0,-0.425,-0.39225,0,0,0]
+	alpha = [pi/2,0,0,pi/2,-pi/2,0]
+	theta = np.atleast_2d(np.asarray(theta, dtype=float))
+	T = transformDHParameterBatch(a[0],d[0],alpha[0],theta[:,0])
+	for i in xrange(1,6):
+		T = np.matmul(T,transformDHParameterBatch(a[i],d[i],alpha[i],theta[:,i]))
+	return T
+
 class InverseKinematicsUR5:
 	def __init__(self):
 		# Debug mode
@@ -63,6 +104,10 @@ class InverseKinematicsUR5:
 		# Robot target transformation
 		self.gd = np.identity(4)
 
+		# Incremented whenever limits, weights or ee offset change, so that
+		# cached IK results can be invalidated
+		self.config_version = 0
+
 		# Stopping IK calculation flag
 		self.stop_flag = False
 
@@ -89,14 +134,17 @@ class InverseKinematicsUR5:
 		# This function is used to set the joint limit for all joint
 		self.limit_max = limit_max
 		self.limit_min = limit_min
+		self.config_version += 1
 
 	def setJointWeights(self, weights):
 		# This function will assign weights list for each joint
 		self.joint_weight = np.array(weights)
+		self.config_version += 1
 
 	def setEERotationOffset(self,r_offset_3x3):
 		# This function will assign rotation offset to the ee. r_offset_3x3 should be a numpy array
 		self.ee_offset[0:3,0:3] = r_offset_3x3
+		self.config_version += 1
 
 	def setEERotationOffsetROS(self):
 		# This function will assign proper tool orientation offset for ROS ur5's urdf.
@@ -112,6 +160,16 @@ class InverseKinematicsUR5:
 			normalized += 2* pi
 		return normalized
 
+	def normalizeArray(self,value):
+		# Vectorized normalize: shift every joint value into the joint limit range
+		normalized = np.array(value, dtype=float)
+		with np.errstate(invalid='ignore'):
+			over = normalized > self.limit_max
+			normalized[over] -= 2 * pi * np.ceil((normalized[over] - self.limit_max) / (2 * pi))
+			under = normalized < self.limit_min
+			normalized[under] += 2 * pi * np.ceil((self.limit_min - normalized[under]) / (2 * pi))
+		return normalized
+
 	def getFlags(self,nominator,denominator):
 		# This function is used to check whether the joint value will be valid or not
 		if denominator == 0:
@@ -294,21 +352,136 @@ class InverseKinematicsUR5:
 
 		return Q
 
+	def selectClosestIK(self,Q,current_joint_configuration):
+		# This function will pick the solution in Q closest to the current joint configuration
+		current_joint = np.array(current_joint_configuration)
+		delta_Q = np.absolute(Q - current_joint) * self.joint_weights
+		delta_Q_weights = np.sum(delta_Q, axis=1)
+		closest_ik_index = np.argmin(delta_Q_weights, axis = 0)
+
+		if self.debug:
+			print 'delta_Q weights for each solutions:', delta_Q_weights
+			print 'Closest IK solution: ', Q[closest_ik_index,:]
+		return Q[closest_ik_index,:]
+
 	def findClosestIK(self,forward_kinematics,current_joint_configuration):
 		if current_joint_configuration is None:
 			return None
 		
-		current_joint = np.array(current_joint_configuration)
 		Q = self.solveIK(forward_kinematics)
 		if Q is not None:
-			delta_Q = np.absolute(Q - current_joint) * self.joint_weights
-			delta_Q_weights = np.sum(delta_Q, axis=1)
-			closest_ik_index = np.argmin(delta_Q_weights, axis = 0)
-
-			if self.debug:
-				print 'delta_Q weights for each solutions:', delta_Q_weights
-				print 'Closest IK solution: ', Q[closest_ik_index,:]
-			return Q[closest_ik_index,:]
+			return self.selectClosestIK(Q,current_joint_configuration)
 		else:
 			return None
 
+	def solveIKBatch(self,forward_kinematics):
+		# This function will solve all eight IK branches for N target poses at once.
+		# forward_kinematics is a N x 4 x 4 array (or a single 4 x 4 array).
+		# It returns Q, a N x 8 x 6 array of joint solutions, and valid, a N x 8
+		# boolean array. Branch 4*i + 2*j + k holds the solution solveIK would
+		# build from theta1[i], theta5[i,j] and theta3[i,j,k].
+		# All intermediate values are local, so this function is reentrant.
+		gd = np.asarray(forward_kinematics, dtype=float)
+		if gd.ndim == 2:
+			gd = gd[np.newaxis]
+		gd = np.matmul(gd, self.ee_offset)
+		N = gd.shape[0]
+		d, a, alpha = self.d, self.a, self.alpha
+
+		with np.errstate(divide='ignore', invalid='ignore'):
+			# joint 1, shape (N,2)
+			p05 = gd[:,0:3,3] - d[5] * gd[:,0:3,2]
+			psi = np.arctan2(p05[:,1],p05[:,0])
+			L = np.sqrt(p05[:,0]**2 + p05[:,1]**2)
+			out_of_range = abs(d[3]) > L
+			flags1 = np.where(out_of_range, np.absolute(d[3] / L) < 1.01, True)
+			flags1 = np.repeat(flags1[:,np.newaxis], 2, axis=1)
+			L = np.where(out_of_range, abs(d[3]), L)
+			phi = np.arccos(d[3] / L)
+			theta1 = np.stack((psi + phi + pi/2, psi - phi + pi/2), axis=1)
+			theta1 = self.normalizeArray(theta1)
+
+			# joint 5, shape (N,2,2)
+			p16z = gd[:,0,3,np.newaxis] * np.sin(theta1) - gd[:,1,3,np.newaxis] * np.cos(theta1)
+			nominator = p16z - d[3]
+			out_of_range = np.absolute(nominator) > d[5]
+			flags5 = np.where(out_of_range, np.absolute(nominator / d[5]) < 1.01, True)
+			L = np.where(out_of_range, np.absolute(nominator), d[5])
+			theta5i = np.arccos(nominator / L)
+			theta5 = np.stack((theta5i, -theta5i), axis=2)
+			flags5 = np.repeat(flags5[:,:,np.newaxis], 2, axis=2)
+
+			# joint 6, shape (N,2,2)
+			T1 = transformDHParameterBatch(a[0],d[0],alpha[0],theta1)
+			T16 = np.matmul(invTransformBatch(T1), gd[:,np.newaxis])
+			T61 = invTransformBatch(T16)
+			sin_theta5 = np.sin(theta5)
+			theta6 = np.where(sin_theta5 == 0, 0.,
+				np.arctan2(-T61[:,:,np.newaxis,1,2] / sin_theta5, T61[:,:,np.newaxis,0,2] / sin_theta5))
+
+			# joint 2 and 3, shape (N,2,2,2)
+			T45 = transformDHParameterBatch(a[4],d[4],alpha[4],theta5)
+			T56 = transformDHParameterBatch(a[5],d[5],alpha[5],theta6)
+			T14 = np.matmul(T16[:,:,np.newaxis], invTransformBatch(np.matmul(T45,T56)))
+			P13 = T14[...,0:3,3] - d[3] * T14[...,0:3,1]
+			P13_norm = np.sqrt(np.sum(P13**2, axis=-1))
+			denominator = 2*a[1]*a[2]
+			L = P13_norm**2 - a[1]**2 - a[2]**2
+			out_of_range = np.absolute(L / denominator) > 1
+			flags3 = np.where(out_of_range, np.absolute(L / denominator) < 1.01, True)
+			L = np.where(out_of_range, np.sign(L) * denominator, L)
+			theta3i = np.arccos(L / denominator)
+			theta3 = np.stack((theta3i, -theta3i), axis=3)
+			flags3 = np.repeat(flags3[:,:,:,np.newaxis], 2, axis=3)
+			theta2 = -np.arctan2(P13[...,1],-P13[...,0])[...,np.newaxis] + \
+				np.arcsin(a[2] * np.sin(theta3) / P13_norm[...,np.newaxis])
+
+			# joint 4, shape (N,2,2,2)
+			T13 = np.matmul(transformDHParameterBatch(a[1],d[1],alpha[1],theta2),
+				transformDHParameterBatch(a[2],d[2],alpha[2],theta3))
+			T34 = np.matmul(invTransformBatch(T13), T14[:,:,:,np.newaxis])
+			theta4 = np.arctan2(T34[...,1,0],T34[...,0,0])
+
+			Q = np.empty((N,2,2,2,6))
+			Q[...,0] = theta1[:,:,np.newaxis,np.newaxis]
+			Q[...,1] = theta2
+			Q[...,2] = theta3
+			Q[...,3] = theta4
+			Q[...,4] = theta5[:,:,:,np.newaxis]
+			Q[...,5] = theta6[:,:,:,np.newaxis]
+			Q = self.normalizeArray(Q).reshape((N,8,6))
+
+		valid = flags1[:,:,np.newaxis,np.newaxis] & flags5[:,:,:,np.newaxis] & flags3
+		valid = valid.reshape((N,8)) & np.all(np.isfinite(Q), axis=2)
+
+		if self.debug:
+			print 'Number of valid solutions per pose: ', np.sum(valid, axis=1)
+
+		return Q, valid
+
+	def findClosestIKBatch(self,forward_kinematics,current_joint_configurations):
+		# Batched counterpart of findClosestIK. current_joint_configurations is
+		# either a N x 6 array with one seed per pose or a single seed used for
+		# every pose. Returns a N x 6 array with the closest valid solution for
+		# each pose and a boolean array of length N marking which poses have a
+		# solution at all; rows without a solution are filled with NaN.
+		Q, valid = self.solveIKBatch(forward_kinematics)
+		N = Q.shape[0]
+		current_joints = np.asarray(current_joint_configurations, dtype=float).reshape((-1,1,6))
+
+		delta_Q_weights = np.sum(np.absolute(Q - current_joints) * self.joint_weights, axis=2)
+		delta_Q_weights[~valid] = np.inf
+		closest_ik_index = np.argmin(delta_Q_weights, axis=1)
+
+		found = np.any(valid, axis=1)
+		Q_closest = Q[np.arange(N),closest_ik_index]
+		Q_closest[~found] = np.nan
+
+		if self.debug:
+			print 'Closest IK solutions: ', Q_closest
+		return Q_closest, found
+
+	def solveFKBatch(self,joint_configurations):
+		# This function will compute the poses of N joint configurations (N x 6)
+		# in the same frame solveIK expects, i.e. with the ee offset removed.
+		return np.matmul(transformRobotParameterBatch(joint_configurations),invTransformBatch(self.ee_offset))
@@ -0,0 +1,232 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+from collections import OrderedDict
+from threading import Lock
+
+# LRU CACHE
+# Small bounded least-recently-used map with hit/miss counters. It is shared
+# between the service threads of CostarArm, so every access is locked.
+class LRUCache(object):
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.mtx = Lock()
+
+    def get(self, key):
+        with self.mtx:
+            value = self.data.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.mtx:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.mtx:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+# KINEMATICS CACHE
+# Wraps the KDL kinematics and the closed form IK solver (if there is one) and
+# memoizes their results. With a ChainKinematics, forward kinematics and
+# Jacobians are computed with NumPy instead of KDL; it also provides the
+# uncached batch versions. Poses are quantized to pose_resolution (meters for
+# the translation, unitless for the rotation matrix entries) and joint
+# positions to joint_resolution (radians).
+#
+# Closed form IK results are cached per pose as the full set of solutions; the
+# closest solution to the seed is selected on every call, so the seed does not
+# need to be part of the key. KDL IK is iterative and depends on the seed, so
+# its key also contains the quantized seed.
+#
+# The cache is flushed automatically whenever the configuration of the closed
+# form solver (joint limits, weights, end effector offset) changes.
+#
+# The KDL solvers keep their state in kdl_kin and are not thread safe, so
+# every call into kdl_kin holds kdl_mtx; anyone else who uses the same
+# kdl_kin (like the planner) should hold it too.
+class KinematicsCache(object):
+
+    def __init__(self, kdl_kin,
+            closed_form_IK_solver=None,
+            chain_kinematics=None,
+            size=1024,
+            pose_resolution=1e-5,
+            joint_resolution=1e-6):
+        self.kdl_kin = kdl_kin
+        self.closed_form_IK_solver = closed_form_IK_solver
+        self.chain_kinematics = chain_kinematics
+        self.pose_resolution = pose_resolution
+        self.joint_resolution = joint_resolution
+
+        self.ik_cache = LRUCache(size)
+        self.fk_cache = LRUCache(size)
+        self.jacobian_cache = LRUCache(size)
+        self.solver_version = self._get_solver_version()
+        self.kdl_mtx = Lock()
+
+    def _get_solver_version(self):
+        if self.closed_form_IK_solver is None:
+            return None
+        return self.closed_form_IK_solver.config_version
+
+    def _check_solver_version(self):
+        version = self._get_solver_version()
+        if version != self.solver_version:
+            self.ik_cache.clear()
+            self.solver_version = version
+
+    def _pose_key(self, T):
+        T = np.asarray(T)
+        return tuple(np.round(T[0:3,:] / self.pose_resolution).astype(np.int64).ravel())
+
+    def _joint_key(self, q):
+        return tuple(np.round(np.asarray(q, dtype=float) / self.joint_resolution).astype(np.int64))
+
+    def invalidate(self):
+        '''
+        Drop every cached result.
+        '''
+        self.ik_cache.clear()
+        self.fk_cache.clear()
+        self.jacobian_cache.clear()
+
+    def forward(self, q):
+        '''
+        Cached kdl_kin.forward(q). Returns a copy, so callers may modify it.
+        '''
+        key = self._joint_key(q)
+        T = self.fk_cache.get(key)
+        if T is None:
+            if self.chain_kinematics is not None:
+                T = self.chain_kinematics.forward(q)
+            else:
+                with self.kdl_mtx:
+                    T = np.array(self.kdl_kin.forward(q))
+            self.fk_cache.put(key, T)
+        return T.copy()
+
+    def jacobian(self, q):
+        '''
+        Cached kdl_kin.jacobian(q).
+        '''
+        key = self._joint_key(q)
+        J = self.jacobian_cache.get(key)
+        if J is None:
+            if self.chain_kinematics is not None:
+                J = self.chain_kinematics.jacobian(q)
+            else:
+                with self.kdl_mtx:
+                    J = np.array(self.kdl_kin.jacobian(q))
+            self.jacobian_cache.put(key, J)
+        return J.copy()
+
+    def forward_batch(self, Q):
+        '''
+        End effector poses for a (N, dof) array of joint positions, as a
+        (N, 4, 4) array. Not cached.
+        '''
+        if self.chain_kinematics is not None:
+            return self.chain_kinematics.forward_batch(Q)
+        with self.kdl_mtx:
+            return np.array([self.kdl_kin.forward(q) for q in Q]).reshape(-1, 4, 4)
+
+    def jacobian_batch(self, Q):
+        '''
+        Jacobians for a (N, dof) array of joint positions, as a (N, 6, dof)
+        array. Not cached.
+        '''
+        if self.chain_kinematics is not None:
+            return self.chain_kinematics.jacobian_batch(Q)
+        with self.kdl_mtx:
+            return np.array([self.kdl_kin.jacobian(q) for q in Q]).reshape(len(Q), 6, -1)
+
+    def solve_ik(self, T):
+        '''
+        All closed form IK solutions for the 4x4 pose T, or None if there are
+        none. Needs a closed form solver.
+        '''
+        self._check_solver_version()
+        key = self._pose_key(T)
+        Q = self.ik_cache.get(key)
+        if Q is None:
+            Q = self.closed_form_IK_solver.solveIK(T)
+            if Q is None:
+                Q = np.zeros((0,6))
+            self.ik_cache.put(key, Q)
+        if len(Q) == 0:
+            return None
+        return Q.copy()
+
+    def solve_ik_batch(self, Ts):
+        '''
+        Closed form IK for a list of 4x4 poses. Poses that are not in the
+        cache are solved together with one solveIKBatch call. Returns one
+        (num_solutions x dof) array per pose, empty if there is no solution.
+        '''
+        self._check_solver_version()
+        keys = [self._pose_key(T) for T in Ts]
+        results = [self.ik_cache.get(key) for key in keys]
+        missing = [i for i, Q in enumerate(results) if Q is None]
+        if len(missing) > 0:
+            Q, valid = self.closed_form_IK_solver.solveIKBatch(
+                    np.array([Ts[i] for i in missing]))
+            for j, i in enumerate(missing):
+                results[i] = Q[j][valid[j]]
+                self.ik_cache.put(keys[i], results[i])
+        return [Q.copy() for Q in results]
+
+    def ik(self, T, q0):
+        '''
+        Cached equivalent of CostarArm.ik(): closest closed form solution to
+        q0 if there is a closed form solver, KDL inverse kinematics otherwise.
+        '''
+        if self.closed_form_IK_solver is not None:
+            if q0 is None:
+                return None
+            Q = self.solve_ik(T)
+            if Q is None:
+                return None
+            return self.closed_form_IK_solver.selectClosestIK(Q, q0)
+
+        if q0 is None:
+            with self.kdl_mtx:
+                return self.kdl_kin.inverse(T, q0)
+
+        key = (self._pose_key(T), self._joint_key(q0))
+        q = self.ik_cache.get(key)
+        if q is None:
+            with self.kdl_mtx:
+                q = self.kdl_kin.inverse(T, q0)
+            if q is None:
+                q = np.zeros(0)
+            self.ik_cache.put(key, q)
+        if len(q) == 0:
+            return None
+        return q.copy()
+
+    def stats(self):
+        '''
+        Hit/miss counters and sizes of the individual caches.
+        '''
+        return dict((name, {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache)})
+                for name, cache in (('ik', self.ik_cache),
+                                    ('fk', self.fk_cache),
+                                    ('jacobian', self.jacobian_cache)))
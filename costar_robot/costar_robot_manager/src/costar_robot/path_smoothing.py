@@ -0,0 +1,134 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import time
+import numpy as np
+
+# PATH SMOOTHER
+# Post-processing for joint space paths from sampling based planners, which
+# tend to take detours. Randomized shortcutting replaces parts of the path by
+# straight lines in joint space wherever those are collision free; the
+# corners that are left are then rounded with a few rounds of Chaikin corner
+# cutting (which converges to a quadratic B-spline).
+#
+# Collision checking is done with a validity_checker function that takes an
+# array of joint positions and returns one bool per row. Candidate shortcuts
+# are checked in batches of batch_size, so a single call checks many of them.
+# Shortcutting stops after time_budget seconds or max_rounds batches.
+class PathSmoother(object):
+
+    def __init__(self, time_budget=0.25,
+            resolution=0.05,
+            batch_size=16,
+            max_rounds=50,
+            smoothing_iterations=3,
+            seed=None):
+        self.time_budget = time_budget
+        self.resolution = resolution
+        self.batch_size = batch_size
+        self.max_rounds = max_rounds
+        self.smoothing_iterations = smoothing_iterations
+        self.random = np.random.RandomState(seed)
+
+    def smooth(self, positions, validity_checker):
+        '''
+        Shortcut and smooth the path through positions (N x dof). The first
+        and last positions are kept. Returns a densely sampled path with
+        steps of at most resolution radians.
+        '''
+        path = np.asarray(positions, dtype=float)
+        if len(path) < 3:
+            return densify(path, self.resolution)
+
+        path = self.shortcut(path, validity_checker)
+
+        # round the corners, but only keep the result if it is collision free
+        rounded = densify(chaikin(path, self.smoothing_iterations), self.resolution)
+        if np.all(validity_checker(rounded)):
+            return rounded
+        return densify(path, self.resolution)
+
+    def shortcut(self, path, validity_checker):
+        '''
+        Randomized shortcutting: try to connect random pairs of path points
+        with straight lines and keep the collision free ones that save the
+        most length. Returns the new waypoints.
+        '''
+        start_time = time.time()
+        for round_number in xrange(self.max_rounds):
+            if len(path) < 3 or time.time() - start_time > self.time_budget:
+                break
+
+            # pick candidate pairs (i, j) with at least one point in between
+            pairs = np.sort(self.random.randint(0, len(path), (self.batch_size, 2)), axis=1)
+            candidates = [(a, b) for a, b in set(map(tuple, pairs)) if b - a > 1]
+            if len(candidates) == 0:
+                continue
+
+            cumulative = np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(path, axis=0), axis=1))))
+            gains = [(cumulative[b] - cumulative[a]) - np.linalg.norm(path[b] - path[a])
+                    for a, b in candidates]
+            candidates = [(gain, a, b) for gain, (a, b) in zip(gains, candidates) if gain > 1e-6]
+            if len(candidates) == 0:
+                continue
+
+            # check all the shortcuts of this batch with one call
+            samples = [interpolate(path[a], path[b], self.resolution) for gain, a, b in candidates]
+            valid = np.asarray(validity_checker(np.concatenate(samples)), dtype=bool)
+            ends = np.cumsum([len(sample) for sample in samples])
+            starts = ends - np.array([len(sample) for sample in samples])
+
+            # apply the valid, non-overlapping shortcuts, best first
+            used = np.zeros(len(path), dtype=bool)
+            keep = np.ones(len(path), dtype=bool)
+            for k in np.argsort([-candidate[0] for candidate in candidates]):
+                gain, a, b = candidates[k]
+                if not np.all(valid[starts[k]:ends[k]]) or np.any(used[a:b+1]):
+                    continue
+                used[a:b+1] = True
+                keep[a+1:b] = False
+            path = path[keep]
+        return path
+
+def path_length(positions):
+    '''
+    Length of the path through positions in joint space.
+    '''
+    if len(positions) < 2:
+        return 0.
+    return np.sum(np.linalg.norm(np.diff(positions, axis=0), axis=1))
+
+def interpolate(q_start, q_goal, resolution):
+    '''
+    Points on the straight line from q_start to q_goal (both included) with
+    joint steps of at most resolution.
+    '''
+    steps = max(1, int(np.ceil(np.max(np.absolute(q_goal - q_start)) / resolution)))
+    fractions = np.linspace(0., 1., steps + 1)[:,np.newaxis]
+    return q_start + fractions * (q_goal - q_start)
+
+def densify(path, resolution):
+    '''
+    Subdivide every segment of the path so no joint moves more than
+    resolution between two points.
+    '''
+    if len(path) < 2:
+        return path
+    segments = [interpolate(path[k], path[k+1], resolution)[:-1] for k in xrange(len(path) - 1)]
+    return np.concatenate(segments + [path[-1:]])
+
+def chaikin(path, iterations):
+    '''
+    Chaikin corner cutting with fixed end points.
+    '''
+    for iteration in xrange(iterations):
+        if len(path) < 3:
+            break
+        q = 0.75 * path[:-1] + 0.25 * path[1:]
+        r = 0.25 * path[:-1] + 0.75 * path[1:]
+        cut = np.empty((2 * len(q), path.shape[1]))
+        cut[0::2] = q
+        cut[1::2] = r
+        path = np.concatenate((path[:1], cut[1:-1], path[-1:]))
+    return path
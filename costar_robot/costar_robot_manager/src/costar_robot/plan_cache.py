@@ -0,0 +1,266 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import yaml
+import numpy as np
+
+from threading import Event
+from threading import Lock
+
+from kinematics_cache import LRUCache
+from trajectory import TrajectoryArrays
+
+# PLAN CACHE
+# Remembers the trajectories returned by MoveIt so that repeated moves (going
+# home, the same joint waypoints in every loop of a task) do not have to be
+# planned again. Entries are keyed on the quantized start position, the goal
+# (joint positions or a 4x4 pose), the attached/allowed object and the
+# planning scene: a signature of its content (see PlanningSceneMirror), so a
+# plan is found again whenever the scene is the same as when it was made.
+#
+# A cached trajectory is only handed out after a cheap revalidation: its end
+# points must match the request and a few samples along it are checked for
+# collisions with the current scene.
+#
+# The cache can be written to and read from YAML text, which is how it is
+# stored with the librarian. Scene signatures are stored with the plans.
+#
+# Plans made ahead of time (SimplePlanning.prefetchPlan) are kept apart, by
+# goal only: they were planned from where the robot was predicted to stop,
+# so they are handed out for any start within prefetch_tolerance of that
+# position and any goal within goal_tolerance of theirs. The scene may have
+# changed since (the motion before usually ends with an attach or detach),
+# so they are revalidated like cached plans. Each one is used at most once;
+# a request for a plan that is still being made ahead of time can wait for
+# it.
+class PlanCache(object):
+
+    def __init__(self, size=64,
+            joint_resolution=1e-3,
+            pose_resolution=1e-3,
+            goal_tolerance=1e-3,
+            check_samples=10,
+            prefetch_tolerance=0.01,
+            max_prefetched=16):
+        self.joint_resolution = joint_resolution
+        self.pose_resolution = pose_resolution
+        self.goal_tolerance = goal_tolerance
+        self.check_samples = check_samples
+        self.prefetch_tolerance = prefetch_tolerance
+        self.max_prefetched = max_prefetched
+
+        self.plans = LRUCache(size)
+        self.rejected = 0
+        self.prefetching = []
+        self.prefetched = []
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self.modified = False
+        self.mtx = Lock()
+
+    def goal_key(self, q_goal=None, T_goal=None, obj=None):
+        '''
+        The goal part of a cache key: either q_goal or the pose T_goal, and
+        the object.
+        '''
+        if q_goal is not None:
+            goal = ('joints',) + tuple(np.round(np.asarray(q_goal, dtype=float)
+                / self.joint_resolution).astype(np.int64))
+        else:
+            goal = ('pose',) + tuple(np.round(np.asarray(T_goal, dtype=float)[0:3,:]
+                / self.pose_resolution).astype(np.int64).ravel())
+        return (goal, obj)
+
+    def key(self, q, q_goal=None, T_goal=None, obj=None, scene=None):
+        '''
+        Cache key for a plan from q to either q_goal or the pose T_goal in
+        the planning scene with the signature scene.
+        '''
+        start = tuple(np.round(np.asarray(q, dtype=float) / self.joint_resolution).astype(np.int64))
+        goal, obj = self.goal_key(q_goal, T_goal, obj)
+        return (scene, start, goal, obj)
+
+    def goal(self, q_goal=None, T_goal=None, obj=None):
+        '''
+        A goal for the plans made ahead of time: (q_goal, T_goal, obj).
+        '''
+        if q_goal is not None:
+            return (np.array(q_goal, dtype=float), None, obj)
+        return (None, np.array(T_goal, dtype=float), obj)
+
+    def same_goal(self, a, b):
+        '''
+        True if the goals a and b are within goal_tolerance of each other.
+        '''
+        (q_a, T_a, obj_a), (q_b, T_b, obj_b) = a, b
+        if obj_a != obj_b:
+            return False
+        if q_a is not None and q_b is not None:
+            return np.max(np.absolute(q_a - q_b)) <= self.goal_tolerance
+        if T_a is not None and T_b is not None:
+            return np.max(np.absolute(T_a[0:3,:] - T_b[0:3,:])) <= self.goal_tolerance
+        return False
+
+    def near_start(self, q_start, q):
+        return np.max(np.absolute(q_start - np.asarray(q, dtype=float))) <= self.prefetch_tolerance
+
+    def begin_prefetch(self, goal, q_start):
+        '''
+        Note that a plan to goal from q_start is being made ahead of time.
+        Returns the entry to pass to end_prefetch(), or None if such a plan
+        is already being made.
+        '''
+        with self.mtx:
+            for (running_goal, running_start, done) in self.prefetching:
+                if self.same_goal(running_goal, goal) and self.near_start(running_start, q_start):
+                    return None
+            entry = (goal, np.array(q_start, dtype=float), Event())
+            self.prefetching.append(entry)
+        return entry
+
+    def end_prefetch(self, entry, traj=None):
+        '''
+        Keep the plan traj made for an entry from begin_prefetch() (None if
+        planning failed) and wake up everyone waiting for it.
+        '''
+        goal, q_start, done = entry
+        with self.mtx:
+            self.prefetching = [running for running in self.prefetching if running is not entry]
+            if traj is not None:
+                self.prefetched.append((goal, q_start, traj))
+                del self.prefetched[:-self.max_prefetched]
+        done.set()
+
+    def take_prefetched(self, goal, q, timeout=0.):
+        '''
+        The plan made ahead of time to goal, if it was made from a start
+        within prefetch_tolerance of q; its first point is moved to q. If
+        that plan is still being made, wait up to timeout seconds for it.
+        None otherwise.
+        '''
+        with self.mtx:
+            running = [done for (running_goal, q_start, done) in self.prefetching
+                    if self.same_goal(running_goal, goal) and self.near_start(q_start, q)]
+        for done in running:
+            done.wait(timeout)
+
+        with self.mtx:
+            for i, (prefetched_goal, q_start, traj) in enumerate(self.prefetched):
+                if self.same_goal(prefetched_goal, goal):
+                    break
+            else:
+                return None
+            del self.prefetched[i]
+            if not self.near_start(q_start, q):
+                self.prefetch_misses += 1
+                return None
+            self.prefetch_hits += 1
+        positions = traj.positions.copy()
+        positions[0] = q
+        return TrajectoryArrays(positions, traj.times, traj.velocities, joint_names=traj.joint_names)
+
+    def get(self, key):
+        '''
+        Cached trajectory for key, or None.
+        '''
+        return self.plans.get(key)
+
+    def put(self, key, traj):
+        self.plans.put(key, traj)
+        with self.mtx:
+            self.modified = True
+
+    def reject(self, key):
+        '''
+        Drop an entry that failed revalidation.
+        '''
+        with self.plans.mtx:
+            self.plans.data.pop(key, None)
+        with self.mtx:
+            self.rejected += 1
+            self.modified = True
+
+    def clear(self):
+        self.plans.clear()
+        with self.mtx:
+            self.modified = True
+
+    def revalidate(self, traj, q, q_goal=None, T_goal=None, forward=None, validity_checker=None):
+        '''
+        Cheap check that traj is still a good plan from q to the goal: the
+        start has to be within joint_resolution of q, the end within
+        goal_tolerance of q_goal (or of T_goal through forward()), and
+        check_samples evenly spaced points, end points included, have to
+        pass validity_checker (a function returning one bool per row of an
+        array of joint positions) if one is given.
+        '''
+        if len(traj) == 0:
+            return False
+        if np.max(np.absolute(traj.positions[0] - np.asarray(q, dtype=float))) > self.joint_resolution:
+            return False
+        if q_goal is not None:
+            if np.max(np.absolute(traj.positions[-1] - np.asarray(q_goal, dtype=float))) > self.goal_tolerance:
+                return False
+        elif T_goal is not None and forward is not None:
+            T = np.asarray(forward(traj.positions[-1]))
+            if np.max(np.absolute(T[0:3,:] - np.asarray(T_goal)[0:3,:])) > self.goal_tolerance:
+                return False
+        if validity_checker is not None:
+            samples = np.unique(np.linspace(0, len(traj) - 1, self.check_samples).round().astype(int))
+            if not np.all(validity_checker(traj.positions[samples])):
+                return False
+        return True
+
+    def stats(self):
+        '''
+        Hit/miss counters and the hit rate of the cache.
+        '''
+        lookups = self.plans.hits + self.plans.misses
+        return {'hits': self.plans.hits,
+                'misses': self.plans.misses,
+                'rejected': self.rejected,
+                'size': len(self.plans),
+                'prefetch_hits': self.prefetch_hits,
+                'prefetch_misses': self.prefetch_misses,
+                'hit_rate': (self.plans.hits - self.rejected) / float(lookups) if lookups > 0 else 0.}
+
+    def to_yaml(self):
+        '''
+        Every entry as YAML text, oldest first.
+        '''
+        with self.plans.mtx:
+            items = self.plans.data.items()
+        with self.mtx:
+            self.modified = False
+        entries = []
+        for (scene, start, goal, obj), traj in items:
+            entries.append({'scene': scene,
+                'start': [int(v) for v in start],
+                'goal_type': goal[0],
+                'goal': [int(v) for v in goal[1:]],
+                'object': obj,
+                'joint_names': list(traj.joint_names),
+                'positions': traj.positions.tolist(),
+                'velocities': traj.velocities.tolist(),
+                'times': traj.times.tolist()})
+        return yaml.safe_dump(entries)
+
+    def from_yaml(self, text, scene=None):
+        '''
+        Add the entries stored with to_yaml(), under the scene signatures
+        stored with them; entries without one are filed under scene.
+        Revalidation still checks them against the current scene.
+        '''
+        entries = yaml.safe_load(text)
+        if not entries:
+            return
+        for entry in entries:
+            key = (entry.get('scene', scene),
+                    tuple(entry['start']),
+                    (entry['goal_type'],) + tuple(entry['goal']),
+                    entry['object'])
+            self.plans.put(key, TrajectoryArrays(entry['positions'],
+                entry['times'],
+                entry['velocities'],
+                joint_names=entry['joint_names']))
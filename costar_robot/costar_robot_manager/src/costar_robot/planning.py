@@ -14,6 +14,9 @@ from moveit_msgs.msg import *
 from moveit_msgs.srv import *
 import actionlib
 
+from Queue import Queue, Empty
+from threading import Lock, Thread
+
 from pykdl_utils.kdl_parser import kdl_tree_from_urdf_model
 from pykdl_utils.kdl_kinematics import KDLKinematics
 
@@ -21,6 +24,22 @@ from trajectory_msgs.msg import JointTrajectory
 from trajectory_msgs.msg import JointTrajectoryPoint
 from shape_msgs.msg import SolidPrimitive
 from geometry_msgs.msg import Pose
+
+from trajectory import TrajectoryArrays
+from trajectory import interpolate_joint_move
+from trajectory import trapezoidal_profile_parameters
+from trajectory import trapezoidal_step_times
+from trajectory import central_difference_velocities
+from cartesian_path import interpolate_poses
+from cartesian_path import interpolate_waypoints
+from cartesian_path import select_continuous_solutions
+from cartesian_path import first_joint_jump
+from path_smoothing import path_length
+from blending import blend_joint_path
+from blending import blend_cartesian_path
+from blending import stop_indices
+from cycle_time import trapezoidal_move_durations
+from cycle_time import time_optimal_move_durations
 ModeJoints = 'joints'
 ModeCart = 'cartesian'
 
@@ -35,6 +54,8 @@ ModeCart = 'cartesian'
 class SimplePlanning:
 
     skip_tol = 1e-6
+    # largest joint motion (radians) allowed between two Cartesian path steps
+    max_joint_jump = 0.5
     
     # How you set these options will determine how we do planning: 
     # what inverse kinematics are used for queries, etc. Most of these are
@@ -46,7 +67,13 @@ class SimplePlanning:
             verbose=False,
             kdl_kin=None,
             closed_form_IK_solver = None,
-            joint_names=[]):
+            joint_names=[],
+            kinematics_cache=None,
+            plan_cache=None,
+            max_planner_clients=4,
+            planning_scene_mirror=None,
+            time_parameterization=None,
+            path_smoother=None):
         self.robot = robot
         self.tree = kdl_tree_from_urdf_model(self.robot)
         self.chain = self.tree.getChain(base_link, end_link)
@@ -60,6 +87,16 @@ class SimplePlanning:
         self.group = group
         self.robot_ns = robot_ns
         self.client = actionlib.SimpleActionClient(move_group_ns, MoveGroupAction)
+
+        # Planning requests may be sent from several threads at once; every
+        # request uses its own action client. Up to max_planner_clients are
+        # created on demand.
+        self.move_group_ns = move_group_ns
+        self.max_planner_clients = max_planner_clients
+        self.num_planner_clients = 1
+        self.idle_planner_clients = Queue()
+        self.idle_planner_clients.put(self.client)
+        self.planner_clients_mtx = Lock()
         self.acceleration_magnification = 1
 
         rospy.wait_for_service('compute_cartesian_path')
@@ -67,22 +104,119 @@ class SimplePlanning:
 
         self.verbose = verbose
         self.closed_form_IK_solver = closed_form_IK_solver
+        self.kinematics_cache = kinematics_cache
+
+        # KDL inverse kinematics is not thread safe and may be called from
+        # several planning or query threads at once; share the lock of the
+        # KinematicsCache, which uses the same kdl_kin.
+        if kinematics_cache is not None:
+          self.kdl_mtx = kinematics_cache.kdl_mtx
+        else:
+          self.kdl_mtx = Lock()
+
+        # Plans from MoveIt are reused if they are still valid. They are
+        # filed under the signature of the planning scene mirror; without a
+        # mirror, the owner bumps scene_version whenever the planning scene
+        # changes. The owner may provide a validity_checker (joint positions,
+        # object to ignore -> list of bools) for the collision recheck of
+        # cached plans.
+        self.plan_cache = plan_cache
+        self.scene_version = 0
+        self.validity_checker = None
+
+        # Plans to upcoming goals can be made ahead of time with
+        # prefetchPlan() while the robot is still moving. getPlan() waits up
+        # to prefetch_wait seconds for a prefetch to the same goal that is
+        # still running.
+        self.prefetch_wait = 10.
+
+        # With a PlanningSceneMirror the allowed collision matrix is read and
+        # changed locally instead of through get_planning_scene.
+        self.planning_scene_mirror = planning_scene_mirror
+
+        # With a TimeParameterization, joint and cartesian moves are retimed
+        # to be as fast as the joint limits allow.
+        self.time_parameterization = time_parameterization
+
+        # With a PathSmoother, plans from MoveIt are shortcut and smoothed
+        # before they are used or cached. The owner provides a fast, padded
+        # smoothing_validity_checker (like validity_checker) for the
+        # shortcuts and a path_validator (joint positions, object to ignore
+        # -> bool) that confirms the final path with MoveIt.
+        self.path_smoother = path_smoother
+        self.smoothing_validity_checker = None
+        self.path_validator = None
     
     # Basic ik() function call.
     # It handles calls to KDL inverse kinematics or to the closed form ik
-    # solver that you provided.
+    # solver that you provided. If a KinematicsCache was provided, results
+    # are looked up there first.
     def ik(self, T, q0, dist=0.5):
       q = None
-      if self.closed_form_IK_solver is not None:
+      if self.kinematics_cache is not None:
+        q = self.kinematics_cache.ik(T,q0)
+      elif self.closed_form_IK_solver is not None:
       #T = pm.toMatrix(F)
         q = self.closed_form_IK_solver.findClosestIK(T,q0)
       else:
-        q = self.kdl_kin.inverse(T,q0)
+        with self.kdl_mtx:
+          q = self.kdl_kin.inverse(T,q0)
 
       return q
 
+    # Forward kinematics, from the KinematicsCache if there is one.
+    def forward(self, q):
+      if self.kinematics_cache is not None:
+        return self.kinematics_cache.forward(q)
+      with self.kdl_mtx:
+        return self.kdl_kin.forward(q)
+
+    # IK for a dense path of poses (an N x 4 x 4 array), e.g. a straight line
+    # in Cartesian space. The closed form solver solves every pose in one
+    # batched call and each step takes the branch closest to the previous
+    # step; KDL is seeded with the previous step instead. Stops at the first
+    # pose without a solution or where a joint would move more than
+    # max_joint_jump. Returns the joint positions before that pose and its
+    # index (None if the whole path could be followed).
+    def ikPath(self, poses, q0, max_joint_jump=None):
+      if self.closed_form_IK_solver is not None:
+        Q, valid = self.closed_form_IK_solver.solveIKBatch(poses)
+        positions, failure_index = select_continuous_solutions(Q, valid, q0,
+            self.closed_form_IK_solver.joint_weights)
+      else:
+        positions = []
+        failure_index = None
+        q = q0
+        with self.kdl_mtx:
+          for i, T in enumerate(poses):
+            q = self.kdl_kin.inverse(T, q)
+            if q is None:
+              failure_index = i
+              break
+            positions.append(q)
+        positions = np.array(positions, dtype=float).reshape(-1, len(q0))
+
+      if max_joint_jump is not None:
+        jump_index = first_joint_jump(positions, q0, max_joint_jump)
+        if jump_index is not None:
+          positions = positions[:jump_index]
+          failure_index = jump_index
+
+      return positions, failure_index
+
+    # Retime a trajectory using the joint velocity and acceleration limits if
+    # there is a TimeParameterization. time_multiplier and percent_acc scale
+    # the limits like they scale the trapezoidal profile.
+    def retime(self, traj, time_multiplier=1, percent_acc=1):
+      if self.time_parameterization is None or len(traj) < 2:
+        return traj
+      return self.time_parameterization.retime(traj,
+          1. / time_multiplier,
+          self.acceleration_magnification * percent_acc)
+
     # Compute parameters for a nice trapezoidal motion. This will let us create
     # movements with the basic move() operation that actually look pretty nice.
+    # See trajectory.trapezoidal_profile_parameters for the actual math.
     def calculateAccelerationProfileParameters(self, 
       dq_to_target, # joint space offset to target
       base_steps, # number of trajectory points to create
@@ -92,66 +226,38 @@ class SimplePlanning:
       time_multiplier,
       percent_acc):
 
-      # We compute a number of steps to take along our trapezoidal trajectory
-      # curve. This gives us a nice, relatively dense trajectory that we can
-      # introspect on later -- we can use it to compute cost functions, to 
-      # detect collisions, etc.
-      delta_q_norm = np.linalg.norm(dq_to_target)
-      steps = base_steps + delta_translation * steps_per_meter + delta_q_norm \
-          * steps_per_radians
-      # Number of steps must be an int.
-      steps = int(np.round(steps))
-
-      # This is the time needed for constant velocity at 100% to reach the goal.
-      t_v_constant = delta_translation + delta_q_norm
-      ts = (t_v_constant / steps ) * time_multiplier
-      
-      # the max constant joint velocity
-      dq_max_target = np.max(np.absolute(dq_to_target))
-      v_max = dq_max_target/t_v_constant
-      v_setting_max = v_max / time_multiplier
-
-      acceleration = v_max * percent_acc
-      # j_acceleration = np.array(dq_target) / t_v_constant * percent_acc
-      t_v_setting_max = v_setting_max / acceleration
-
-      # Compute the number of trajectory points we want to make before we will
-      # get up to max speed.
-      steps_to_max_speed = 0.5 * acceleration * t_v_setting_max **2 \
-          / (dq_max_target / steps) 
-      if steps_to_max_speed * 2 > steps:
+      steps, ts, t_v_setting_max, steps_to_max_speed, const_velocity_max_step, steps_required = \
+          trapezoidal_profile_parameters(dq_to_target,
+            base_steps,
+            steps_per_meter,
+            steps_per_radians,
+            delta_translation,
+            time_multiplier,
+            percent_acc)
+
+      if steps_required > steps:
         rospy.logwarn("Cannot reach the maximum velocity setting, steps "
-            "required %.1f > total number of steps %d"%(steps_to_max_speed * 2,steps))
-        t_v_setting_max = np.sqrt(0.5 * dq_max_target / acceleration)
-        steps_to_max_speed = (0.5 * steps)
-        v_setting_max = t_v_setting_max * acceleration
+            "required %.1f > total number of steps %d"%(steps_required,steps))
 
       rospy.loginfo("Acceleration number of steps is set to %.1f and time "
             "elapsed to reach max velocity is %.3fs"%(steps_to_max_speed,
               t_v_setting_max))
 
-      const_velocity_max_step = np.max([steps - 2 * steps_to_max_speed, 0])
-
       return steps, ts, t_v_setting_max, steps_to_max_speed, const_velocity_max_step
 
     # This is where we compute what time we want for each trajectory point.
+    # step_index may also be an array of steps.
     def calculateTimeOfTrajectoryStep(self,
       step_index,
       steps_to_max_speed,
       const_velocity_max_step,
       t_v_const_step,
       t_to_reach_v_setting_max):
-      acceleration_step = np.min([step_index, steps_to_max_speed])
-      deceleration_step = np.min([np.max([step_index - const_velocity_max_step - steps_to_max_speed, 0]), steps_to_max_speed]) 
-      const_velocity_step = np.min([np.max([0, step_index - steps_to_max_speed]), const_velocity_max_step]) 
-      acceleration_time = 0
-      deceleration_time = 0
-      if steps_to_max_speed > 0.0001:
-        acceleration_time = np.sqrt(acceleration_step/steps_to_max_speed) * t_to_reach_v_setting_max
-        deceleration_time = t_to_reach_v_setting_max - np.sqrt((steps_to_max_speed-deceleration_step)/steps_to_max_speed) * t_to_reach_v_setting_max
-      const_vel_time = const_velocity_step * t_v_const_step
-
-      return acceleration_time + const_vel_time + deceleration_time
+      return trapezoidal_step_times(step_index,
+        steps_to_max_speed,
+        const_velocity_max_step,
+        t_v_const_step,
+        t_to_reach_v_setting_max)
 
 
     # Compute a nice joint trajectory. This is useful for checking collisions,
@@ -167,21 +273,47 @@ class SimplePlanning:
         use_joint_move=False,
         table_frame=None):
 
+      traj = self.getJointMoveArrays(q_goal, q0,
+        base_steps,
+        steps_per_meter,
+        steps_per_radians,
+        time_multiplier,
+        percent_acc,
+        use_joint_move,
+        table_frame)
+      if traj is None:
+        return JointTrajectory()
+      return traj.to_msg()
+
+    # Same as getJointMove, but returns the trajectory as TrajectoryArrays
+    # (or None on failure) without building a ROS message.
+    def getJointMoveArrays(self,
+        q_goal,
+        q0,
+        base_steps=1000,
+        steps_per_meter=1000,
+        steps_per_radians=4,
+        time_multiplier=1,
+        percent_acc=1,
+        use_joint_move=False,
+        table_frame=None):
+
       if q0 is None:
         rospy.logerr("Invalid initial joint position in getJointMove")
-        return JointTrajectory()
+        return None
       elif np.all(np.isclose(q0,q_goal,atol = 0.0001)):
         rospy.logwarn("Robot is already in the goal position.")
-        return JointTrajectory()
+        return None
 
+      q_goal = np.array(q_goal)
       if np.any(np.greater(np.absolute(q_goal[:2] - np.array(q0[:2])), np.pi/2)) \
         or np.absolute(q_goal[3] - q0[3]) > np.pi:
         
         # TODO: these thresholds should not be set manually here.
         rospy.logerr("Dangerous IK solution, abort getJointMove")
 
-        return JointTrajectory()
-      delta_q = np.array(q_goal) - np.array(q0)
+        return None
+      delta_q = q_goal - np.array(q0)
       # steps = base_steps + int(np.sum(np.absolute(delta_q)) * steps_per_radians)
       steps, t_v_const_step, t_v_setting_max, steps_to_max_speed, const_velocity_max_step = self.calculateAccelerationProfileParameters(delta_q,
         base_steps,
@@ -191,52 +323,26 @@ class SimplePlanning:
         time_multiplier,
         self.acceleration_magnification * percent_acc)
 
-      traj = JointTrajectory()
-      traj.points.append(JointTrajectoryPoint(positions=q0,
-            velocities=[0]*len(q0),
-            accelerations=[0]*len(q0)))
-      # compute IK
-      for i in range(1,steps + 1):
-        xyz = None
-        rpy = None
-        q = None
-
-        q = np.array(q0) + (float(i)/steps) * delta_q
-        q = q.tolist()
-
-        if self.verbose:
-          print "%d -- %s %s = %s"%(i,str(xyz),str(rpy),str(q))
-
-        if q is not None:
-          dq_i = np.array(q) - np.array(traj.points[i-1].positions)
-          if np.sum(dq_i) < 0.0001:
-            rospy.logwarn("Joint trajectory point %d is repeating previous trajectory point. "%i)
-            # continue
-
-          total_time = total_time = self.calculateTimeOfTrajectoryStep(i, 
-            steps_to_max_speed,
-            const_velocity_max_step,
-            t_v_const_step,
-            t_v_setting_max)
-          traj.points[i-1].velocities = dq_i/(total_time - traj.points[i-1].time_from_start.to_sec())
-
-          pt = JointTrajectoryPoint(positions=q,
-            velocities=[0]*len(q),
-            accelerations=[0]*len(q))
-          pt.time_from_start = rospy.Duration(total_time)
-          traj.points.append(pt)
-        else:
-          rospy.logwarn("No IK solution on one of the trajectory point to cartesian move target")
-
-      if len(traj.points) < base_steps:
-          print rospy.logerr("Planning failure with " \
-                  + str(len(traj.points)) \
+      # compute every trajectory point at once
+      traj = interpolate_joint_move(q0, q_goal, steps,
+        steps_to_max_speed,
+        const_velocity_max_step,
+        t_v_const_step,
+        t_v_setting_max,
+        joint_names=self.joint_names)
+
+      if self.verbose:
+        for i, q in enumerate(traj.positions):
+          print "%d -- %s"%(i,str(q))
+
+      if len(traj) < base_steps:
+          rospy.logerr("Planning failure with " \
+                  + str(len(traj)) \
                   + " / " + str(base_steps) \
                   + " points.")
-          return JointTrajectory()
+          return None
 
-      traj.joint_names = self.joint_names
-      return traj
+      return self.retime(traj, time_multiplier, percent_acc)
 
     # Compute a simple trajectory.
     def getCartesianMove(self, frame, q0,
@@ -248,17 +354,40 @@ class SimplePlanning:
       use_joint_move = False,
       table_frame = None):
 
+      traj = self.getCartesianMoveArrays(frame, q0,
+        base_steps,
+        steps_per_meter,
+        steps_per_radians,
+        time_multiplier,
+        percent_acc,
+        use_joint_move,
+        table_frame)
+      if traj is None:
+        return JointTrajectory()
+      return traj.to_msg()
+
+    # Same as getCartesianMove, but returns the trajectory as TrajectoryArrays
+    # (or None on failure) without building a ROS message.
+    def getCartesianMoveArrays(self, frame, q0,
+      base_steps=1000,
+      steps_per_meter=1000,
+      steps_per_radians = 4,
+      time_multiplier=1,
+      percent_acc=1,
+      use_joint_move = False,
+      table_frame = None):
+
       if table_frame is not None:
         if frame.p[2] < table_frame[0][2]:
           rospy.logerr("Ignoring move to waypoint due to relative z: %f < %f"%(frame.p[2],table_frame[0][2]))
-          return JointTrajectory()
+          return None
 
       if q0 is None:
         rospy.logerr("Invalid initial joint position in getCartesianMove")
-        return JointTrajectory()
+        return None
 
       # interpolate between start and goal
-      pose = pm.fromMatrix(self.kdl_kin.forward(q0))
+      pose = pm.fromMatrix(self.forward(q0))
 
       cur_rpy = np.array(pose.M.GetRPY())
       cur_xyz = np.array(pose.p)
@@ -269,16 +398,12 @@ class SimplePlanning:
       delta_translation = (pose.p - frame.p).Norm()
       if delta_rpy < 0.001 and delta_translation < 0.001:
         rospy.logwarn("Robot is already in the goal position.")
-        return JointTrajectory(points=[JointTrajectoryPoint(positions=q0,
-          velocities=[0]*len(q0),
-          accelerations=[0]*len(q0),
-          time_from_start=rospy.Duration(0.0))], 
-          joint_names = self.joint_names)
+        return TrajectoryArrays([q0], [0.0], joint_names=self.joint_names)
 
       q_target = self.ik(pm.toMatrix(frame),q0)
       if q_target is None:
         rospy.logerr("No IK solution on cartesian move target")
-        return JointTrajectory()
+        return None
       else:
         if np.any(
           np.greater(
@@ -286,16 +411,12 @@ class SimplePlanning:
           or np.absolute(q_target[3] - q0[3]) > np.pi:
 
           rospy.logerr("Dangerous IK solution, abort getCartesianMove")
-          return JointTrajectory()
+          return None
       
       dq_target = q_target - np.array(q0)
       if np.sum(np.absolute(dq_target)) < 0.0001:
         rospy.logwarn("Robot is already in the goal position.")
-        return JointTrajectory(points=[JointTrajectoryPoint(positions=q0,
-          velocities=[0]*len(q0),
-          accelerations=[0]*len(q0),
-          time_from_start=rospy.Duration(0.0))], 
-          joint_names = self.joint_names)
+        return TrajectoryArrays([q0], [0.0], joint_names=self.joint_names)
       
       steps, t_v_const_step, t_v_setting_max, steps_to_max_speed, const_velocity_max_step = self.calculateAccelerationProfileParameters(dq_target,
         base_steps,
@@ -305,74 +426,55 @@ class SimplePlanning:
         time_multiplier,
         self.acceleration_magnification * percent_acc)
 
-      traj = JointTrajectory()
-      traj.points.append(JointTrajectoryPoint(positions=q0,
-          	velocities=[0]*len(q0),
-          	accelerations=[0]*len(q0)))
-      # Compute a smooth trajectory.
-      for i in range(1,steps + 1):
-        xyz = None
-        rpy = None
-        q = None
-
-        if not use_joint_move:
-          xyz = cur_xyz + ((float(i)/steps) * (goal_xyz - cur_xyz))
-          rpy = cur_rpy + ((float(i)/steps) * (goal_rpy - cur_rpy))
-
-          # Create transform for goal frame
-          frame = pm.toMatrix(
-            kdl.Frame(
-              kdl.Rotation.RPY(
-                rpy[0],
-                rpy[1],
-                rpy[2]),
-              kdl.Vector(
-                xyz[0],
-                xyz[1],
-                xyz[2])))
-
-          # Use current inverse kinematics solver with current position
-          q = self.ik(frame, q0)
-        else:
-          q = np.array(q0) + (float(i)/steps) * dq_target
-          q = q.tolist()
-          
-          #q = self.kdl_kin.inverse(frame,q0)
+      if use_joint_move:
+        # A straight line in joint space: compute every point at once
+        traj = interpolate_joint_move(q0, q_target, steps,
+          steps_to_max_speed,
+          const_velocity_max_step,
+          t_v_const_step,
+          t_v_setting_max,
+          joint_names=self.joint_names)
         if self.verbose:
-          print "%d -- %s %s = %s"%(i,str(xyz),str(rpy),str(q))
-
-        if q is not None:
-          total_time = self.calculateTimeOfTrajectoryStep(i, 
-            steps_to_max_speed,
-            const_velocity_max_step,
-            t_v_const_step,
-            t_v_setting_max)
-          # Compute the distance to the last point for each joint. We use this to compute our joint velocities.
-          dq_i = np.array(q) - np.array(traj.points[-1].positions)
-          if np.sum(np.abs(dq_i)) < self.skip_tol:
-            rospy.logwarn("Joint trajectory point %d is repeating previous trajectory point. "%i)
-            continue
-
-          traj.points[i-1].velocities = (dq_i)/(total_time - traj.points[i-1].time_from_start.to_sec())
-          pt = JointTrajectoryPoint(positions=q,
-          	velocities=[0]*len(q),
-          	accelerations=[0]*len(q))
-
-          pt.time_from_start = rospy.Duration(total_time)
-          # pt.time_from_start = rospy.Duration(i * ts)
-          traj.points.append(pt)
-        else:
-          rospy.logwarn("No IK solution on one of the trajectory point to cartesian move target")
+          for i, q in enumerate(traj.positions):
+            print "%d -- %s"%(i,str(q))
+      else:
+        # Compute a smooth trajectory: a straight line in Cartesian space with
+        # slerp for the orientation, solved with one batched IK call.
+        poses = interpolate_poses(pm.toMatrix(pose), pm.toMatrix(frame), steps)
+        path, failure_index = self.ikPath(poses, q0, self.max_joint_jump)
+        if failure_index is not None:
+          rospy.logwarn("Cartesian move cannot continue after trajectory point %d of %d"%(failure_index,steps))
+
+        positions = np.vstack((np.array(q0, dtype=float), path))
+        step_index = np.arange(len(positions))
+
+        # Compare to the last point; we need progress to compute velocities.
+        moving = np.ones(len(positions), dtype=bool)
+        moving[1:] = np.sum(np.abs(np.diff(positions, axis=0)), axis=1) >= self.skip_tol
+        if not np.all(moving):
+          rospy.logwarn("Skipping %d joint trajectory points repeating the previous point."%np.sum(~moving))
+        positions = positions[moving]
+        step_index = step_index[moving]
 
-      if len(traj.points) < base_steps:
-          print rospy.logerr("Planning failure with " \
-                  + str(len(traj.points)) \
+        if self.verbose:
+          for i, q in zip(step_index, positions):
+            print "%d -- %s"%(i,str(q))
+
+        times = self.calculateTimeOfTrajectoryStep(step_index,
+          steps_to_max_speed,
+          const_velocity_max_step,
+          t_v_const_step,
+          t_v_setting_max)
+        traj = TrajectoryArrays(positions, times, joint_names=self.joint_names)
+
+      if len(traj) < base_steps:
+          rospy.logerr("Planning failure with " \
+                  + str(len(traj)) \
                   + " / " + str(base_steps) \
                   + " points.")
-          return JointTrajectory()
+          return None
 
-      traj.joint_names = self.joint_names
-      return traj
+      return self.retime(traj, time_multiplier, percent_acc)
 
     def getGoalConstraints(self, frame = None, q = None, q_goal=None, timeout=2.0, mode = ModeJoints):
         if frame == None and q_goal == None:
@@ -393,7 +495,7 @@ class SimplePlanning:
         elif q_goal is not None:
           joints = q_goal
 
-        if len(joints) is not len(self.joint_names):
+        if joints is None or len(joints) is not len(self.joint_names):
           rospy.logerr("Invalid goal position. Number of joints in goal is not the same as robot's dof")
           return (None, None)
 
@@ -444,7 +546,25 @@ class SimplePlanning:
 
 
     def updateAllowedCollisions(self,obj,allowed):
+        if self.planning_scene_mirror is not None:
+          self.planning_scene_mirror.setAllowedCollisions(obj,allowed)
+          return
+
         self.planning_scene_publisher = rospy.Publisher('planning_scene', PlanningScene, queue_size = 10)
+        acm = self.getAllowedCollisionMatrix(obj,allowed)
+
+        planning_scene_diff = PlanningScene(
+                is_diff=True,
+                allowed_collision_matrix=acm)
+
+        self.planning_scene_publisher.publish(planning_scene_diff)
+
+    # The current allowed collision matrix, with collisions with obj allowed
+    # or not.
+    def getAllowedCollisionMatrix(self,obj,allowed):
+        if self.planning_scene_mirror is not None:
+          return self.planning_scene_mirror.getAllowedCollisionMatrix(obj,allowed)
+
         rospy.wait_for_service('get_planning_scene', 10.0)
         get_planning_scene = rospy.ServiceProxy('get_planning_scene', GetPlanningScene)
         request = PlanningSceneComponents(components=PlanningSceneComponents.ALLOWED_COLLISION_MATRIX)
@@ -464,14 +584,56 @@ class SimplePlanning:
         #    entry.enabled[idx] = allowed
         #  for i in xrange(len(acm.entry_names)):
         #    acm.entry_values[idx].enabled[i]=allowed
+        return acm
+
+    # Get an idle action client for move_group, creating a new one if there
+    # are fewer than max_planner_clients. Blocks until one is available.
+    def acquirePlannerClient(self):
+        try:
+          return self.idle_planner_clients.get_nowait()
+        except Empty:
+          pass
+        with self.planner_clients_mtx:
+          create = self.num_planner_clients < self.max_planner_clients
+          if create:
+            self.num_planner_clients += 1
+        if create:
+          client = actionlib.SimpleActionClient(self.move_group_ns, MoveGroupAction)
+          client.wait_for_server(rospy.Duration(5.0))
+          return client
+        return self.idle_planner_clients.get()
+
+    def releasePlannerClient(self, client):
+        self.idle_planner_clients.put(client)
+
+    # Start state, workspace and planner settings shared by all our planning
+    # requests; the goal constraints are up to the caller.
+    def makeMotionPlanRequest(self, q):
+        motion_req = MotionPlanRequest()
 
-        planning_scene_diff = PlanningScene(
-                is_diff=True,
-                allowed_collision_matrix=acm)
-
-        self.planning_scene_publisher.publish(planning_scene_diff)
+        motion_req.start_state.joint_state.position = q
+        motion_req.start_state.joint_state.name = self.joint_names
+        motion_req.workspace_parameters.header.frame_id = self.base_link
+        motion_req.workspace_parameters.max_corner.x = 1.0
+        motion_req.workspace_parameters.max_corner.y = 1.0
+        motion_req.workspace_parameters.max_corner.z = 1.0
+        motion_req.workspace_parameters.min_corner.x = -1.0
+        motion_req.workspace_parameters.min_corner.y = -1.0
+        motion_req.workspace_parameters.min_corner.z = -1.0
 
-    def getPlan(self,frame=None,q=None,q_goal=None,obj=None,compute_ik=True):
+        motion_req.group_name = self.group
+        motion_req.num_planning_attempts = 10
+        motion_req.allowed_planning_time = 4.0
+        motion_req.planner_id = "RRTConnectkConfigDefault"
+        return motion_req
+
+    # Send a plan-only request to move_group and wait for the result.
+    # Collisions with obj are allowed for this request only: the changed
+    # allowed collision matrix is sent along as a planning scene diff, so
+    # requests from different threads do not interfere. Setting
+    # cancel_event cancels the request.
+    # Returns the MoveGroupResult, or None.
+    def sendPlanRequest(self, motion_req, obj=None, cancel_event=None):
         planning_options = PlanningOptions()
         planning_options.plan_only = True
         planning_options.replan = False
@@ -479,7 +641,31 @@ class SimplePlanning:
         planning_options.replan_delay = 0.1
         planning_options.planning_scene_diff.is_diff = True
         planning_options.planning_scene_diff.robot_state.is_diff = True
+        if obj is not None:
+          planning_options.planning_scene_diff.allowed_collision_matrix = \
+              self.getAllowedCollisionMatrix(obj,True)
+
+        goal = MoveGroupGoal()
+        goal.planning_options = planning_options
+        goal.request = motion_req
+
+        rospy.logwarn( "Sending request...")
 
+        client = self.acquirePlannerClient()
+        try:
+          client.send_goal(goal)
+          if cancel_event is None:
+            client.wait_for_result()
+          else:
+            while not client.wait_for_result(rospy.Duration(0.05)):
+              if cancel_event.is_set() or rospy.is_shutdown():
+                client.cancel_goal()
+                return None
+          return client.get_result()
+        finally:
+          self.releasePlannerClient(client)
+
+    def getPlan(self,frame=None,q=None,q_goal=None,obj=None,compute_ik=True,cancel_event=None,use_prefetched=True):
         if frame is None and q_goal is None:
           raise RuntimeError('Must provide either a goal frame or joint state!')
         if q is None:
@@ -488,20 +674,17 @@ class SimplePlanning:
           rospy.logerr("Invalid number of joints in getPlan starting position setting")
           return (-31,None)
         
-        if obj is not None:
-          self.updateAllowedCollisions(obj,True);
-
-        motion_req = MotionPlanRequest()
-
-        motion_req.start_state.joint_state.position = q
-        motion_req.start_state.joint_state.name = self.joint_names
-        motion_req.workspace_parameters.header.frame_id = self.base_link
-        motion_req.workspace_parameters.max_corner.x = 1.0
-        motion_req.workspace_parameters.max_corner.y = 1.0
-        motion_req.workspace_parameters.max_corner.z = 1.0
-        motion_req.workspace_parameters.min_corner.x = -1.0
-        motion_req.workspace_parameters.min_corner.y = -1.0
-        motion_req.workspace_parameters.min_corner.z = -1.0
+        cache_key = None
+        if self.plan_cache is not None:
+          T_goal = pm.toMatrix(frame) if q_goal is None else None
+          cache_key = self.plan_cache.key(q, q_goal, T_goal, obj, self.sceneSignature())
+          res = self.getCachedPlan(cache_key, q, q_goal, T_goal, obj)
+          if res is None and use_prefetched:
+            res = self.getPrefetchedPlan(q, q_goal, T_goal, obj)
+          if res is not None:
+            return (res.error_code.val, res)
+
+        motion_req = self.makeMotionPlanRequest(q)
 
         # create the goal constraints
         # TODO: change this to use cart goal(s)
@@ -516,10 +699,6 @@ class SimplePlanning:
             mode=constrain_mode)
 
         motion_req.goal_constraints.append(goal)
-        motion_req.group_name = self.group
-        motion_req.num_planning_attempts = 10
-        motion_req.allowed_planning_time = 4.0
-        motion_req.planner_id = "RRTConnectkConfigDefault"
         
         if goal is None:
           print 'Error: goal is None'
@@ -531,26 +710,236 @@ class SimplePlanning:
           print 'Error: ik resp failure'
           return (-31, None)
 
-        goal = MoveGroupGoal()
-        goal.planning_options = planning_options
-        goal.request = motion_req
-
-        rospy.logwarn( "Sending request...")
-
-        self.client.send_goal(goal)
-        self.client.wait_for_result()
-        res = self.client.get_result()
+        res = self.sendPlanRequest(motion_req, obj, cancel_event)
         if res is not None:
           rospy.logwarn("Done: " + str(res.error_code.val))
 
-          if obj is not None:
-            self.updateAllowedCollisions(obj,False);
+          if res.error_code.val == MoveItErrorCodes.SUCCESS:
+            self.smoothPlan(res, obj)
+
+          if cache_key is not None and res.error_code.val == MoveItErrorCodes.SUCCESS:
+            self.plan_cache.put(cache_key,
+                TrajectoryArrays.from_msg(res.planned_trajectory.joint_trajectory))
 
           return (res.error_code.val, res)
         else:
           rospy.logerr("Planning response is None")
           return (-31,None)
 
+    # Plan to whichever of several alternative goals MoveIt reaches first:
+    # all goals go into a single MotionPlanRequest as a list of goal
+    # constraints, so failing candidates do not each cost a planning call.
+    # Give either frames (kdl frames, solved with ik()) or q_goals.
+    # Returns (code, res, index) where index is the goal that was reached
+    # (None if planning failed). Goals without an IK solution are skipped.
+    def getPlanAnyOf(self,frames=None,q=None,q_goals=None,obj=None):
+        if frames is None and q_goals is None:
+          raise RuntimeError('Must provide either goal frames or joint states!')
+        if q is None:
+          raise RuntimeError('Must provide starting position!')
+        elif len(q) is not len(self.joint_names):
+          rospy.logerr("Invalid number of joints in getPlanAnyOf starting position setting")
+          return (-31,None,None)
+
+        num_goals = len(frames) if q_goals is None else len(q_goals)
+        cache_keys = [None] * num_goals
+        if self.plan_cache is not None:
+          for i in xrange(num_goals):
+            q_goal = q_goals[i] if q_goals is not None else None
+            T_goal = pm.toMatrix(frames[i]) if q_goals is None else None
+            cache_keys[i] = self.plan_cache.key(q, q_goal, T_goal, obj, self.sceneSignature())
+            res = self.getCachedPlan(cache_keys[i], q, q_goal, T_goal, obj)
+            if res is not None:
+              return (res.error_code.val, res, i)
+
+        motion_req = self.makeMotionPlanRequest(q)
+        goal_indices = []
+        goal_joints = []
+        for i in xrange(num_goals):
+          if q_goals is not None:
+            joints = q_goals[i]
+          else:
+            joints = self.ik(pm.toMatrix(frames[i]),q)
+          if joints is None or len(joints) != len(self.joint_names):
+            rospy.logwarn("Skipping goal %d without a valid joint position"%i)
+            continue
+          (ik_resp, goal) = self.getGoalConstraints(q=q, q_goal=joints)
+          if goal is None:
+            continue
+          motion_req.goal_constraints.append(goal)
+          goal_indices.append(i)
+          goal_joints.append(joints)
+
+        if len(goal_indices) == 0:
+          rospy.logerr("No valid goals for getPlanAnyOf")
+          return (-31,None,None)
+
+        res = self.sendPlanRequest(motion_req, obj)
+        if res is None:
+          rospy.logerr("Planning response is None")
+          return (-31,None,None)
+
+        rospy.logwarn("Done: " + str(res.error_code.val))
+        if res.error_code.val != MoveItErrorCodes.SUCCESS \
+            or len(res.planned_trajectory.joint_trajectory.points) == 0:
+          return (res.error_code.val, res, None)
+
+        # MoveIt does not say which goal was reached; pick the closest one
+        q_end = np.array(res.planned_trajectory.joint_trajectory.points[-1].positions)
+        distance = np.max(np.absolute(np.array(goal_joints) - q_end), axis=1)
+        index = goal_indices[int(np.argmin(distance))]
+
+        self.smoothPlan(res, obj)
+
+        if cache_keys[index] is not None:
+          self.plan_cache.put(cache_keys[index],
+              TrajectoryArrays.from_msg(res.planned_trajectory.joint_trajectory))
+
+        return (res.error_code.val, res, index)
+
+    # Shortcut and smooth the trajectory of a successful MoveIt result in
+    # place. Collisions with obj are ignored, like they are during planning.
+    # The shortcuts are found with the smoothing_validity_checker, and the
+    # final path is only used if the path_validator accepts it. Plans are
+    # not smoothed while an object is attached to the robot, because the
+    # fast checker does not know about attached objects.
+    # The new path is retimed with the TimeParameterization if there is one;
+    # otherwise it keeps the average speed of the original plan.
+    def smoothPlan(self, res, obj=None):
+        if self.path_smoother is None or self.smoothing_validity_checker is None \
+            or self.path_validator is None:
+          return res
+        if self.planning_scene_mirror is not None and self.planning_scene_mirror.hasAttachedObjects():
+          return res
+        traj = TrajectoryArrays.from_msg(res.planned_trajectory.joint_trajectory)
+        if len(traj) < 3:
+          return res
+
+        positions = self.path_smoother.smooth(traj.positions,
+            lambda Q: self.smoothing_validity_checker(Q, obj))
+        length_before = path_length(traj.positions)
+        length_after = path_length(positions)
+        if length_after >= length_before:
+          return res
+
+        try:
+          valid = self.path_validator(positions, obj)
+        except Exception, e:
+          rospy.logwarn("Could not check the smoothed plan: %s"%str(e))
+          valid = False
+        if not valid:
+          rospy.logwarn("Smoothed plan is not valid, using the original plan.")
+          return res
+
+        smoothed = TrajectoryArrays(positions, np.zeros(len(positions)), joint_names=traj.joint_names)
+        if self.time_parameterization is not None:
+          time_before = self.time_parameterization.retime(traj).times[-1]
+          smoothed = self.time_parameterization.retime(smoothed)
+        else:
+          time_before = traj.times[-1]
+          arc_length = np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(positions, axis=0), axis=1))))
+          smoothed = TrajectoryArrays(positions, arc_length * time_before / length_before,
+              joint_names=traj.joint_names)
+        time_after = smoothed.times[-1]
+
+        rospy.loginfo("Smoothed plan: path length %.3f -> %.3f rad, estimated time %.2f -> %.2f s"%(
+          length_before, length_after, time_before, time_after))
+        res.planned_trajectory.joint_trajectory = smoothed.to_msg()
+        return res
+
+    # Look up a plan in the plan cache and check that it can still be used.
+    # Returns a MoveGroupResult like the one MoveIt would send, or None.
+    def getCachedPlan(self, key, q, q_goal=None, T_goal=None, obj=None):
+        traj = self.plan_cache.get(key)
+        if traj is None:
+          return None
+        validity_checker = None
+        if self.validity_checker is not None:
+          validity_checker = lambda Q: self.validity_checker(Q, obj)
+        if not self.plan_cache.revalidate(traj, q, q_goal, T_goal,
+            forward=self.forward,
+            validity_checker=validity_checker):
+          rospy.logwarn("Cached plan is no longer valid, planning again.")
+          self.plan_cache.reject(key)
+          return None
+
+        rospy.loginfo("Reusing cached plan with %d points."%len(traj))
+        return self.planResult(traj, q)
+
+    # MoveGroupResult for a plan from the caches, starting exactly at q.
+    def planResult(self, traj, q):
+        res = MoveGroupResult()
+        res.error_code.val = MoveItErrorCodes.SUCCESS
+        res.trajectory_start.joint_state.name = self.joint_names
+        res.trajectory_start.joint_state.position = list(q)
+        res.planned_trajectory.joint_trajectory = traj.to_msg()
+        # the cached plan may start up to a quantization step away from q
+        res.planned_trajectory.joint_trajectory.points[0].positions = list(q)
+        return res
+
+    # Plan ahead: plan to the goal (a kdl frame or q_goal) from q_start, where
+    # the robot will be once its current motion is done, on a background
+    # thread. When getPlan() is asked for about the same goal from about that
+    # start, it reuses this plan (waiting for it if it is not done yet)
+    # instead of planning again, if it is still valid in the scene by then.
+    # Needs a plan cache. Returns False if nothing was started.
+    def prefetchPlan(self, q_start, frame=None, q_goal=None, obj=None):
+      if self.plan_cache is None or q_start is None:
+        return False
+      T_goal = pm.toMatrix(frame) if q_goal is None else None
+      entry = self.plan_cache.begin_prefetch(self.plan_cache.goal(q_goal, T_goal, obj), q_start)
+      if entry is None:
+        return False
+
+      def plan():
+        traj = None
+        try:
+          (code, res) = self.getPlan(frame=frame, q=q_start, q_goal=q_goal, obj=obj, use_prefetched=False)
+          if res is not None and code == MoveItErrorCodes.SUCCESS:
+            traj = TrajectoryArrays.from_msg(res.planned_trajectory.joint_trajectory)
+          else:
+            rospy.logwarn("Planning ahead failed with code %s"%str(code))
+        except Exception, e:
+          rospy.logerr("Planning ahead failed: %s"%str(e))
+        finally:
+          self.plan_cache.end_prefetch(entry, traj)
+
+      thread = Thread(target=plan)
+      thread.daemon = True
+      thread.start()
+      return True
+
+    # The plan prefetchPlan() made to this goal, if it started close enough
+    # to q and still passes the plan cache checks in the current scene.
+    def getPrefetchedPlan(self, q, q_goal=None, T_goal=None, obj=None):
+      traj = self.plan_cache.take_prefetched(self.plan_cache.goal(q_goal, T_goal, obj), q,
+          self.prefetch_wait)
+      if traj is None:
+        return None
+      validity_checker = None
+      if self.validity_checker is not None:
+        validity_checker = lambda Q: self.validity_checker(Q, obj)
+      if not self.plan_cache.revalidate(traj, q, q_goal, T_goal,
+          forward=self.forward,
+          validity_checker=validity_checker):
+        rospy.logwarn("Plan made ahead of time is no longer valid, planning again.")
+        return None
+
+      rospy.loginfo("Using the plan made ahead of time with %d points."%len(traj))
+      return self.planResult(traj, q)
+
+    # Without a planning scene mirror, call this whenever the planning scene
+    # changes. Cached plans made for an older scene will not be used any more.
+    def updateSceneVersion(self):
+        self.scene_version += 1
+
+    # What cached plans are filed under: the signature of the content of the
+    # mirrored planning scene, or the scene_version without a mirror.
+    def sceneSignature(self):
+        if self.planning_scene_mirror is not None:
+          return self.planning_scene_mirror.signature
+        return self.scene_version
+
     def getPlanWaypoints(self,waypoints_in_kdl_frame,q,obj=None):
       cartesian_path_req = GetCartesianPathRequest()
       cartesian_path_req.header.frame_id = self.base_link
@@ -581,3 +970,225 @@ class SimplePlanning:
         self.updateAllowedCollisions(obj,False)
 
       return (res.error_code.val, res)
+
+    # Local alternative to getPlanWaypoints for short moves such as approaches
+    # and retreats: follows straight lines through the waypoints (kdl frames
+    # in the base frame) without a round trip to MoveIt. Steps are at most
+    # max_translation_step meters and max_rotation_step radians apart and the
+    # result is timed with the usual trapezoidal profile. Like
+    # compute_cartesian_path this does not check for collisions.
+    # Returns (traj, failure_index): failure_index is the index of the first
+    # path step that could not be reached (None if the whole path can be
+    # followed), and traj holds the part of the path before it (None if there
+    # is no such part).
+    def getCartesianPath(self, waypoints_in_kdl_frame, q,
+        max_translation_step=0.005,
+        max_rotation_step=0.02,
+        time_multiplier=1,
+        percent_acc=1):
+
+      if q is None:
+        rospy.logerr("Invalid initial joint position in getCartesianPath")
+        return (None, 0)
+
+      q0 = np.array(q, dtype=float)
+      poses, path_length = interpolate_waypoints(self.forward(q0),
+          [pm.toMatrix(T) for T in waypoints_in_kdl_frame],
+          max_translation_step,
+          max_rotation_step)
+      path, failure_index = self.ikPath(poses, q0, self.max_joint_jump)
+      if failure_index is not None:
+        rospy.logwarn("Cartesian path cannot continue after step %d of %d"%(failure_index,len(poses)))
+      if len(path) == 0:
+        return (None, failure_index)
+
+      positions = np.vstack((q0, path))
+      # total motion of every joint along the path
+      dq_path = np.sum(np.absolute(np.diff(positions, axis=0)), axis=0)
+      if np.max(dq_path) < self.skip_tol:
+        return (TrajectoryArrays([q0], [0.0], joint_names=self.joint_names), failure_index)
+
+      return (self.timePath(positions, path_length, time_multiplier, percent_acc), failure_index)
+
+    # Time a dense joint space path with one trapezoidal profile from rest to
+    # rest, so the robot does not stop anywhere along it, and retime it to
+    # the joint limits if there is a TimeParameterization.
+    def timePath(self, positions, delta_translation, time_multiplier=1, percent_acc=1):
+      # total motion of every joint along the path
+      dq_path = np.sum(np.absolute(np.diff(positions, axis=0)), axis=0)
+      steps, t_v_const_step, t_v_setting_max, steps_to_max_speed, const_velocity_max_step = self.calculateAccelerationProfileParameters(dq_path,
+        len(positions) - 1,
+        0,
+        0,
+        delta_translation,
+        time_multiplier,
+        self.acceleration_magnification * percent_acc)
+
+      times = self.calculateTimeOfTrajectoryStep(np.arange(len(positions)),
+        steps_to_max_speed,
+        const_velocity_max_step,
+        t_v_const_step,
+        t_v_setting_max)
+      traj = TrajectoryArrays(positions, times, joint_names=self.joint_names)
+      return self.retime(traj, time_multiplier, percent_acc)
+
+    # Time a dense joint space path that has to stop at the positions with
+    # the indices in stops: each piece between two stops is timed from rest
+    # to rest with timePath, one after the other. translation is the end
+    # effector translation along the path up to every position (None for
+    # joint space paths).
+    def timePathWithStops(self, positions, stops, translation=None, time_multiplier=1, percent_acc=1):
+      bounds = [0] + sorted(set(int(i) for i in stops if 0 < i < len(positions) - 1)) + [len(positions) - 1]
+      pieces = []
+      t_start = 0.
+      for a, b in zip(bounds[:-1], bounds[1:]):
+        delta_translation = 0. if translation is None else translation[b] - translation[a]
+        piece = self.timePath(positions[a:b+1], delta_translation, time_multiplier, percent_acc)
+        # the first point of a piece is the last one of the previous piece
+        first = 0 if len(pieces) == 0 else 1
+        pieces.append((piece.positions[first:], piece.times[first:] + t_start, piece.velocities[first:]))
+        t_start += piece.times[-1]
+      return TrajectoryArrays(np.concatenate([piece[0] for piece in pieces]),
+          np.concatenate([piece[1] for piece in pieces]),
+          np.concatenate([piece[2] for piece in pieces]),
+          joint_names=self.joint_names)
+
+    # Joint trajectory through timed end effector poses (4x4 matrices in the
+    # base frame), e.g. the samples of a DMP plan. IK is solved for all poses
+    # at once, each solution continuing from the previous one, and the times
+    # are kept, stretched by time_multiplier. With a TimeParameterization,
+    # the path is retimed to go no faster than these times anywhere, but
+    # slower where the joint limits need it: it starts and ends at rest,
+    # even if the first and last poses are far apart.
+    # Returns (traj, failure_index) like getCartesianPath, but traj is None
+    # unless the whole path can be followed.
+    def getTimedCartesianPath(self, poses, times, q, time_multiplier=1):
+
+      if q is None:
+        rospy.logerr("Invalid initial joint position in getTimedCartesianPath")
+        return (None, 0)
+
+      q0 = np.array(q, dtype=float)
+      times = np.asarray(times, dtype=float) * time_multiplier
+      # poses at (or before) the start are where the robot already is
+      start = int(np.searchsorted(times, 0., side='right'))
+      poses = np.asarray(poses, dtype=float)[start:]
+      times = times[start:]
+      if len(poses) == 0:
+        return (TrajectoryArrays([q0], [0.0], joint_names=self.joint_names), None)
+
+      path, failure_index = self.ikPath(poses, q0, self.max_joint_jump)
+      if failure_index is not None:
+        rospy.logwarn("Timed Cartesian path cannot continue after step %d of %d"%(failure_index,len(poses)))
+        return (None, failure_index + start)
+
+      positions = np.vstack((q0, path))
+      times = np.concatenate(([0.], times))
+      traj = TrajectoryArrays(positions, times,
+          central_difference_velocities(positions, times),
+          joint_names=self.joint_names)
+      if self.time_parameterization is not None and len(traj) > 1:
+        traj = self.time_parameterization.retime(traj, follow_times=True)
+        if traj.times[-1] > times[-1] + 1e-6:
+          rospy.logwarn("Slowing the path down from %.2fs to %.2fs to stay within the joint limits"%(
+            times[-1], traj.times[-1]))
+
+      return (traj, None)
+
+    # One joint trajectory through a list of joint space waypoints that does
+    # not stop at the intermediate ones: the corner at waypoint k is rounded
+    # off within blend_radii[k] radians (see blending.py), and the whole path
+    # is timed as a single motion. Waypoints with a radius of zero are sharp
+    # corners, so the motion stops there. Returns TrajectoryArrays, or None.
+    def getBlendedJointMove(self, waypoints, blend_radii, q,
+        resolution=0.01,
+        time_multiplier=1,
+        percent_acc=1):
+
+      if q is None:
+        rospy.logerr("Invalid initial joint position in getBlendedJointMove")
+        return None
+
+      q0 = np.array(q, dtype=float)
+      positions, progress = blend_joint_path(q0, waypoints, blend_radii, resolution)
+      if len(positions) < 2:
+        rospy.logwarn("Robot is already at every waypoint.")
+        return TrajectoryArrays([q0], [0.0], joint_names=self.joint_names)
+      return self.timePathWithStops(positions, stop_indices(progress, blend_radii),
+          time_multiplier=time_multiplier, percent_acc=percent_acc)
+
+    # Same for Cartesian waypoints (kdl frames in the base frame): straight
+    # lines in Cartesian space with the corners rounded off within
+    # blend_radii[k] meters, stopping at the sharp ones. Returns (traj,
+    # failure_index), where failure_index is the index of the first waypoint
+    # that cannot be reached (None if the whole path can be followed); traj is
+    # None unless the whole path can be followed.
+    def getBlendedCartesianPath(self, waypoints_in_kdl_frame, blend_radii, q,
+        max_translation_step=0.005,
+        max_rotation_step=0.02,
+        time_multiplier=1,
+        percent_acc=1):
+
+      if q is None:
+        rospy.logerr("Invalid initial joint position in getBlendedCartesianPath")
+        return (None, 0)
+
+      q0 = np.array(q, dtype=float)
+      poses, progress, path_length = blend_cartesian_path(self.forward(q0),
+          [pm.toMatrix(T) for T in waypoints_in_kdl_frame],
+          blend_radii,
+          max_translation_step,
+          max_rotation_step)
+      if len(poses) == 0:
+        rospy.logwarn("Robot is already at every waypoint.")
+        return (TrajectoryArrays([q0], [0.0], joint_names=self.joint_names), None)
+
+      path, failure_index = self.ikPath(poses, q0, self.max_joint_jump)
+      if failure_index is not None:
+        # progress k + f lies between waypoint k - 1 and waypoint k
+        waypoint = int(np.ceil(progress[failure_index])) - 1
+        rospy.logwarn("Blended Cartesian path cannot reach waypoint %d of %d"%(
+          waypoint, len(waypoints_in_kdl_frame)))
+        return (None, waypoint)
+
+      positions = np.vstack((q0, path))
+      stops = stop_indices(np.concatenate(([0.], progress)), blend_radii)
+      if len(stops) == 0:
+        return (self.timePath(positions, path_length, time_multiplier, percent_acc), None)
+      points = np.vstack((self.forward(q0)[0:3,3], poses[:,0:3,3]))
+      translation = np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))))
+      return (self.timePathWithStops(positions, stops, translation, time_multiplier, percent_acc), None)
+
+    # Estimated durations of straight joint moves from q0 to every row of
+    # q_goals, timed like getJointMove times them (retimed to the joint
+    # limits if there is a TimeParameterization), without building the
+    # trajectories. delta_translation is the end effector translation of
+    # each move for Cartesian moves. Returns an array of seconds.
+    def estimateMoveTimes(self, q_goals, q0,
+        base_steps=1000,
+        steps_per_meter=1000,
+        steps_per_radians=4,
+        time_multiplier=1,
+        percent_acc=1,
+        delta_translation=0.):
+
+      dq = np.atleast_2d(np.asarray(q_goals, dtype=float)) - np.asarray(q0, dtype=float)
+      if self.time_parameterization is not None:
+        return time_optimal_move_durations(dq,
+            self.time_parameterization.max_velocities / time_multiplier,
+            self.time_parameterization.max_accelerations * self.acceleration_magnification * percent_acc)
+      return trapezoidal_move_durations(dq,
+          base_steps,
+          steps_per_meter,
+          steps_per_radians,
+          delta_translation,
+          time_multiplier,
+          self.acceleration_magnification * percent_acc)
+
+    # Estimated duration of following the joint space path through positions
+    # from rest to rest, timed like the paths of getCartesianPath.
+    def estimatePathTime(self, positions, time_multiplier=1, percent_acc=1):
+      positions = np.asarray(positions, dtype=float)
+      if len(positions) < 2 or np.max(np.absolute(np.diff(positions, axis=0))) < self.skip_tol:
+        return 0.
+      return self.timePath(positions, 0., time_multiplier, percent_acc).times[-1]
@@ -0,0 +1,262 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import copy
+import hashlib
+import rospy
+
+from moveit_msgs.msg import *
+from moveit_msgs.srv import *
+
+from StringIO import StringIO
+from threading import Lock
+
+def _with_stamp(obj, stamp):
+    '''
+    Copy of the CollisionObject obj with its header stamp set to stamp.
+    '''
+    obj = copy.copy(obj)
+    obj.header = copy.copy(obj.header)
+    obj.header.stamp = stamp
+    return obj
+
+def _same_collision_object(a, b):
+    '''
+    True if the CollisionObjects a and b describe the same object. The header
+    stamps are not compared; they change with every update.
+    '''
+    if a is None or b is None:
+        return a is b
+    return a == _with_stamp(b, a.header.stamp)
+
+def _same_attached_object(a, b):
+    '''
+    True if the AttachedCollisionObjects a and b describe the same attached
+    body. The header stamps are not compared; they change with every update.
+    '''
+    if a is None or b is None:
+        return a is b
+    b = copy.copy(b)
+    b.object = _with_stamp(b.object, a.object.header.stamp)
+    return a == b
+
+def _same_objects(a, b, same):
+    '''
+    True if the dicts a and b hold the same ids and same() holds for every
+    pair of objects with the same id.
+    '''
+    if set(a.keys()) != set(b.keys()):
+        return False
+    return all(same(a[key], b[key]) for key in a)
+
+def _scene_signature(world_objects, attached_objects):
+    '''
+    Hash of the world and attached objects (without their stamps). It only
+    depends on the content, so it is the same for the same scene in every
+    session.
+    '''
+    digest = hashlib.sha1()
+    for objects in (world_objects, attached_objects):
+        for key in sorted(objects.keys()):
+            msg = objects[key]
+            if isinstance(msg, AttachedCollisionObject):
+                msg = copy.copy(msg)
+                msg.object = _with_stamp(msg.object, rospy.Time())
+            else:
+                msg = _with_stamp(msg, rospy.Time())
+            buff = StringIO()
+            msg.serialize(buff)
+            digest.update(buff.getvalue())
+        digest.update('/')
+    return digest.hexdigest()
+
+# PLANNING SCENE MIRROR
+# Local copy of the parts of the MoveIt planning scene that CoSTAR works
+# with: the world collision objects, the objects attached to the robot and
+# the allowed collision matrix. It is filled with one get_planning_scene call
+# and then kept up to date from the scene updates move_group publishes.
+#
+# Changes made through the mirror are applied locally right away and sent to
+# move_group as small diffs through a single long lived publisher, so reading
+# or editing the scene does not need any service calls.
+#
+# version is incremented every time the world, the attached objects or the
+# allowed collision matrix change; on_change (if given) is called after that.
+# Only changes of the content count: the monitored scene repeats the attached
+# objects with every robot state update, full scenes repeat everything, and
+# move_group sends every diff published through the mirror back to it. None
+# of these change the objects (stamps aside), so they leave version alone.
+#
+# signature is a hash of the world and attached objects. Unlike version it
+# comes back to the same value when the scene does, e.g. every time the same
+# object is picked up in a loop, and it is the same across sessions.
+class PlanningSceneMirror(object):
+
+    def __init__(self,
+            monitored_scene_topic="move_group/monitored_planning_scene",
+            planning_scene_topic="planning_scene",
+            get_planning_scene_service="get_planning_scene",
+            on_change=None):
+        self.mtx = Lock()
+        self.world_objects = {}
+        self.attached_objects = {}
+        self.acm = AllowedCollisionMatrix()
+        self.version = 0
+        self.signature = _scene_signature(self.world_objects, self.attached_objects)
+        self.on_change = on_change
+
+        self.publisher = rospy.Publisher(planning_scene_topic, PlanningScene, queue_size=100)
+
+        rospy.wait_for_service(get_planning_scene_service, 10.0)
+        get_planning_scene = rospy.ServiceProxy(get_planning_scene_service, GetPlanningScene)
+        components = PlanningSceneComponents.WORLD_OBJECT_GEOMETRY \
+                | PlanningSceneComponents.ROBOT_STATE_ATTACHED_OBJECTS \
+                | PlanningSceneComponents.ALLOWED_COLLISION_MATRIX
+        res = get_planning_scene(PlanningSceneComponents(components=components))
+        self.apply(res.scene)
+
+        self.subscriber = rospy.Subscriber(monitored_scene_topic, PlanningScene, self.scene_cb)
+
+    def scene_cb(self, msg):
+        self.apply(msg)
+
+    def apply(self, scene):
+        '''
+        Update the mirror from a (full or diff) PlanningScene message.
+        '''
+        with self.mtx:
+            if scene.is_diff:
+                world_objects = dict(self.world_objects)
+                attached_objects = dict(self.attached_objects)
+            else:
+                world_objects = {}
+                attached_objects = {}
+            for obj in scene.world.collision_objects:
+                self._apply_world_object(world_objects, obj)
+            for attached in scene.robot_state.attached_collision_objects:
+                if attached.object.operation == CollisionObject.REMOVE:
+                    if len(attached.object.id) == 0:
+                        attached_objects = {}
+                    else:
+                        attached_objects.pop(attached.object.id, None)
+                else:
+                    attached_objects[attached.object.id] = attached
+            acm = self.acm
+            if len(scene.allowed_collision_matrix.entry_names) > 0 \
+                    or len(scene.allowed_collision_matrix.default_entry_names) > 0:
+                acm = scene.allowed_collision_matrix
+
+            changed = acm != self.acm \
+                    or not _same_objects(self.world_objects, world_objects, _same_collision_object) \
+                    or not _same_objects(self.attached_objects, attached_objects, _same_attached_object)
+            self.world_objects = world_objects
+            self.attached_objects = attached_objects
+            self.acm = acm
+            if changed:
+                self.version += 1
+                self.signature = _scene_signature(world_objects, attached_objects)
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def _apply_world_object(self, world_objects, obj):
+        if obj.operation == CollisionObject.REMOVE:
+            if len(obj.id) == 0:
+                world_objects.clear()
+            else:
+                world_objects.pop(obj.id, None)
+        elif obj.operation == CollisionObject.MOVE and obj.id in world_objects:
+            moved = copy.copy(world_objects[obj.id])
+            moved.header = obj.header
+            if len(obj.primitive_poses) > 0:
+                moved.primitive_poses = obj.primitive_poses
+            if len(obj.mesh_poses) > 0:
+                moved.mesh_poses = obj.mesh_poses
+            if len(obj.plane_poses) > 0:
+                moved.plane_poses = obj.plane_poses
+            world_objects[obj.id] = moved
+        else:
+            world_objects[obj.id] = obj
+
+    def publish(self, scene_diff):
+        '''
+        Apply a diff locally and send it to move_group.
+        '''
+        scene_diff.is_diff = True
+        scene_diff.robot_state.is_diff = True
+        self.apply(scene_diff)
+        self.publisher.publish(scene_diff)
+
+    def getCollisionObjects(self):
+        with self.mtx:
+            return [copy.deepcopy(obj) for obj in self.world_objects.values()]
+
+    def getCollisionObject(self, object_name):
+        '''
+        Copy of a world collision object, or None.
+        '''
+        with self.mtx:
+            obj = self.world_objects.get(object_name, None)
+            return copy.deepcopy(obj) if obj is not None else None
+
+    def getAttachedObjects(self):
+        with self.mtx:
+            return [copy.deepcopy(obj) for obj in self.attached_objects.values()]
+
+    def hasAttachedObjects(self):
+        with self.mtx:
+            return len(self.attached_objects) > 0
+
+    def getAllowedCollisionMatrix(self, obj, allowed):
+        '''
+        Copy of the allowed collision matrix with collisions with obj allowed
+        or not. Does not change the scene.
+        '''
+        with self.mtx:
+            acm = copy.deepcopy(self.acm)
+        if not obj in acm.default_entry_names:
+            acm.default_entry_names += [obj]
+            acm.default_entry_values += [allowed]
+        else:
+            idx = acm.default_entry_names.index(obj)
+            acm.default_entry_values[idx] = allowed
+        return acm
+
+    def setAllowedCollisions(self, obj, allowed):
+        self.publish(PlanningScene(allowed_collision_matrix=self.getAllowedCollisionMatrix(obj, allowed)))
+
+    def removeObject(self, object_name):
+        '''
+        Remove a collision object from the world. Returns the removed object,
+        or None if there is no such object.
+        '''
+        obj = self.getCollisionObject(object_name)
+        if obj is None:
+            return None
+        scene_diff = PlanningScene()
+        scene_diff.world.collision_objects.append(CollisionObject(id=object_name,
+            header=obj.header,
+            operation=CollisionObject.REMOVE))
+        self.publish(scene_diff)
+        return obj
+
+    def attachObject(self, object_name, link_name, frame_id):
+        '''
+        Move a world collision object onto link_name. Returns False if there
+        is no such object.
+        '''
+        obj = self.getCollisionObject(object_name)
+        if obj is None:
+            return False
+        scene_diff = PlanningScene()
+        scene_diff.world.collision_objects.append(CollisionObject(id=object_name,
+            header=obj.header,
+            operation=CollisionObject.REMOVE))
+        attached_object = AttachedCollisionObject()
+        attached_object.object = obj
+        attached_object.link_name = link_name
+        attached_object.object.header.frame_id = frame_id
+        attached_object.object.operation = CollisionObject.ADD
+        scene_diff.robot_state.attached_collision_objects.append(attached_object)
+        self.publish(scene_diff)
+        return True
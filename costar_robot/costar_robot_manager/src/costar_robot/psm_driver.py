@@ -72,7 +72,7 @@ class CostarPSMDriver(CostarArm):
     def marker_cbback(self,data):
         (self.last_marker_trans,self.last_marker_rot) = pm.toTf(pm.fromMsg(data.pose))
 
-    def handle_tick(self):
+    def broadcast_tf(self):
         br = tf.TransformBroadcaster()
         br.sendTransform((0, 0, 0), tf.transformations.quaternion_from_euler(0, 0, 0), rospy.Time.now(), "/base_link",
                          self.base_link)
@@ -0,0 +1,194 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import yaml
+import numpy as np
+
+# REACHABILITY MAP
+# Precomputed answer to "can the arm reach this pose at all?" for a whole
+# workspace. The workspace (in the robot base frame) is cut into cubic voxels
+# and the end effector orientation into bins; every (voxel, orientation bin)
+# pair has one bit that says whether any sampled joint configuration put the
+# end effector there.
+#
+# Orientation bins: the approach axis of the tool (a column of the rotation
+# matrix) is binned with a cube map (6 faces of n x n cells) and the rotation
+# around it into roll_bins sectors.
+#
+# The map is built offline by sampling joint space with forward kinematics
+# (see scripts/build_reachability_map.py) and dilated by a voxel, so it errs
+# on the side of "reachable": it is meant as a cheap first-pass filter in
+# front of real IK, not a replacement for it. Poses outside the bounds are
+# looked up in the nearest voxel on the border.
+#
+# The bits are stored as a .npy file, which load() memory maps, next to a
+# .yaml file with the parameters of the map.
+class ReachabilityMap(object):
+
+    def __init__(self, bounds,
+            voxel_size=0.05,
+            directions_per_face=2,
+            roll_bins=4,
+            approach_axis=0,
+            base_link="",
+            end_link="",
+            data=None):
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.voxel_size = voxel_size
+        self.directions_per_face = directions_per_face
+        self.roll_bins = roll_bins
+        self.approach_axis = approach_axis
+        self.base_link = base_link
+        self.end_link = end_link
+
+        self.shape = tuple(np.maximum(1, np.ceil(
+            (self.bounds[:,1] - self.bounds[:,0]) / voxel_size).astype(int)))
+        self.num_orientations = 6 * directions_per_face**2 * roll_bins
+        if data is None:
+            data = np.zeros(self.shape + ((self.num_orientations + 7) // 8,), dtype=np.uint8)
+        self.data = data
+
+    def voxel_indices(self, positions):
+        '''
+        (N, 3) voxel indices of (N, 3) positions, clipped to the map.
+        '''
+        idx = np.floor((np.asarray(positions) - self.bounds[:,0]) / self.voxel_size).astype(int)
+        return np.clip(idx, 0, np.array(self.shape) - 1)
+
+    def orientation_bins(self, R):
+        '''
+        Orientation bin of each of the (N, 3, 3) rotation matrices R.
+        '''
+        a = R[:,:,self.approach_axis]
+        b = R[:,:,(self.approach_axis + 1) % 3]
+        n = self.directions_per_face
+        rows = np.arange(len(R))
+
+        # cube map face and cell of the approach axis
+        axis = np.argmax(np.absolute(a), axis=1)
+        major = a[rows, axis]
+        face = 2 * axis + (major < 0)
+        u = a[rows, (axis + 1) % 3] / np.absolute(major)
+        v = a[rows, (axis + 2) % 3] / np.absolute(major)
+        cell_u = np.clip(np.floor((u + 1) * 0.5 * n).astype(int), 0, n - 1)
+        cell_v = np.clip(np.floor((v + 1) * 0.5 * n).astype(int), 0, n - 1)
+
+        # roll: angle of b around a, measured from the next base axis of the
+        # face projected onto the plane normal to a (never parallel to a)
+        ref = np.zeros(a.shape)
+        ref[rows, (axis + 1) % 3] = 1.
+        e1 = ref - np.sum(ref * a, axis=1)[:,np.newaxis] * a
+        e1 /= np.linalg.norm(e1, axis=1)[:,np.newaxis]
+        e2 = np.cross(a, e1)
+        roll = np.arctan2(np.sum(b * e2, axis=1), np.sum(b * e1, axis=1))
+        roll_bin = np.clip(np.floor((roll + np.pi) / (2 * np.pi) * self.roll_bins).astype(int),
+                0, self.roll_bins - 1)
+
+        return ((face * n + cell_u) * n + cell_v) * self.roll_bins + roll_bin
+
+    def _bits(self, Ts):
+        Ts = np.asarray(Ts, dtype=float)
+        if Ts.ndim == 2:
+            Ts = Ts[np.newaxis]
+        idx = self.voxel_indices(Ts[:,0:3,3])
+        o = self.orientation_bins(Ts[:,0:3,0:3])
+        return (idx[:,0], idx[:,1], idx[:,2], o >> 3), (128 >> (o & 7)).astype(np.uint8)
+
+    def mark(self, Ts):
+        '''
+        Mark the (N, 4, 4) end effector poses Ts as reachable.
+        '''
+        cell, bit = self._bits(Ts)
+        np.bitwise_or.at(self.data, cell, bit)
+
+    def reachable(self, Ts):
+        '''
+        One bool per (N, 4, 4) pose in Ts: False means the pose is (almost
+        certainly) out of reach, True that it is worth trying IK.
+        '''
+        cell, bit = self._bits(Ts)
+        return (self.data[cell] & bit) != 0
+
+    def dilate(self, steps=1):
+        '''
+        Also mark every voxel next to a reachable one, for every orientation
+        bin, to cover voxels that the sampling only just missed.
+        '''
+        for step in xrange(steps):
+            data = self.data.copy()
+            for axis in xrange(3):
+                lo = [slice(None)] * 4
+                hi = [slice(None)] * 4
+                lo[axis] = slice(0, -1)
+                hi[axis] = slice(1, None)
+                data[tuple(lo)] |= self.data[tuple(hi)]
+                data[tuple(hi)] |= self.data[tuple(lo)]
+            self.data = data
+
+    def fraction_reachable(self):
+        '''
+        Fraction of all (voxel, orientation bin) pairs that are reachable.
+        '''
+        set_bits = np.unpackbits(np.asarray(self.data).ravel()).sum()
+        return set_bits / float(np.prod(self.shape) * self.num_orientations)
+
+    def save(self, filename):
+        '''
+        Write the bits to filename (.npy) and the parameters to filename.yaml.
+        '''
+        if not filename.endswith('.npy'):
+            filename += '.npy'
+        np.save(filename, self.data)
+        with open(filename + '.yaml', 'w') as f:
+            yaml.safe_dump({'bounds': self.bounds.tolist(),
+                'voxel_size': float(self.voxel_size),
+                'directions_per_face': int(self.directions_per_face),
+                'roll_bins': int(self.roll_bins),
+                'approach_axis': int(self.approach_axis),
+                'base_link': self.base_link,
+                'end_link': self.end_link}, f)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Memory map a map written with save().
+        '''
+        if not filename.endswith('.npy'):
+            filename += '.npy'
+        with open(filename + '.yaml', 'r') as f:
+            params = yaml.safe_load(f)
+        return cls(data=np.load(filename, mmap_mode='r'), **params)
+
+def build_reachability_map(forward_batch, limits_lower, limits_upper,
+        num_samples=10000000,
+        batch_size=100000,
+        dilate=1,
+        seed=None,
+        **kwargs):
+    '''
+    Build a ReachabilityMap by sampling num_samples joint configurations
+    uniformly within the joint limits. forward_batch maps an (N, dof) array
+    of joint positions to (N, 4, 4) end effector poses in the base frame.
+    The bounds of the map are taken from the first batch of samples, with a
+    margin of two voxels; kwargs go to the ReachabilityMap constructor.
+    '''
+    random = np.random.RandomState(seed)
+    limits_lower = np.asarray(limits_lower, dtype=float)
+    limits_upper = np.asarray(limits_upper, dtype=float)
+    reachability_map = None
+    remaining = num_samples
+    while remaining > 0:
+        n = min(batch_size, remaining)
+        Q = random.uniform(limits_lower, limits_upper, (n, len(limits_lower)))
+        Ts = np.asarray(forward_batch(Q))
+        if reachability_map is None:
+            voxel_size = kwargs.get('voxel_size', 0.05)
+            positions = Ts[:,0:3,3]
+            bounds = np.column_stack((positions.min(axis=0) - 2 * voxel_size,
+                positions.max(axis=0) + 2 * voxel_size))
+            reachability_map = ReachabilityMap(bounds, **kwargs)
+        reachability_map.mark(Ts)
+        remaining -= n
+    reachability_map.dilate(dilate)
+    return reachability_map
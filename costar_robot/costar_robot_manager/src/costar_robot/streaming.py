@@ -0,0 +1,108 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import time
+import rospy
+import numpy as np
+
+from trajectory_msgs.msg import JointTrajectoryPoint
+
+from trajectory import TrajectoryArrays
+
+try:
+    from time import monotonic as clock
+except ImportError:
+    # python 2 has no monotonic clock; see StreamingExecutor.time_source()
+    from time import time as clock
+
+# STREAMING EXECUTOR
+# Follows a joint trajectory on robots that take one joint position at a
+# time (the IIWA, the simulated UR5, the PSM): instead of sending every
+# trajectory point and sleeping until the next one, the trajectory is
+# interpolated and a setpoint is sent every 1/rate seconds.
+#
+# Every cycle has an absolute deadline (start + k / rate), so timing errors
+# do not add up. A cycle that starts more than one period late skips the
+# setpoints it missed instead of sending them in a burst. How late cycles
+# were is kept in stats for the last trajectory. Under /use_sim_time the
+# deadlines are in ROS time, like rospy.Rate, so a simulation that runs
+# slower or faster than real time is streamed to at its own pace.
+#
+# publish is called with a JointTrajectoryPoint for every setpoint.
+# execute() runs on the calling thread and returns after the last setpoint.
+class StreamingExecutor(object):
+
+    def __init__(self, publish, rate=250.):
+        self.publish = publish
+        self.rate = rate
+        self.stats = {}
+
+    def time_source(self):
+        '''
+        (now, sleep) functions for the deadlines of execute(): ROS time under
+        /use_sim_time, and otherwise a monotonic clock. Python 2 has none, so
+        there the wall clock is used instead; since the deadlines are
+        absolute that still does not drift, but setting the wall clock back
+        (or forward) during a trajectory stalls (or skips) setpoints.
+        '''
+        if rospy.get_param('/use_sim_time', False):
+            return rospy.get_time, rospy.sleep
+        return clock, time.sleep
+
+    def execute(self, traj, is_valid=None):
+        '''
+        Stream the JointTrajectory traj. is_valid is checked every cycle;
+        streaming stops as soon as it returns False. Returns True if the
+        whole trajectory was sent.
+        '''
+        if len(traj.points) == 0:
+            return True
+        arrays = TrajectoryArrays.from_msg(traj)
+        duration = arrays.times[-1]
+        period = 1. / self.rate
+        now, sleep = self.time_source()
+
+        cycles = 0
+        missed = 0
+        late = []
+        completed = True
+        start = now()
+        cycle = 0
+        while True:
+            if is_valid is not None and not is_valid():
+                completed = False
+                break
+
+            t = min(cycle * period, duration)
+            q, dq = arrays.sample(t)
+            self.publish(JointTrajectoryPoint(positions=q.tolist(),
+                velocities=dq.tolist(),
+                time_from_start=rospy.Duration(t)))
+            cycles += 1
+            if t >= duration:
+                break
+
+            cycle += 1
+            lateness = now() - (start + cycle * period)
+            if lateness > period:
+                # skip the setpoints we are too late for
+                skip = int(lateness / period)
+                missed += skip
+                cycle += skip
+                lateness -= skip * period
+            if lateness < 0:
+                sleep(-lateness)
+            else:
+                late.append(lateness)
+
+        self.stats = {'cycles': cycles,
+                'missed_cycles': missed,
+                'late_cycles': len(late),
+                'max_lateness': max(late) if len(late) > 0 else 0.,
+                'mean_lateness': np.mean(late) if len(late) > 0 else 0.,
+                'duration': now() - start}
+        if missed > 0:
+            rospy.logwarn("Streaming at %g Hz missed %d of %d setpoints (max lateness %.4f s)"%(
+                self.rate, missed, cycles + missed, self.stats['max_lateness']))
+        return completed
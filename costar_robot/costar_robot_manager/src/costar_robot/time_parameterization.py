@@ -0,0 +1,271 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import numpy as np
+
+from trajectory import TrajectoryArrays
+
+# TIME PARAMETERIZATION
+# Retimes a joint space path (the positions of a trajectory) so that it is
+# followed as fast as the joint velocity and acceleration limits allow. The
+# path is treated as a polyline through the trajectory points: on every
+# segment the path speed is limited by the joint that has to move fastest,
+# the speed at every point is limited by the acceleration needed to turn the
+# corner there, and a forward and a backward pass over the points turn this
+# into a trapezoidal speed profile that starts and ends at rest.
+#
+# The drivers do not follow the polyline but the cubic Hermite segments
+# through the positions and velocities of the points. The velocities are
+# those of the cubic spline through the points at their times (continuous in
+# acceleration, at rest at both ends), so they agree with the timing; where
+# that spline still exceeds a limit, the segments around it are slowed down
+# and the speed is planned again, so that a noisy stretch of the path does
+# not slow down all of it.
+#
+# Velocity limits come from the URDF. URDF has no acceleration limits, so
+# those are taken from the MoveIt joint_limits parameters if they are given,
+# and default to the velocity limit (full speed after one second) otherwise.
+class TimeParameterization(object):
+
+    def __init__(self, max_velocities, max_accelerations):
+        self.max_velocities = np.asarray(max_velocities, dtype=float)
+        self.max_accelerations = np.asarray(max_accelerations, dtype=float)
+
+    @classmethod
+    def from_urdf(cls, robot, joint_names, acceleration_limits={}, default_velocity=1.0):
+        '''
+        Limits of joint_names from a urdf_parser_py robot model.
+        acceleration_limits maps joint names to acceleration limits.
+        '''
+        joints = dict((joint.name, joint) for joint in robot.joints)
+        max_velocities = []
+        max_accelerations = []
+        for name in joint_names:
+            limit = getattr(joints[name], 'limit', None)
+            velocity = default_velocity
+            if limit is not None and limit.velocity is not None and limit.velocity > 0:
+                velocity = limit.velocity
+            max_velocities.append(velocity)
+            max_accelerations.append(acceleration_limits.get(name, velocity))
+        return cls(max_velocities, max_accelerations)
+
+    def retime(self, traj, velocity_scale=1., acceleration_scale=1., follow_times=False):
+        '''
+        Time optimal TrajectoryArrays through the points of traj, with the
+        limits scaled by velocity_scale and acceleration_scale. Repeated
+        points are dropped. With follow_times, no segment is traversed faster
+        than in traj, so its timing is kept wherever the limits allow it.
+        '''
+        moving = moving_points(traj.positions)
+        positions = traj.positions[moving]
+        max_speeds = None
+        if follow_times:
+            with np.errstate(divide='ignore'):
+                max_speeds = np.linalg.norm(np.diff(positions, axis=0), axis=1) \
+                        / np.diff(traj.times[moving])
+        times, velocities = time_optimal_parameterization(positions,
+            self.max_velocities * velocity_scale,
+            self.max_accelerations * acceleration_scale,
+            max_speeds=max_speeds)
+        return TrajectoryArrays(positions, times, velocities, joint_names=traj.joint_names)
+
+    def retime_msg(self, traj, velocity_scale=1., acceleration_scale=1.):
+        '''
+        Same as retime() for a JointTrajectory message.
+        '''
+        if len(traj.points) < 2:
+            return traj
+        return self.retime(TrajectoryArrays.from_msg(traj),
+            velocity_scale, acceleration_scale).to_msg()
+
+def moving_points(positions):
+    '''
+    Mask of the positions (N x dof) that are not repeats of the one before.
+    '''
+    moving = np.ones(len(positions), dtype=bool)
+    moving[1:] = np.any(np.diff(positions, axis=0) != 0, axis=1)
+    return moving
+
+def retimed_point_times(positions, retimed_times):
+    '''
+    Time of each of the positions (N x dof) in the trajectory that retime()
+    made from them, given its times. A repeated point is reached at the same
+    time as the one it repeats.
+    '''
+    return np.asarray(retimed_times)[np.cumsum(moving_points(positions)) - 1]
+
+def segment_durations(lengths, v_start, v_end, v_max, a_max):
+    '''
+    Shortest time to cover each segment, starting at v_start and ending at
+    v_end, without going faster than v_max or accelerating faster than a_max.
+    The end speeds must be reachable from each other within the segment.
+    '''
+    v_peak = np.sqrt((2 * a_max * lengths + v_start**2 + v_end**2) / 2)
+    triangle = v_peak <= v_max
+    v_top = np.where(triangle, v_peak, v_max)
+    t_acc = (v_top - v_start) / a_max
+    t_dec = (v_top - v_end) / a_max
+    d_cruise = lengths - (v_top**2 - v_start**2) / (2 * a_max) - (v_top**2 - v_end**2) / (2 * a_max)
+    t_cruise = np.where(triangle, 0., np.maximum(d_cruise, 0.) / v_top)
+    return t_acc + t_dec + t_cruise
+
+def speed_profile(v_cap, lengths, a_segment):
+    '''
+    Fastest path speed at every point that respects v_cap and can be reached
+    from rest at the start and still stop at the end.
+    '''
+    # forward pass: how fast we can be after accelerating from the start;
+    # backward pass: how fast we can be and still stop at the end
+    v = v_cap.copy()
+    for k in xrange(len(v) - 1):
+        v[k+1] = min(v[k+1], np.sqrt(v[k]**2 + 2 * a_segment[k] * lengths[k]))
+    for k in xrange(len(v) - 2, -1, -1):
+        v[k] = min(v[k], np.sqrt(v[k+1]**2 + 2 * a_segment[k] * lengths[k]))
+    return v
+
+def spline_velocities(durations, dq):
+    '''
+    Joint velocities at the points of the cubic spline with segment durations
+    (M,) and position changes dq (M, dof) that is at rest at both ends and has
+    continuous accelerations. Returns (M + 1, dof).
+    '''
+    num_points = len(dq) + 1
+    velocities = np.zeros((num_points, dq.shape[1]))
+    if num_points < 3:
+        return velocities
+    slopes = dq / durations[:,np.newaxis]
+    # tridiagonal system for the interior velocities, solved with the
+    # Thomas algorithm for all joints at once
+    lower = 1. / durations[:-1]
+    upper = 1. / durations[1:]
+    diagonal = 2. * (lower + upper)
+    rhs = 3. * (slopes[:-1] * lower[:,np.newaxis] + slopes[1:] * upper[:,np.newaxis])
+    c = np.zeros(num_points - 2)
+    d = np.zeros(rhs.shape)
+    c[0] = upper[0] / diagonal[0]
+    d[0] = rhs[0] / diagonal[0]
+    for k in xrange(1, num_points - 2):
+        pivot = diagonal[k] - lower[k] * c[k-1]
+        c[k] = upper[k] / pivot
+        d[k] = (rhs[k] - lower[k] * d[k-1]) / pivot
+    for k in xrange(num_points - 4, -1, -1):
+        d[k] -= c[k] * d[k+1]
+    velocities[1:-1] = d
+    return velocities
+
+def hermite_peaks(durations, dq, v0, v1):
+    '''
+    Largest absolute joint velocities and accelerations (both (M, dof)) on
+    the cubic Hermite segments with the given durations, position changes
+    and joint velocities at their start (v0) and end (v1).
+    '''
+    h = durations[:,np.newaxis]
+    slopes = dq / h
+    # the velocity is a * s**2 + b * s + v0 in the fraction s of the segment
+    a = 3 * (v0 + v1) - 6 * slopes
+    b = 6 * slopes - 4 * v0 - 2 * v1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.clip(-b / (2 * a), 0., 1.)
+    s = np.where(np.isnan(s), 0., s)
+    peak_velocities = np.maximum(np.maximum(np.absolute(v0), np.absolute(v1)),
+        np.absolute((a * s + b) * s + v0))
+    # the acceleration is linear in s, so it peaks at one of the ends
+    peak_accelerations = np.maximum(np.absolute(b), np.absolute(2 * a + b)) / h
+    return peak_velocities, peak_accelerations
+
+def time_optimal_parameterization(positions, max_velocities, max_accelerations,
+        max_iterations=50, tolerance=0.01, max_speeds=None):
+    '''
+    Times and joint velocities for following the polyline through positions
+    (N x dof, no repeated points) from rest to rest as fast as the limits
+    allow, and no faster than the path speeds max_speeds (one per segment)
+    if they are given. The speed along the path is planned with joint
+    accelerations (by finite differences between segments), and then with
+    the cubic Hermite segments through the times and velocities, within
+    tolerance of the limits, unless that takes more than max_iterations
+    corrections; the Hermite segments through the returned times and
+    velocities stay within the limits. Returns (times, velocities).
+    '''
+    positions = np.asarray(positions, dtype=float)
+    num_points = len(positions)
+    if num_points < 2:
+        return np.zeros(num_points), np.zeros(positions.shape)
+
+    dq = np.diff(positions, axis=0)
+    lengths = np.linalg.norm(dq, axis=1)
+    directions = dq / lengths[:,np.newaxis]
+
+    # fastest path speed and acceleration the joints allow on each segment
+    with np.errstate(divide='ignore'):
+        v_segment = np.min(max_velocities / np.absolute(directions), axis=1)
+        a_segment = np.min(max_accelerations / np.absolute(directions), axis=1)
+    if max_speeds is not None:
+        v_segment = np.minimum(v_segment, max_speeds)
+
+    # turning a corner at speed v changes the joint velocities by
+    # v * (d_k - d_k-1) within about half of each neighbouring segment
+    v_cap = np.zeros(num_points)
+    if num_points > 2:
+        turn = np.absolute(np.diff(directions, axis=0))
+        half_lengths = 0.5 * (lengths[:-1] + lengths[1:])
+        with np.errstate(divide='ignore'):
+            v_corner = np.min(np.sqrt(max_accelerations * half_lengths[:,np.newaxis] / turn), axis=1)
+        v_cap[1:-1] = np.minimum(np.minimum(v_segment[:-1], v_segment[1:]), v_corner)
+
+    # tangential and centripetal acceleration add up on curved paths; lower
+    # the speed wherever the resulting joint accelerations are too high
+    for iteration in xrange(max_iterations):
+        v = speed_profile(v_cap, lengths, a_segment)
+        durations = segment_durations(lengths, v[:-1], v[1:], v_segment, a_segment)
+        if num_points < 3:
+            break
+        segment_velocities = dq / durations[:,np.newaxis]
+        accelerations = np.diff(segment_velocities, axis=0) \
+                / (0.5 * (durations[:-1] + durations[1:]))[:,np.newaxis]
+        ratio = np.max(np.absolute(accelerations) / max_accelerations, axis=1)
+        too_fast = ratio > 1. + tolerance
+        if not np.any(too_fast):
+            break
+        v_cap[1:-1][too_fast] = v[1:-1][too_fast] / np.sqrt(ratio[too_fast])
+
+    # the cubic spline through the points bulges between them, most where
+    # the path is noisy. Slowing a segment down by a factor c divides its
+    # spline velocities by c and its accelerations by c**2, so lower the
+    # speed and acceleration limits of the segments that exceed the limits
+    # by their factor, and of the segments around them by a factor that
+    # shrinks with the distance (so that the speed changes gently instead
+    # of making the spline bulge again), and plan the speed again
+    for iteration in xrange(max_iterations):
+        if num_points < 3:
+            break
+        velocities = spline_velocities(durations, dq)
+        peak_velocities, peak_accelerations = hermite_peaks(durations, dq,
+            velocities[:-1], velocities[1:])
+        ratio = np.maximum(np.max(peak_velocities / max_velocities, axis=1),
+            np.sqrt(np.max(peak_accelerations / max_accelerations, axis=1)))
+        too_fast = ratio > 1. + tolerance
+        if not np.any(too_fast):
+            break
+        log_slowdown = np.where(too_fast, np.log(ratio), 0.)
+        for k in xrange(1, len(log_slowdown)):
+            log_slowdown[k] = max(log_slowdown[k], 0.9 * log_slowdown[k-1])
+        for k in xrange(len(log_slowdown) - 2, -1, -1):
+            log_slowdown[k] = max(log_slowdown[k], 0.9 * log_slowdown[k+1])
+        segment_slowdown = np.exp(log_slowdown)
+        v_segment /= segment_slowdown
+        a_segment /= segment_slowdown**2
+        v_cap[:-1] = np.minimum(v_cap[:-1], v[:-1] / segment_slowdown)
+        v_cap[1:] = np.minimum(v_cap[1:], v[1:] / segment_slowdown)
+        v = speed_profile(v_cap, lengths, a_segment)
+        durations = segment_durations(lengths, v[:-1], v[1:], v_segment, a_segment)
+
+    # whatever is left (within tolerance, or after max_iterations) is
+    # removed by slowing the whole trajectory down by the worst factor
+    velocities = spline_velocities(durations, dq)
+    peak_velocities, peak_accelerations = hermite_peaks(durations, dq,
+        velocities[:-1], velocities[1:])
+    slowdown = max(1., np.max(peak_velocities / max_velocities),
+        np.sqrt(np.max(peak_accelerations / max_accelerations)))
+    times = np.concatenate(([0.], np.cumsum(durations * slowdown)))
+    return times, velocities / slowdown
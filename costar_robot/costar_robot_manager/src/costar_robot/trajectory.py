@@ -0,0 +1,188 @@
+# By Chris Paxton and Felix Jonathan
+# (c) 2016-2017 The Johns Hopkins University
+# See license for more details
+
+import rospy
+import numpy as np
+
+from trajectory_msgs.msg import JointTrajectory
+from trajectory_msgs.msg import JointTrajectoryPoint
+
+# TRAJECTORY ARRAYS
+# Array representation of a joint trajectory: one row per trajectory point.
+# SimplePlanning builds trajectories in this form and only turns them into a
+# trajectory_msgs/JointTrajectory message when one is actually needed.
+class TrajectoryArrays(object):
+
+    def __init__(self, positions, times, velocities=None, joint_names=[]):
+        self.positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        self.times = np.asarray(times, dtype=float)
+        if velocities is None:
+            velocities = finite_difference_velocities(self.positions, self.times)
+        self.velocities = np.atleast_2d(np.asarray(velocities, dtype=float))
+        self.joint_names = joint_names
+
+    @classmethod
+    def from_msg(cls, traj):
+        '''
+        Arrays of a JointTrajectory message. Velocities are recomputed if the
+        message does not have them for every point.
+        '''
+        positions = [pt.positions for pt in traj.points]
+        times = [pt.time_from_start.to_sec() for pt in traj.points]
+        velocities = None
+        if len(traj.points) > 0 and all(len(pt.velocities) == len(pt.positions) for pt in traj.points):
+            velocities = [pt.velocities for pt in traj.points]
+        return cls(positions, times, velocities, joint_names=list(traj.joint_names))
+
+    def __len__(self):
+        return len(self.times)
+
+    def sample(self, t):
+        '''
+        Position and velocity at time t, by cubic Hermite interpolation
+        between the points. t is clamped to the times of the trajectory.
+        '''
+        if t <= self.times[0] or len(self.times) == 1:
+            return self.positions[0].copy(), self.velocities[0].copy()
+        if t >= self.times[-1]:
+            return self.positions[-1].copy(), self.velocities[-1].copy()
+        k = min(int(np.searchsorted(self.times, t, side='right')) - 1, len(self.times) - 2)
+        h = self.times[k+1] - self.times[k]
+        if h <= 0:
+            return self.positions[k+1].copy(), self.velocities[k+1].copy()
+        s = (t - self.times[k]) / h
+        p0, p1 = self.positions[k], self.positions[k+1]
+        m0, m1 = self.velocities[k] * h, self.velocities[k+1] * h
+        q = (2*s**3 - 3*s**2 + 1) * p0 + (s**3 - 2*s**2 + s) * m0 \
+            + (3*s**2 - 2*s**3) * p1 + (s**3 - s**2) * m1
+        dq = ((6*s**2 - 6*s) * (p0 - p1) + (3*s**2 - 4*s + 1) * m0 + (3*s**2 - 2*s) * m1) / h
+        return q, dq
+
+    def to_msg(self):
+        '''
+        Materialize the trajectory as a JointTrajectory message.
+        '''
+        traj = JointTrajectory(joint_names=self.joint_names)
+        dof = self.positions.shape[1]
+        for q, dq, t in zip(self.positions.tolist(), self.velocities.tolist(), self.times):
+            traj.points.append(JointTrajectoryPoint(positions=q,
+                velocities=dq,
+                accelerations=[0]*dof,
+                time_from_start=rospy.Duration(t)))
+        return traj
+
+def finite_difference_velocities(positions, times):
+    '''
+    Velocity of every point towards the next one; the last point is at rest.
+    '''
+    velocities = np.zeros(positions.shape)
+    if len(times) > 1:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            velocities[:-1] = np.diff(positions, axis=0) / np.diff(times)[:,np.newaxis]
+    return velocities
+
+def central_difference_velocities(positions, times):
+    '''
+    Velocity of every point from its two neighbors, for dense paths through
+    samples of a smooth motion; the first and last point are at rest.
+    '''
+    velocities = np.zeros(positions.shape)
+    if len(times) > 2:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            velocities[1:-1] = (positions[2:] - positions[:-2]) \
+                / (times[2:] - times[:-2])[:,np.newaxis]
+    return np.nan_to_num(velocities)
+
+def trapezoidal_profile_parameters(dq_to_target,
+    base_steps,
+    steps_per_meter,
+    steps_per_radians,
+    delta_translation,
+    time_multiplier,
+    percent_acc):
+    '''
+    Parameters of the trapezoidal velocity profile used by SimplePlanning.
+    Returns (steps, ts, t_v_setting_max, steps_to_max_speed,
+    const_velocity_max_step, steps_required_to_max_speed); the last entry is
+    twice the number of steps needed to reach full speed, which is larger than
+    steps when the profile has been reduced to a triangle.
+    '''
+    # We compute a number of steps to take along our trapezoidal trajectory
+    # curve. This gives us a nice, relatively dense trajectory that we can
+    # introspect on later -- we can use it to compute cost functions, to
+    # detect collisions, etc.
+    delta_q_norm = np.linalg.norm(dq_to_target)
+    steps = base_steps + delta_translation * steps_per_meter + delta_q_norm \
+        * steps_per_radians
+    # Number of steps must be an int.
+    steps = int(np.round(steps))
+
+    # This is the time needed for constant velocity at 100% to reach the goal.
+    t_v_constant = delta_translation + delta_q_norm
+    ts = (t_v_constant / steps ) * time_multiplier
+
+    # the max constant joint velocity
+    dq_max_target = np.max(np.absolute(dq_to_target))
+    v_max = dq_max_target/t_v_constant
+    v_setting_max = v_max / time_multiplier
+
+    acceleration = v_max * percent_acc
+    t_v_setting_max = v_setting_max / acceleration
+
+    # Compute the number of trajectory points we want to make before we will
+    # get up to max speed.
+    steps_to_max_speed = 0.5 * acceleration * t_v_setting_max **2 \
+        / (dq_max_target / steps)
+    steps_required = steps_to_max_speed * 2
+    if steps_to_max_speed * 2 > steps:
+        t_v_setting_max = np.sqrt(0.5 * dq_max_target / acceleration)
+        steps_to_max_speed = (0.5 * steps)
+        v_setting_max = t_v_setting_max * acceleration
+
+    const_velocity_max_step = np.max([steps - 2 * steps_to_max_speed, 0])
+
+    return steps, ts, t_v_setting_max, steps_to_max_speed, const_velocity_max_step, steps_required
+
+def trapezoidal_step_times(step_index,
+    steps_to_max_speed,
+    const_velocity_max_step,
+    t_v_const_step,
+    t_to_reach_v_setting_max):
+    '''
+    Time from start of the given trajectory step(s). step_index may be a
+    scalar or an array of step indices.
+    '''
+    step_index = np.asarray(step_index, dtype=float)
+    acceleration_step = np.minimum(step_index, steps_to_max_speed)
+    deceleration_step = np.minimum(np.maximum(step_index - const_velocity_max_step - steps_to_max_speed, 0), steps_to_max_speed)
+    const_velocity_step = np.minimum(np.maximum(0, step_index - steps_to_max_speed), const_velocity_max_step)
+    acceleration_time = np.zeros(step_index.shape)
+    deceleration_time = np.zeros(step_index.shape)
+    if steps_to_max_speed > 0.0001:
+        acceleration_time = np.sqrt(acceleration_step/steps_to_max_speed) * t_to_reach_v_setting_max
+        deceleration_time = t_to_reach_v_setting_max - np.sqrt((steps_to_max_speed-deceleration_step)/steps_to_max_speed) * t_to_reach_v_setting_max
+    const_vel_time = const_velocity_step * t_v_const_step
+
+    return acceleration_time + const_vel_time + deceleration_time
+
+def interpolate_joint_move(q0, q_goal, steps,
+    steps_to_max_speed,
+    const_velocity_max_step,
+    t_v_const_step,
+    t_to_reach_v_setting_max,
+    joint_names=[]):
+    '''
+    Straight line in joint space from q0 to q_goal with steps + 1 points,
+    timed by the trapezoidal time law.
+    '''
+    q0 = np.asarray(q0, dtype=float)
+    delta_q = np.asarray(q_goal, dtype=float) - q0
+    step_index = np.arange(steps + 1)
+    positions = q0 + (step_index / float(steps))[:,np.newaxis] * delta_q
+    times = trapezoidal_step_times(step_index,
+        steps_to_max_speed,
+        const_velocity_max_step,
+        t_v_const_step,
+        t_to_reach_v_setting_max)
+    return TrajectoryArrays(positions, times, joint_names=joint_names)
@@ -39,6 +39,8 @@ class CostarUR5Driver(CostarArm):
 
         self.simulation = simulation
         self.ur_script_pub = rospy.Publisher('/ur_driver/URScript', String, queue_size=10,*args,**kwargs)
+        # ur_modern_driver runs speedj with the velocities of the first point
+        self.joint_speed_pub = rospy.Publisher('/ur_driver/joint_speed', JointTrajectory, queue_size=1)
 
         self.closed_form_IK_solver = InverseKinematicsUR5()
         self.closed_form_IK_solver.setEERotationOffsetROS()
@@ -78,9 +80,6 @@ class CostarUR5Driver(CostarArm):
     '''
     def send_trajectory(self,traj,stamp,acceleration=0.5,velocity=0.5,cartesian=False,linear=False):
 
-        rate = rospy.Rate(30)
-        t = rospy.Time(0)
-        
         # Make sure that the trajectory 0 is the current joint position
         traj.points[0].positions = self.q0
 
@@ -91,50 +90,36 @@ class CostarUR5Driver(CostarArm):
         if self.simulation:
             rospy.logwarn("Simulation mode is active")
             if not linear:
-                for pt in traj.points[:-1]:
-                    if not cartesian:
-                        self.send_q(pt.positions,acceleration,velocity)
-                    else:
-                        self.send_cart(pt.positions,acceleration,velocity) ##
-                    self.set_goal(pt.positions)
-
-                    start_t = rospy.Time.now()
-
-                    rospy.sleep(rospy.Duration(pt.time_from_start.to_sec() - t.to_sec()))
-                    t = pt.time_from_start
+                if not self.streaming_executor.execute(traj, lambda: self.valid_verify(stamp)):
+                    return 'FAILURE - preempted'
 
             if not cartesian:
                 self.send_q(traj.points[-1].positions,acceleration,velocity)
             else:
                 self.send_cart(traj.points[-1].positions,acceleration,velocity) ##
             self.set_goal(traj.points[-1].positions)
-            start_t = rospy.Time.now()
 
             # wait until robot is at goal
-            #while self.moving:
-            while not self.at_goal and self.valid_verify(stamp):
-                if (rospy.Time.now() - start_t).to_sec() > 3:
-                    return 'FAILURE - timeout'
-                rate.sleep()
-
-            if self.at_goal:
+            if self.wait_for_goal(3, stamp):
                 return 'SUCCESS - moved to pose'
-            else:
+            elif not self.valid_verify(stamp):
                 return 'FAILURE - did not reach destination'
+            else:
+                return 'FAILURE - timeout'
         else:
             self.set_goal(traj.points[-1].positions)
 
         goal = FollowJointTrajectoryGoal(trajectory=traj)
-        for i, pt in enumerate(traj.points):
-            print("Pt =", i, pt.positions)
+        rospy.logdebug("Sending %d trajectory points to UR"%len(traj.points))
 
         if self.valid_verify(stamp):
             self.client.send_goal(goal)
-            # max time before returning = 30 s
-            done = False
-            #while self.valid_verify(stamp) and not done:
+            # wait in short steps so that preemption stops the robot right away
             rospy.loginfo("Waiting for UR...")
-            self.client.wait_for_result()#rospy.Duration.from_sec(1.0))
+            while not self.client.wait_for_result(rospy.Duration.from_sec(0.1)):
+                if not self.valid_verify(stamp):
+                    self.client.cancel_goal()
+                    break
             rospy.loginfo("Done waiting for UR.")
         else:
             return "FAILURE - preempted before trajectory sent"
@@ -177,6 +162,18 @@ class CostarUR5Driver(CostarArm):
 
         self.pt_publisher.publish(pt)
 
+    '''
+    Servo setpoints go to the joint velocity interface of the real robot;
+    the simulation takes joint positions.
+    '''
+    def send_servo(self,q,dq,period):
+        if self.simulation:
+            super(CostarUR5Driver, self).send_servo(q,dq,period)
+        else:
+            pt = JointTrajectoryPoint(velocities=dq.tolist(),
+                    accelerations=[self.MAX_ACC] * self.dof)
+            self.joint_speed_pub.publish(JointTrajectory(points=[pt]))
+
     '''
     URX supports Cartesian moves, so we will recover our forward kinematics
     and send a Cartesian pose.